@@ -1,5 +1,6 @@
 import argparse
 import csv
+import json
 import logging
 import os
 import sys
@@ -7,20 +8,49 @@ import sys
 from autouri import GCSURI, S3URI
 
 from . import __version__ as version
-from .croo import Croo
+from .croo import DEFAULT_WATCH_INTERVAL, Croo
+from .croo_batch import BATCH_SUMMARY_FILE, CrooBatch
+from .croo_local_copy import LOCAL_COPY_METHOD_COPY, LOCAL_COPY_METHODS
+from .croo_throttle import BACKENDS, DEFAULT_MAX_RETRIES, DEFAULT_RETRY_DELAY
+from .croo_tmp_cache import is_same_or_sub_dir
+from .croo_transfer import DEFAULT_MULTIPART_NUM_THREADS, DEFAULT_MULTIPART_PART_SIZE
 
 
-def parse_croo_arguments():
+def parse_croo_arguments(batch=False):
     """Argument parser for Cromwell Output Organizer (COO)
+
+    Args:
+        batch:
+            Parse arguments for "croo batch" (sys.argv[2:]).
     """
-    p = argparse.ArgumentParser()
-    p.add_argument(
-        'metadata_json',
-        help='Path, URL or URI for metadata.json for a workflow '
-        'Example: /scratch/sample1/metadata.json, '
-        'gs://some/where/metadata.json, '
-        'http://hello.com/world/metadata.json',
-    )
+    if batch:
+        p = argparse.ArgumentParser(prog='croo batch', fromfile_prefix_chars='@')
+        p.add_argument(
+            'metadata_json',
+            nargs='+',
+            help='Paths, URLs or URIs for metadata.json files for workflows. '
+            'Glob patterns are allowed for local files '
+            '(quote them to pass them to croo as they are). '
+            'A metadata JSON file can have a list of metadata JSON objects. '
+            'Use @FILE to read them from a text file (one per line). '
+            'Example: "/scratch/*/metadata.json" gs://some/where/metadata.json',
+        )
+        p.add_argument(
+            '--num-workers',
+            type=int,
+            default=1,
+            help='Number of worker processes to organize outputs of '
+            'workflows in parallel. Worker processes share caches on --tmp-dir.',
+        )
+    else:
+        p = argparse.ArgumentParser()
+        p.add_argument(
+            'metadata_json',
+            help='Path, URL or URI for metadata.json for a workflow '
+            'Example: /scratch/sample1/metadata.json, '
+            'gs://some/where/metadata.json, '
+            'http://hello.com/world/metadata.json',
+        )
     p.add_argument(
         '--out-def-json',
         help='Output definition JSON file for a WDL file corresponding to '
@@ -28,13 +58,21 @@ def parse_croo_arguments():
     )
     p.add_argument(
         '--method',
-        choices=('link', 'copy'),
+        choices=('link', 'copy') + LOCAL_COPY_METHODS[1:],
         default='link',
         help='Method to localize files on output directory/bucket. '
         '"link" means a soft-linking and it\'s for local directory only. '
         'Original output files will be kept in Cromwell\'s output '
         'directory. '
-        '"copy" makes copies of Cromwell\'s original outputs',
+        '"copy" makes copies of Cromwell\'s original outputs. '
+        'Other methods are the same as "copy" except for '
+        'copying between local files: '
+        '"hardlink" makes hard links. '
+        '"reflink" makes copy-on-write clones on a file system supporting it '
+        '(e.g. btrfs, XFS). '
+        '"copy_file_range" copies within kernel with copy_file_range(2). '
+        'These fall back to "copy" if not possible '
+        '(e.g. different devices).',
     )
     p.add_argument(
         '--ucsc-genome-db',
@@ -88,7 +126,10 @@ def parse_croo_arguments():
         '--out-dir',
         default='.',
         help='Output directory/bucket (LOCAL OR REMOTE). '
-        'This can be a local path, gs:// or s3://. ',
+        'This can be a local path, gs:// or s3://. '
+        'For "croo batch", outputs of each workflow are organized on '
+        'OUT_DIR/WORKFLOW_ID/ and a summary of all workflows is written '
+        'as croo.batch_summary.json on OUT_DIR.',
     )
     p.add_argument(
         '--tmp-dir',
@@ -97,6 +138,16 @@ def parse_croo_arguments():
         'stored here. You can clean it up but will lose all cached files '
         'so that remote files will be re-downloaded.',
     )
+    p.add_argument(
+        '--max-tmp-cache-size-mb',
+        type=int,
+        help='Limit total size (in MB) of files cached on --tmp-dir '
+        '(e.g. remote metadata JSON and out_def JSON files localized on it). '
+        'Least recently accessed files are evicted. '
+        'md5 checksum cache DB and manifests are not evicted. '
+        'Not allowed if --tmp-dir is --out-dir itself or its parent. '
+        'No limit by default.',
+    )
     p.add_argument(
         '--use-gsutil-for-s3',
         action='store_true',
@@ -112,25 +163,246 @@ def parse_croo_arguments():
         'even if md5-identical files (or soft links) already exist there. '
         'Md5 hash/filename/filesize checking will be skipped.',
     )
+    p.add_argument(
+        '--task-graph-transitive-reduction',
+        action='store_true',
+        help='Remove redundant links from the task graph in HTML report. '
+        'A link between two nodes is removed if one can be reached from '
+        'the other through other nodes. Useful for a huge graph.',
+    )
+    p.add_argument(
+        '--compact-task-graph',
+        action='store_true',
+        help='Use a memory-efficient task graph. '
+        'Nodes are stored with integer IDs and links are stored in arrays. '
+        'Useful for a huge workflow with 100k+ files.',
+    )
+    p.add_argument(
+        '--stream-metadata',
+        action='store_true',
+        help='Parse metadata JSON file as a stream without loading the whole '
+        'JSON document on memory. Useful for a huge (>1GB) metadata JSON file. '
+        'Requires ijson (pip install ijson).',
+    )
+    p.add_argument(
+        '--cache-metadata',
+        action='store_true',
+        help='Cache parsed metadata JSON on --tmp-dir. '
+        'Metadata JSON file is not downloaded/parsed again on a next run '
+        'if it has not changed (path, size, mtime and inode for a local file, '
+        'URI, size, mtime and md5 hash for a remote one). '
+        'Useful for re-running croo on a huge metadata JSON file '
+        'with a different output definition JSON file.',
+    )
+    p.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of threads to transfer (copy/link) files in parallel. '
+        'All transfers are done first and then HTML report is generated. '
+        'Croo fails after generating HTML report if any transfer fails.',
+    )
+    p.add_argument(
+        '--no-checksum-cache',
+        action='store_true',
+        help='Do not cache md5 hashes of local files on --tmp-dir. '
+        'With "--method copy", md5 hashes are used to skip copying '
+        'identical files. A cached hash is used only if the file\'s size and '
+        'modification time have not changed.',
+    )
+    p.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume organizing outputs from a previous run. '
+        'Croo writes a manifest of transferred files (croo.manifest.*.jsonl) '
+        'on --out-dir while organizing outputs. Files in it are skipped '
+        'if their sources have not changed and transferred files still exist.',
+    )
+    p.add_argument(
+        '--multipart-threshold-mb',
+        type=int,
+        help='Upload a local file larger than this (in MB) to '
+        'a cloud --out-dir (gs://, s3://) in parts in parallel. '
+        'Parallel composite upload on GCS and multipart upload on S3. '
+        'Note that a composite object on GCS does not have an md5 hash. '
+        'If not defined, a file is uploaded as a single stream on GCS '
+        'and with boto3\'s default multipart settings on S3.',
+    )
+    p.add_argument(
+        '--multipart-part-size-mb',
+        type=int,
+        default=DEFAULT_MULTIPART_PART_SIZE // (1024 * 1024),
+        help='Size of each part (in MB) for --multipart-threshold-mb. '
+        'It is increased if a file has too many parts '
+        '(32 parts at most on GCS).',
+    )
+    p.add_argument(
+        '--multipart-num-threads',
+        type=int,
+        default=DEFAULT_MULTIPART_NUM_THREADS,
+        help='Number of threads to upload parts of each file '
+        'for --multipart-threshold-mb. '
+        'Up to --jobs x this number of parts can be uploaded at the same time.',
+    )
+    p.add_argument(
+        '--max-concurrent-transfers',
+        help='Limit the number of concurrent transfers from/to each storage '
+        'backend (local, gs, s3 and http). Comma-separated BACKEND=N pairs. '
+        'e.g. "local=4,gs=64" not to overload an NFS server '
+        'while saturating a link to GCS with --jobs 64.',
+    )
+    p.add_argument(
+        '--max-transfer-rate-mb',
+        help='Limit average bandwidth (in MB/sec) of transfers from/to '
+        'each storage backend (local, gs, s3 and http). '
+        'Comma-separated BACKEND=N pairs. e.g. "local=200". '
+        'This is a coarse limit per file: a transfer waits until '
+        'the budget for the whole file is available.',
+    )
+    p.add_argument(
+        '--max-retries',
+        type=int,
+        default=DEFAULT_MAX_RETRIES,
+        help='Maximum number of retrials for a transfer failed with '
+        'a transient error (e.g. connection error, time-out, '
+        'HTTP 429/5xx, stale NFS file handle).',
+    )
+    p.add_argument(
+        '--retry-delay',
+        type=float,
+        default=DEFAULT_RETRY_DELAY,
+        help='Delay (in seconds) before the first retrial. '
+        'It is doubled for each retrial (exponential backoff).',
+    )
+    p.add_argument(
+        '--no-stats',
+        action='store_true',
+        help='Do not write performance metrics of a run (croo.stats.*.json) '
+        'on --out-dir. It has timings of each phase '
+        '(metadata parsing, task graph, transfers and report), '
+        'increase of resident memory (RSS) by metadata parsing, '
+        'number of files transferred/skipped, bytes transferred, '
+        'throughput per storage backend and the slowest transfers.',
+    )
+    p.add_argument(
+        '--profile',
+        action='store_true',
+        help='Profile croo itself. Time and peak memory (max RSS) of '
+        'each phase (metadata localization/parsing, task graph construction, '
+        'inline expressions, each transfer, DOT/graphviz rendering and '
+        'HTML writing) are written as a Chrome trace JSON file '
+        '(croo.profile.*.json) on --out-dir. Open it on Perfetto UI '
+        '(https://ui.perfetto.dev) or speedscope as a flame chart.',
+    )
+    if not batch:
+        p.add_argument(
+            '--watch',
+            action='store_true',
+            help='Organize outputs incrementally while a workflow is running. '
+            'metadata_json (a file periodically rewritten with a running '
+            'workflow\'s metadata or a local directory with snapshots of metadata '
+            'JSON files) is polled every --watch-interval seconds and outputs of '
+            'newly done calls are transferred. HTML report is written once '
+            'the workflow is done (Succeeded, Failed or Aborted). '
+            'Transferred files are recorded in a manifest (see --resume).',
+        )
+        p.add_argument(
+            '--watch-interval',
+            type=float,
+            default=DEFAULT_WATCH_INTERVAL,
+            help='Polling interval in seconds for --watch.',
+        )
+        p.add_argument(
+            '--watch-timeout',
+            type=float,
+            help='Stop watching after this (in seconds) and write HTML report '
+            'with all calls done so far. No timeout by default.',
+        )
+        p.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Print a plan for organizing outputs (all resolved target paths, '
+            'transfer method, size of each file and whether it will be skipped) '
+            'without transferring files or writing HTML report on --out-dir. '
+            'Storages are not accessed unless --dry-run-check-storage. '
+            '--out-dir is not created and no file is evicted from --tmp-dir '
+            '(--max-tmp-cache-size-mb is ignored). Remote metadata JSON and '
+            'out_def JSON files are still localized on --tmp-dir '
+            '(OUT_DIR/.croo_tmp by default) and parsed metadata is cached '
+            'there with --cache-metadata.',
+        )
+        p.add_argument(
+            '--dry-run-check-storage',
+            action='store_true',
+            help='Read metadata of files on storages with --dry-run to get '
+            'size of each file and to find files that will be skipped. '
+            'md5 hashes of local files can be calculated (not cached) and '
+            'a manifest on --out-dir is read with --resume.',
+        )
+        p.add_argument(
+            '--plan-format',
+            choices=['json', 'tsv'],
+            default='json',
+            help='Format of a plan printed with --dry-run. '
+            'json: everything including outputs and summary. '
+            'tsv: one line per transfer job.',
+        )
     p.add_argument('-v', '--version', action='store_true', help='Show version')
     p.add_argument(
         '-D', '--debug', action='store_true', help='Prints all logs >= DEBUG level'
     )
 
-    if len(sys.argv[1:]) == 0:
+    argv = sys.argv[2:] if batch else sys.argv[1:]
+    if len(argv) == 0:
         p.print_help()
         p.exit()
-    if '-v' in sys.argv or '--version' in sys.argv:
+    if '-v' in argv or '--version' in argv:
         print(version)
         p.exit()
 
-    args = p.parse_args()
+    args = p.parse_args(argv)
     # convert to dict
     d_args = vars(args)
 
     return d_args
 
 
+def parse_backend_limits(s, arg_name, value_type):
+    """Parse comma-separated BACKEND=N pairs (e.g. local=4,gs=64)
+
+    Returns:
+        dict of { backend: N }. None if s is None.
+    """
+    if s is None:
+        return None
+    limits = {}
+    for pair in s.split(','):
+        backend, sep, value = pair.partition('=')
+        backend = backend.strip()
+        if not sep or backend not in BACKENDS:
+            raise ValueError(
+                'Invalid {arg_name}: {s}. Define comma-separated BACKEND=N pairs. '
+                'BACKEND must be one of {backends}.'.format(
+                    arg_name=arg_name, s=s, backends=BACKENDS
+                )
+            )
+        try:
+            limits[backend] = value_type(value)
+        except ValueError:
+            raise ValueError(
+                'Invalid number for {backend} in {arg_name}: {s}'.format(
+                    backend=backend, arg_name=arg_name, s=s
+                )
+            )
+        if limits[backend] <= 0:
+            raise ValueError(
+                'Limit for {backend} in {arg_name} must be > 0'.format(
+                    backend=backend, arg_name=arg_name
+                )
+            )
+    return limits
+
+
 def check_args(args):
     """Check cmd line arguments are valid
 
@@ -161,6 +433,59 @@ def check_args(args):
     if args['out_dir'].startswith(('http://', 'https://')):
         raise ValueError('URL is not allowed for --out-dir')
 
+    if args['max_tmp_cache_size_mb'] is not None and args['max_tmp_cache_size_mb'] < 0:
+        raise ValueError('--max-tmp-cache-size-mb must be >= 0')
+
+    if (
+        args['max_tmp_cache_size_mb'] is not None
+        and args['tmp_dir'] is not None
+        and is_same_or_sub_dir(args['out_dir'], args['tmp_dir'])
+    ):
+        raise ValueError(
+            '--max-tmp-cache-size-mb is not allowed if --tmp-dir is '
+            '--out-dir itself or its parent.'
+        )
+
+    if args['jobs'] < 1:
+        raise ValueError('--jobs must be >= 1')
+
+    if (
+        args['multipart_threshold_mb'] is not None
+        and args['multipart_threshold_mb'] < 0
+    ):
+        raise ValueError('--multipart-threshold-mb must be >= 0')
+
+    if args['multipart_part_size_mb'] < 1:
+        raise ValueError('--multipart-part-size-mb must be >= 1')
+
+    if args['multipart_num_threads'] < 1:
+        raise ValueError('--multipart-num-threads must be >= 1')
+
+    if args.get('watch') and args.get('dry_run'):
+        raise ValueError('--watch and --dry-run cannot be used together.')
+
+    if args.get('dry_run_check_storage') and not args.get('dry_run'):
+        raise ValueError('--dry-run-check-storage requires --dry-run.')
+
+    if args.get('watch_interval', DEFAULT_WATCH_INTERVAL) <= 0.0:
+        raise ValueError('--watch-interval must be > 0')
+
+    if args.get('num_workers', 1) < 1:
+        raise ValueError('--num-workers must be >= 1')
+
+    if args['max_retries'] < 0:
+        raise ValueError('--max-retries must be >= 0')
+
+    if args['retry_delay'] < 0.0:
+        raise ValueError('--retry-delay must be >= 0')
+
+    args['max_concurrent_transfers'] = parse_backend_limits(
+        args['max_concurrent_transfers'], '--max-concurrent-transfers', int
+    )
+    args['max_transfer_rate_mb'] = parse_backend_limits(
+        args['max_transfer_rate_mb'], '--max-transfer-rate-mb', float
+    )
+
 
 def init_dirs(args):
     """More initialization for out/tmp directories since tmp
@@ -176,7 +501,8 @@ def init_dirs(args):
             args['tmp_dir'] = os.path.join(os.getcwd(), '.croo_tmp')
     else:
         args['out_dir'] = os.path.abspath(os.path.expanduser(args['out_dir']))
-        os.makedirs(args['out_dir'], exist_ok=True)
+        if not args.get('dry_run'):
+            os.makedirs(args['out_dir'], exist_ok=True)
         if args['tmp_dir'] is None:
             args['tmp_dir'] = os.path.join(args['out_dir'], '.croo_tmp')
 
@@ -218,20 +544,43 @@ def init_logging(args):
     logging.getLogger('filelock').setLevel('CRITICAL')
 
 
-def main():
-    args = parse_croo_arguments()
+def print_plan(plan, plan_format):
+    """Print a plan made by Croo.plan() on STDOUT
+
+    Args:
+        plan:
+            dict returned by Croo.plan()
+        plan_format:
+            json or tsv
+    """
+    if plan_format == 'json':
+        print(json.dumps(plan, indent=4))
+    else:
+        writer = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+        cols = ('src', 'target', 'method', 'size', 'skip')
+        writer.writerow(cols)
+        for job in plan['jobs']:
+            writer.writerow(['' if job[c] is None else job[c] for c in cols])
 
-    check_args(args)
-    init_dirs(args)
-    init_autouri(args)
-    init_logging(args)
 
-    co = Croo(
-        metadata_json=args['metadata_json'],
+def make_croo_kwargs(args):
+    """Make keyword arguments for Croo from cmd line arguments
+    except for metadata_json.
+
+    Args:
+        args:
+            dict of cmd line arguments
+    """
+    return dict(
         out_def_json=args['out_def_json'],
         out_dir=args['out_dir'],
         tmp_dir=args['tmp_dir'],
         soft_link=args['method'] == 'link',
+        local_copy_method=(
+            args['method']
+            if args['method'] in LOCAL_COPY_METHODS
+            else LOCAL_COPY_METHOD_COPY
+        ),
         ucsc_genome_db=args['ucsc_genome_db'],
         ucsc_genome_pos=args['ucsc_genome_pos'],
         use_presigned_url_s3=args['use_presigned_url_s3'],
@@ -242,9 +591,92 @@ def main():
         gcp_private_key=args['gcp_private_key'],
         map_path_to_url=args['mapping_path_to_url'],
         no_checksum=args['no_checksum'],
+        task_graph_transitive_reduction=args['task_graph_transitive_reduction'],
+        compact_task_graph=args['compact_task_graph'],
+        stream_metadata=args['stream_metadata'],
+        cache_metadata=args['cache_metadata'],
+        num_threads=args['jobs'],
+        use_checksum_cache=not args['no_checksum_cache'],
+        resume=args['resume'],
+        multipart_threshold=(
+            None
+            if args['multipart_threshold_mb'] is None
+            else args['multipart_threshold_mb'] * 1024 * 1024
+        ),
+        multipart_part_size=args['multipart_part_size_mb'] * 1024 * 1024,
+        multipart_num_threads=args['multipart_num_threads'],
+        max_concurrent_transfers=args['max_concurrent_transfers'],
+        max_bytes_per_sec=(
+            None
+            if args['max_transfer_rate_mb'] is None
+            else {
+                backend: int(rate * 1024 * 1024)
+                for backend, rate in args['max_transfer_rate_mb'].items()
+            }
+        ),
+        max_retries=args['max_retries'],
+        retry_delay=args['retry_delay'],
+        write_stats=not args['no_stats'],
+        profile=args['profile'],
+        max_tmp_cache_size=(
+            None
+            if args['max_tmp_cache_size_mb'] is None
+            else args['max_tmp_cache_size_mb'] * 1024 * 1024
+        ),
     )
 
-    co.organize_output()
+
+def main_batch():
+    args = parse_croo_arguments(batch=True)
+
+    check_args(args)
+    init_dirs(args)
+    init_autouri(args)
+    init_logging(args)
+
+    summary = CrooBatch(
+        metadata_jsons=args['metadata_json'],
+        num_workers=args['num_workers'],
+        **make_croo_kwargs(args)
+    ).run()
+    if summary['num_failed']:
+        raise Exception(
+            'Failed to organize outputs of {num_failed} out of '
+            '{num_workflows} workflows. See {f} on --out-dir.'.format(
+                f=BATCH_SUMMARY_FILE, **summary
+            )
+        )
+
+    return 0
+
+
+def main():
+    if sys.argv[1:2] == ['batch']:
+        return main_batch()
+
+    args = parse_croo_arguments()
+
+    check_args(args)
+    init_dirs(args)
+    init_autouri(args)
+    init_logging(args)
+
+    croo_kwargs = make_croo_kwargs(args)
+    if args['dry_run']:
+        # never evict files from tmp_dir on a dry run
+        croo_kwargs['max_tmp_cache_size'] = None
+
+    co = Croo(metadata_json=args['metadata_json'], watch=args['watch'], **croo_kwargs)
+
+    if args['dry_run']:
+        print_plan(
+            co.plan(check_storage=args['dry_run_check_storage']),
+            args['plan_format'],
+        )
+    elif args['watch']:
+        co.watch(interval=args['watch_interval'], timeout=args['watch_timeout'])
+    else:
+        co.organize_output()
 
     return 0
 
@@ -0,0 +1,237 @@
+"""Compact DAG with dense integer node IDs and CSR adjacency arrays.
+It takes much less memory than DAG for a huge graph (100k+ nodes)
+since it doesn't keep a Python set of parents/children for each node.
+"""
+
+from array import array
+
+from .dag import DAG
+
+
+class CompactDAG(DAG):
+    """Directed acyclic graph with the same interface as DAG.
+    Each node gets a dense integer ID (0, 1, 2, ...) in order of insertion
+    and this ID is used instead of a node's hash in all public methods
+    (e.g. get_nodes(), find_nodes() and to_dot()).
+
+    Links are stored in compressed sparse row (CSR) arrays.
+    e.g. parents of a node with ID i are
+        self._parent_idx[self._parent_ptr[i]:self._parent_ptr[i + 1]]
+
+    CSR arrays are rebuilt from scratch whenever nodes are added/removed,
+    so add all nodes at once with add_nodes() or from_nodes().
+    Key functions (fnc_keys_as_parent and fnc_keys_as_child) are required.
+
+    Member variables:
+        self._node_list:
+            [n0, n1, ...] where index is ID of a node.
+            None for a removed node.
+        self._ids:
+            { h: i } where h = hash of a node and i = ID of a node.
+        self._parent_ptr, self._parent_idx:
+            CSR arrays for parents.
+        self._child_ptr, self._child_idx:
+            CSR arrays for children.
+    """
+
+    def __init__(
+        self,
+        fnc_is_parent,
+        fnc_hash=None,
+        nodes=None,
+        fnc_keys_as_parent=None,
+        fnc_keys_as_child=None,
+    ):
+        if fnc_keys_as_parent is None or fnc_keys_as_child is None:
+            raise ValueError(
+                'fnc_keys_as_parent and fnc_keys_as_child must be defined '
+                'for CompactDAG.'
+            )
+        super().__init__(
+            fnc_is_parent=fnc_is_parent,
+            fnc_hash=fnc_hash,
+            fnc_keys_as_parent=fnc_keys_as_parent,
+            fnc_keys_as_child=fnc_keys_as_child,
+        )
+        self._node_list = []
+        self._ids = {}
+        self._parent_ptr = array('q', [0])
+        self._parent_idx = array('i')
+        self._child_ptr = array('q', [0])
+        self._child_idx = array('i')
+        if nodes is not None:
+            self.add_nodes(nodes)
+
+    @classmethod
+    def from_dag(cls, dag):
+        """Convert any DAG into a CompactDAG.
+        """
+        return cls(
+            fnc_is_parent=dag._fnc_is_parent,
+            fnc_hash=dag._fnc_hash,
+            nodes=[n for _, n in dag.get_nodes()],
+            fnc_keys_as_parent=dag._fnc_keys_as_parent,
+            fnc_keys_as_child=dag._fnc_keys_as_child,
+        )
+
+    def __str__(self):
+        """to String.
+        """
+        result = '=== all nodes ===\n'
+        for i, n in self.get_nodes():
+            result += '{}: {}\n'.format(i, n)
+
+        result += '\n=== parents ===\n'
+        for i, _ in self.get_nodes():
+            result += '{}: {}\n'.format(i, list(self.get_parents(i)))
+
+        result += '\n=== children ===\n'
+        for i, _ in self.get_nodes():
+            result += '{}: {}\n'.format(i, list(self.get_children(i)))
+
+        return result
+
+    def get_nodes(self):
+        """Get a list of all nodes
+
+        Returns:
+            [(i, n)] where i is an ID of a node n
+        """
+        return [(i, n) for i, n in enumerate(self._node_list) if n is not None]
+
+    def get_parents(self, i):
+        """Get IDs of all parents of a node.
+        """
+        if i >= len(self._parent_ptr) - 1:
+            return ()
+        return self._parent_idx[self._parent_ptr[i] : self._parent_ptr[i + 1]]
+
+    def get_children(self, i):
+        """Get IDs of all children of a node.
+        """
+        if i >= len(self._child_ptr) - 1:
+            return ()
+        return self._child_idx[self._child_ptr[i] : self._child_ptr[i + 1]]
+
+    def get_id(self, n):
+        """Get ID of a node. None if not found.
+        """
+        return self._ids.get(self.hash_node(n))
+
+    def rm_node(self, i, recursive=False):
+        """Remove a node based on ID. IDs of other nodes are kept.
+
+        Args:
+            i: ID of a node.
+            recursive: remove all children nodes recursively.
+        """
+        if i >= len(self._node_list) or self._node_list[i] is None:
+            return
+        self._ids.pop(self.hash_node(self._node_list[i]), None)
+        self._update_secondary_indexes(i, self._node_list[i], None)
+        self._node_list[i] = None
+        self.__build()
+
+    def add_node(self, n):
+        """Add a node to graph.
+        This rebuilds the whole graph. Use add_nodes() instead for many nodes.
+        """
+        self.add_nodes([n])
+
+    def add_nodes(self, nodes):
+        """Add multiple nodes to graph at once and rebuild CSR arrays.
+        Node with an existing hash in graph replaces the old one keeping its ID.
+        Raises ValueError if two different nodes in "nodes" have the same hash
+        or if any cyclic link is found after adding nodes.
+        """
+        new_hashes = set()
+        for n in nodes:
+            h = self.hash_node(n)
+            i = self._ids.get(h)
+            if i is None:
+                i = len(self._node_list)
+                self._ids[h] = i
+                self._node_list.append(n)
+                self._update_secondary_indexes(i, None, n)
+            else:
+                if h in new_hashes and self._node_list[i] != n:
+                    raise ValueError(
+                        'Detected duplicate hash for different nodes in DAG. '
+                        'hash={h}, node1={n1}, node2={n2}'.format(
+                            h=h, n1=self._node_list[i], n2=n
+                        )
+                    )
+                self._update_secondary_indexes(i, self._node_list[i], n)
+                self._node_list[i] = n
+            new_hashes.add(h)
+
+        self.__build()
+
+    def __build(self):
+        """Build CSR arrays for parents/children by joining keys.
+        """
+        num_nodes = len(self._node_list)
+
+        # temporary index: key -> IDs of nodes providing it
+        providers = {}
+        for i, n in enumerate(self._node_list):
+            if n is None:
+                continue
+            for key in self._fnc_keys_as_parent(n):
+                providers.setdefault(key, []).append(i)
+
+        parent_ptr = array('q', [0])
+        parent_idx = array('i')
+        for i, n in enumerate(self._node_list):
+            if n is not None:
+                parents = set()
+                for key in self._fnc_keys_as_child(n):
+                    parents.update(providers.get(key, ()))
+                parents.discard(i)
+                parent_idx.extend(sorted(parents))
+            parent_ptr.append(len(parent_idx))
+        del providers
+
+        # transpose parents into children
+        child_ptr = array('q', [0]) * (num_nodes + 1)
+        for i in parent_idx:
+            child_ptr[i + 1] += 1
+        for i in range(num_nodes):
+            child_ptr[i + 1] += child_ptr[i]
+        child_idx = array('i', [0]) * len(parent_idx)
+        pos = array('q', child_ptr[:-1])
+        for i in range(num_nodes):
+            for j in parent_idx[parent_ptr[i] : parent_ptr[i + 1]]:
+                child_idx[pos[j]] = i
+                pos[j] += 1
+
+        self._parent_ptr = parent_ptr
+        self._parent_idx = parent_idx
+        self._child_ptr = child_ptr
+        self._child_idx = child_idx
+
+        self.__check_acyclic()
+
+    def __check_acyclic(self):
+        """Kahn's algorithm on CSR arrays.
+        """
+        num_nodes = len(self._node_list)
+        num_parents = array(
+            'i',
+            (self._parent_ptr[i + 1] - self._parent_ptr[i] for i in range(num_nodes)),
+        )
+        stack = [
+            i
+            for i in range(num_nodes)
+            if num_parents[i] == 0 and self._node_list[i] is not None
+        ]
+        num_visited = 0
+        while stack:
+            i = stack.pop()
+            num_visited += 1
+            for j in self.get_children(i):
+                num_parents[j] -= 1
+                if num_parents[j] == 0:
+                    stack.append(j)
+        if num_visited != len(self._ids):
+            raise ValueError('Detected a cyclic link in DAG.')
@@ -1,13 +1,23 @@
 import json
+import logging
+import sys
 import tempfile
+import time
 from collections import OrderedDict, namedtuple
+from functools import lru_cache
 from pathlib import Path
 
 from autouri import AutoURI
 
+from .compact_dag import CompactDAG
+from .croo_profiler import CrooProfiler
 from .croo_wdl_parser import CrooWDLParser
 from .dag import DAG
 
+logger = logging.getLogger(__name__)
+
+CALL_STATUS_DONE = 'Done'
+
 CMNode = namedtuple(
     'CMNode',
     (
@@ -21,6 +31,9 @@ CMNode = namedtuple(
     ),
 )
 
+VALID_URI_PREFIXES = ('/', 'gs://', 's3://', 'http://', 'https://')
+AMBIGUOUS_URI_SUFFIXES = ('.json', '.csv', '.tsv')
+
 
 def is_parent_cmnode(n1, n2):
     """Check if n1 is a parent node of n2.
@@ -42,9 +55,74 @@ def is_parent_cmnode(n1, n2):
     return False
 
 
+def cmnode_keys_as_parent(n):
+    """Keys that n provides to its children.
+    Consistent with is_parent_cmnode() so that DAG can link nodes through index.
+    1) task: (task_name, shard_idx) of itself, which its outputs look for.
+    2) output: its own path, which tasks taking it as an input look for.
+    """
+    if n.type == 'task':
+        return (('task', n.task_name, n.shard_idx),)
+    elif n.type == 'output':
+        return (('path', n.output_path),)
+    raise ValueError('Unsupported CMNode type: {}.'.format(n.type))
+
+
+def cmnode_keys_as_child(n):
+    """Keys that n looks for in its parents.
+    1) task: paths of all input files.
+    2) output: (task_name, shard_idx) of a task that made it.
+    """
+    if n.type == 'task':
+        if n.all_inputs is None:
+            return tuple()
+        return tuple(('path', path) for _, path, _ in n.all_inputs)
+    elif n.type == 'output':
+        return (('task', n.task_name, n.shard_idx),)
+    raise ValueError('Unsupported CMNode type: {}.'.format(n.type))
+
+
+def cmnode_key_type_task_name(n):
+    """Key for a secondary index to find nodes by (type, task_name).
+    """
+    return n.type, n.task_name
+
+
+def cmnode_key_input_name(n):
+    """Key for a secondary index to find pipeline's input nodes
+    (an output node without an associated task) by their input name.
+    """
+    if n.type == 'output' and n.task_name is None:
+        return n.output_name
+    return None
+
+
+@lru_cache(maxsize=65536)
+def is_valid_uri(s):
+    """Fast check if a string is a valid AbsPath/URL/URI.
+    Most strings in metadata JSON can be classified by their prefix only.
+    e.g. /somewhere/here/there.txt, gs://, s3://, http(s)://
+    AutoURI is used only for an ambiguous string:
+        - starting with "~": AbsPath expands user's home.
+        - ending with AMBIGUOUS_URI_SUFFIXES: AbsPath converts such relative path
+          into an absolute one if it exists on CWD.
+        - with an unknown scheme ("://").
+    Results are cached since the same string (e.g. sample name, flag)
+    can appear many times in metadata JSON.
+    """
+    if not s:
+        return False
+    if s.startswith(VALID_URI_PREFIXES):
+        return True
+    if s.startswith('~') or s.endswith(AMBIGUOUS_URI_SUFFIXES) or '://' in s:
+        return AutoURI(s).is_valid
+    return False
+
+
 def find_valid_uris_in_dict(d, parent=tuple(), list_idx=tuple()):
-    """Can recursively parse WDL struct to find valid AbsPath/URL/URIs.
+    """Can parse WDL struct to find valid AbsPath/URL/URIs.
     For example, /somewhere/here/there.txt, s3://bucket1/t.txt, http://...
+    Nested struct is traversed with a stack instead of recursion.
 
     Returns a list of tuples (
         dot_delimited_all_parents_string,
@@ -53,40 +131,433 @@ def find_valid_uris_in_dict(d, parent=tuple(), list_idx=tuple()):
     ).
     """
     files = []
-    if isinstance(d, dict):
-        for k, v in d.items():
-            files.extend(
-                find_valid_uris_in_dict(v, parent=parent + (k,), list_idx=list_idx)
+    stack = [(d, parent, list_idx)]
+    while stack:
+        d, parent, list_idx = stack.pop()
+        if isinstance(d, dict):
+            # reversed to keep the same order as in a recursive traversal
+            for k, v in reversed(list(d.items())):
+                stack.append((v, parent + (k,), list_idx))
+
+        elif isinstance(d, (list, tuple)):
+            for i in reversed(range(len(d))):
+                stack.append((d[i], parent, list_idx + (i,)))
+
+        elif isinstance(d, str) and is_valid_uri(d):
+            # intern strings since the same path/name appears in many nodes
+            files.append(
+                (
+                    sys.intern('.'.join(parent)),
+                    sys.intern(d),
+                    list_idx if list_idx else (-1,),
+                )
+            )
+    return files
+
+
+def get_subworkflow_or_task_alias(call_name):
+    """Get an alias of subworkflow/task from a call name in `calls`.
+    See CromwellMetadata.__parse_calls() for details about call name formats.
+    Returns None for Cromwell's temporary subworkflow for a nested `scatter`.
+    """
+    split_call_name = call_name.split('.')
+
+    if len(split_call_name) == 2:
+        return split_call_name[1]
+
+    elif len(split_call_name) == 1:
+        if not call_name.startswith('ScatterAt'):
+            raise ValueError(
+                'Wrong temporary call name format for a nested subworkflow.'
             )
+        return None
+
+    raise ValueError('Wrong call name format. Too many dots.')
 
-    elif isinstance(d, (list, tuple)):
-        for i, v in enumerate(d):
-            files.extend(
-                find_valid_uris_in_dict(v, parent=parent, list_idx=list_idx + (i,))
+
+def is_call_done(execution_status):
+    """Check if a call is done with its `executionStatus` in metadata JSON.
+    A call without executionStatus is considered done.
+    """
+    return execution_status is None or execution_status == CALL_STATUS_DONE
+
+
+def make_cmnodes_for_call(full_call_name, shard_idx, in_files, out_files):
+    """Make nodes for a task call and its output files.
+
+    Args:
+        in_files, out_files:
+            Lists of tuples found by find_valid_uris_in_dict().
+    Returns:
+        List of CMNode for a task itself and its outputs.
+    """
+    # task itself
+    nodes = [
+        CMNode(
+            type='task',
+            shard_idx=shard_idx,
+            task_name=full_call_name,
+            output_name=None,
+            output_path=None,
+            all_outputs=tuple(out_files) if out_files else None,
+            all_inputs=tuple(in_files) if in_files else None,
+        )
+    ]
+    if out_files:
+        for output_name, output_path, _ in out_files:
+            # each output file
+            nodes.append(
+                CMNode(
+                    type='output',
+                    shard_idx=shard_idx,
+                    task_name=full_call_name,
+                    output_name=output_name,
+                    output_path=output_path,
+                    all_outputs=None,
+                    all_inputs=None,
+                )
             )
+    return nodes
 
-    elif isinstance(d, str) and AutoURI(d).is_valid:
-        files.append(('.'.join(parent), d, list_idx if list_idx else (-1,)))
-    return files
+
+def build_obj_from_json_events(events, event, value):
+    """Build a Python object from ijson's basic_parse events.
+    Builds a whole subtree of JSON starting from the current event.
+
+    Args:
+        events:
+            Iterator of (event, value) from ijson.basic_parse().
+        event, value:
+            Current event and its value.
+    """
+    if event == 'start_map':
+        obj = {}
+        for event, key in events:
+            if event == 'end_map':
+                return obj
+            event, value = next(events)
+            obj[key] = build_obj_from_json_events(events, event, value)
+    elif event == 'start_array':
+        obj = []
+        for event, value in events:
+            if event == 'end_array':
+                return obj
+            obj.append(build_obj_from_json_events(events, event, value))
+    return value
+
+
+def skip_json_events(events, event):
+    """Skip all events of a whole subtree of JSON starting from the current event.
+    """
+    if event not in ('start_map', 'start_array'):
+        return
+    depth = 1
+    for event, _ in events:
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                return
 
 
 class CromwellMetadata:
     """Construct a task DAG based Cromwell's metadata.json file
     """
 
-    def __init__(self, metadata_json, debug=False):
+    INDEX_TYPE_TASK_NAME = 'type_task_name'
+    WORKFLOW_STATUSES_DONE = ('Succeeded', 'Failed', 'Aborted')
+    INDEX_INPUT_NAME = 'input_name'
+
+    def __init__(
+        self,
+        metadata_json,
+        debug=False,
+        compact_dag=False,
+        done_calls_only=False,
+    ):
+        """
+        Args:
+            metadata_json:
+                dict of Cromwell's metadata JSON.
+            compact_dag:
+                Use CompactDAG instead of DAG for a task graph.
+                It takes much less memory for a huge workflow.
+            done_calls_only:
+                Take calls which are done only.
+                Useful for metadata JSON of a running workflow.
+                See update() to add calls done later.
+                Ignored once workflow is done (e.g. failed or aborted)
+                so that all calls are taken as in a normal run.
+        """
         self._metadata_json = metadata_json
 
-        # input JSON
-        if 'submittedFiles' in self._metadata_json:
+        # input JSON and out_def JSON file defined in WDL
+        self.__parse_submitted_files(self._metadata_json.get('submittedFiles'))
+
+        # workflow ID
+        self._workflow_id = self._metadata_json['id']
+        self._workflow_status = self._metadata_json.get('status')
+        self._done_calls_only = done_calls_only and not self.is_workflow_done()
+
+        # parse calls to get tasks and their outputs
+        nodes = self.__parse_calls(
+            self._metadata_json['calls'],
+            parent_workflows=(self._metadata_json['workflowName'],),
+            done_calls_only=self._done_calls_only,
+        )
+
+        # parse input JSON to get inputs
+        nodes.extend(self.__parse_input_json())
+
+        self.__init_task_graph(nodes, debug=debug, compact_dag=compact_dag)
+
+    @classmethod
+    def from_stream(cls, fp, debug=False, compact_dag=False, done_calls_only=False):
+        """Construct from a metadata JSON file object without loading
+        the whole JSON document on memory.
+        JSON is parsed as a stream of events and only small parts of it
+        (e.g. inputs/outputs of each call) are built as Python objects.
+        Requires ijson (pip install ijson).
+
+        Args:
+            fp:
+                File object of metadata JSON opened in binary mode.
+                If it has a list of metadata JSON objects then only
+                the first one is taken.
+            done_calls_only:
+                Take calls which are done only. See __init__().
+        """
+        workflow_id, status, submitted_files, nodes = CromwellMetadata.__stream_nodes(
+            fp, done_calls_only
+        )
+
+        cm = cls.__new__(cls)
+        cm._metadata_json = None
+        cm._workflow_status = status
+        cm._done_calls_only = done_calls_only and not cm.is_workflow_done()
+        if done_calls_only and not cm._done_calls_only:
+            # status is found after calls. parse again to take all calls
+            fp.seek(0)
+            _, _, _, nodes = CromwellMetadata.__stream_nodes(fp)
+        cm.__parse_submitted_files(submitted_files)
+        cm._workflow_id = workflow_id
+        nodes.extend(cm.__parse_input_json())
+
+        cm.__init_task_graph(nodes, debug=debug, compact_dag=compact_dag)
+        return cm
+
+    @staticmethod
+    def __stream_nodes(fp, done_calls_only=False):
+        """Parse metadata JSON as a stream. See from_stream().
+
+        Returns:
+            Tuple of (workflow_id, status, submitted_files, nodes):
+                nodes:
+                    List of CMNode for tasks and their outputs.
+        """
+        try:
+            import ijson
+        except ImportError:
+            raise ImportError(
+                'ijson is required for streaming metadata JSON parser. '
+                'Install it with "pip install ijson".'
+            )
+
+        events = iter(ijson.basic_parse(fp, use_float=True))
+        event, _ = next(events, (None, None))
+        is_list = event == 'start_array'
+        if is_list:
+            event, _ = next(events, (None, None))
+            if event == 'end_array':
+                raise Exception('metadata JSON file is empty')
+        if event != 'start_map':
+            raise ValueError('metadata JSON is not a JSON object.')
+
+        workflow_name = None
+        workflow_id = None
+        status = None
+        submitted_files = None
+        calls = []
+        for event, key in events:
+            if event == 'end_map':
+                break
+            event, value = next(events)
+            if key == 'calls':
+                CromwellMetadata.__stream_calls(
+                    events,
+                    parent_workflows=tuple(),
+                    parent_shard_idx_cells=tuple(),
+                    calls=calls,
+                    done_calls_only=done_calls_only,
+                )
+            elif key == 'workflowName':
+                workflow_name = value
+            elif key == 'id':
+                workflow_id = value
+            elif key == 'status':
+                status = value
+            elif key == 'submittedFiles':
+                submitted_files = build_obj_from_json_events(events, event, value)
+            else:
+                skip_json_events(events, event)
+
+        if is_list:
+            num_objects = 1
+            for event, _ in events:
+                if event == 'end_array':
+                    break
+                skip_json_events(events, event)
+                num_objects += 1
+            if num_objects > 1:
+                logger.warning(
+                    'Multiple metadata JSON objects '
+                    'found in metadata JSON file. Taking the first '
+                    'one...'
+                )
+
+        nodes = []
+        for (
+            parent_workflows,
+            parent_shard_idx_cells,
+            shard_idx,
+            in_files,
+            out_files,
+        ) in calls:
+            none_free_parent_workflows = (
+                workflow
+                for workflow in (workflow_name,) + parent_workflows
+                if workflow is not None
+            )
+            full_call_name = sys.intern('.'.join(none_free_parent_workflows))
+            shard_idx = tuple(cell[0] for cell in parent_shard_idx_cells) + (shard_idx,)
+            nodes.extend(
+                make_cmnodes_for_call(full_call_name, shard_idx, in_files, out_files)
+            )
+        return workflow_id, status, submitted_files, nodes
+
+    @classmethod
+    def from_nodes(
+        cls, nodes, workflow_id, out_def_json_file, debug=False, compact_dag=False
+    ):
+        """Construct from nodes of an already parsed metadata JSON.
+        e.g. nodes loaded from CromwellMetadataCache.
+
+        Args:
+            nodes:
+                List of CMNode. See get_nodes().
+        """
+        cm = cls.__new__(cls)
+        cm._metadata_json = None
+        cm._input_json = None
+        cm._out_def_json_file = out_def_json_file
+        cm._workflow_id = workflow_id
+        cm._workflow_status = None
+        cm._done_calls_only = False
+        cm.__init_task_graph(nodes, debug=debug, compact_dag=compact_dag)
+        return cm
+
+    @staticmethod
+    def __stream_calls(
+        events, parent_workflows, parent_shard_idx_cells, calls, done_calls_only=False
+    ):
+        """Recursively parse events of `calls` in metadata JSON.
+        This is a streaming version of __parse_calls().
+        A subworkflow call's `shardIndex` can come after its `subWorkflowMetadata`
+        so each subworkflow call has a cell (single-element list) for its shard index,
+        which is filled at the end of the call.
+
+        Args:
+            events:
+                Iterator of ijson's basic_parse events.
+                The first event should be `start_map` of `calls`.
+            parent_workflows:
+                A tuple of parent workflow's alias. Main workflow's name is not included.
+            parent_shard_idx_cells:
+                A tuple of cells for shard indices of all parent workflows.
+            calls:
+                Each task call is appended to this list as a tuple of
+                (parent_workflows, parent_shard_idx_cells, shard_idx, in_files, out_files).
+            done_calls_only:
+                Skip task calls which are not done yet.
+        """
+        for event, call_name in events:
+            if event == 'end_map':
+                return
+            alias = get_subworkflow_or_task_alias(call_name)
+            # start_array of a call list
+            next(events)
+
+            for event, _ in events:
+                if event == 'end_array':
+                    break
+                # start_map of a call
+                shard_idx_cell = [None]
+                is_subworkflow = False
+                execution_status = None
+                in_files = None
+                out_files = None
+
+                for event, key in events:
+                    if event == 'end_map':
+                        break
+                    event, value = next(events)
+                    if key == 'shardIndex':
+                        shard_idx_cell[0] = value
+                    elif key == 'executionStatus':
+                        execution_status = value
+                    elif key == 'inputs':
+                        in_files = find_valid_uris_in_dict(
+                            build_obj_from_json_events(events, event, value)
+                        )
+                    elif key == 'outputs':
+                        out_files = find_valid_uris_in_dict(
+                            build_obj_from_json_events(events, event, value)
+                        )
+                    elif key == 'subWorkflowMetadata':
+                        is_subworkflow = True
+                        for event, key_sub in events:
+                            if event == 'end_map':
+                                break
+                            event, value = next(events)
+                            if key_sub == 'calls':
+                                CromwellMetadata.__stream_calls(
+                                    events,
+                                    parent_workflows=parent_workflows + (alias,),
+                                    parent_shard_idx_cells=parent_shard_idx_cells
+                                    + (shard_idx_cell,),
+                                    calls=calls,
+                                    done_calls_only=done_calls_only,
+                                )
+                            else:
+                                skip_json_events(events, event)
+                    else:
+                        skip_json_events(events, event)
+
+                if not is_subworkflow and (
+                    not done_calls_only or is_call_done(execution_status)
+                ):
+                    calls.append(
+                        (
+                            parent_workflows + (alias,),
+                            parent_shard_idx_cells,
+                            shard_idx_cell[0],
+                            in_files,
+                            out_files,
+                        )
+                    )
+
+    def __parse_submitted_files(self, submitted_files):
+        """Parse input JSON and WDL in `submittedFiles` of metadata JSON.
+        """
+        if submitted_files is not None:
             self._input_json = json.loads(
-                self._metadata_json['submittedFiles']['inputs'],
-                object_pairs_hook=OrderedDict,
+                submitted_files['inputs'], object_pairs_hook=OrderedDict
             )
             # parse WDL to find croo JSON file path/URL
             with tempfile.TemporaryDirectory() as tmpdir:
                 temp_wdl = Path(tmpdir) / 'temp.wdl'
-                temp_wdl.write_text(self._metadata_json['submittedFiles']['workflow'])
+                temp_wdl.write_text(submitted_files['workflow'])
                 self._out_def_json_file = CrooWDLParser(str(temp_wdl)).croo_out_def
         else:
             # Would work also with sub-workflow metadata that does not
@@ -94,20 +565,25 @@ class CromwellMetadata:
             self._input_json = None
             self._out_def_json_file = None
 
-        # workflow ID
-        self._workflow_id = self._metadata_json['id']
-
-        # construct an indexed DAG
-        self._dag = DAG(fnc_is_parent=is_parent_cmnode)
-
-        # parse calls to add tasks and their outputs to graph
-        self.__parse_calls(
-            self._metadata_json['calls'],
-            parent_workflows=(self._metadata_json['workflowName'],),
-        )
-
-        # parse input JSON to add inputs to graph
-        self.__parse_input_json()
+    def __init_task_graph(self, nodes, debug=False, compact_dag=False):
+        """Construct an indexed DAG with all nodes at once.
+        """
+        start = time.perf_counter()
+        with CrooProfiler.span('build_task_graph'):
+            dag_cls = CompactDAG if compact_dag else DAG
+            self._dag = dag_cls.from_nodes(
+                nodes,
+                fnc_is_parent=is_parent_cmnode,
+                fnc_keys_as_parent=cmnode_keys_as_parent,
+                fnc_keys_as_child=cmnode_keys_as_child,
+            )
+            self._dag.add_secondary_index(
+                CromwellMetadata.INDEX_TYPE_TASK_NAME, cmnode_key_type_task_name
+            )
+            self._dag.add_secondary_index(
+                CromwellMetadata.INDEX_INPUT_NAME, cmnode_key_input_name
+            )
+        self._task_graph_build_time = time.perf_counter() - start
 
         self._debug = debug
         if self._debug:
@@ -116,17 +592,132 @@ class CromwellMetadata:
     def get_workflow_id(self):
         return self._workflow_id
 
+    def get_workflow_status(self):
+        """Workflow's status (e.g. Running, Succeeded) in metadata JSON.
+        None if not found.
+        """
+        return self._workflow_status
+
+    def is_workflow_done(self):
+        """Check if workflow is done (succeeded, failed or aborted).
+        A workflow without status is considered done.
+        """
+        return (
+            self._workflow_status is None
+            or self._workflow_status in CromwellMetadata.WORKFLOW_STATUSES_DONE
+        )
+
+    def update(self, metadata_json):
+        """Update with a newer snapshot of the same workflow's metadata JSON.
+        e.g. metadata JSON file rewritten while a workflow is running.
+        Only new nodes (e.g. outputs of newly done calls) are
+        added to the task graph.
+
+        Args:
+            metadata_json:
+                dict of Cromwell's metadata JSON.
+        Returns:
+            List of new CMNode.
+        """
+        if metadata_json['id'] != self._workflow_id:
+            raise ValueError(
+                'Workflow ID does not match. {id1} vs {id2}'.format(
+                    id1=self._workflow_id, id2=metadata_json['id']
+                )
+            )
+        self._workflow_status = metadata_json.get('status')
+        # take all calls in the final snapshot as in a normal run
+        self._done_calls_only = self._done_calls_only and not self.is_workflow_done()
+        nodes = self.__parse_calls(
+            metadata_json['calls'],
+            parent_workflows=(metadata_json['workflowName'],),
+            done_calls_only=self._done_calls_only,
+        )
+        return self.__add_new_nodes(nodes)
+
+    def update_from_stream(self, fp):
+        """Streaming version of update().
+
+        Args:
+            fp:
+                File object of metadata JSON opened in binary mode.
+        Returns:
+            List of new CMNode.
+        """
+        workflow_id, status, _, nodes = CromwellMetadata.__stream_nodes(
+            fp, self._done_calls_only
+        )
+        if workflow_id != self._workflow_id:
+            raise ValueError(
+                'Workflow ID does not match. {id1} vs {id2}'.format(
+                    id1=self._workflow_id, id2=workflow_id
+                )
+            )
+        self._workflow_status = status
+        if self._done_calls_only and self.is_workflow_done():
+            # take all calls in the final snapshot as in a normal run
+            self._done_calls_only = False
+            fp.seek(0)
+            _, _, _, nodes = CromwellMetadata.__stream_nodes(fp)
+        return self.__add_new_nodes(nodes)
+
+    def __add_new_nodes(self, nodes):
+        existing_nodes = set(self.get_nodes())
+        new_nodes = []
+        for n in nodes:
+            if n not in existing_nodes:
+                existing_nodes.add(n)
+                new_nodes.append(n)
+        if new_nodes:
+            with CrooProfiler.span('build_task_graph'):
+                self._dag.add_nodes(new_nodes)
+        return new_nodes
+
     def get_task_graph(self):
         return self._dag
 
+    def get_task_graph_build_time(self):
+        """Time (in seconds) taken to build the task graph.
+        """
+        return self._task_graph_build_time
+
+    def get_nodes(self):
+        """Get a list of all nodes (CMNode) in the task graph.
+        """
+        return [n for _, n in self._dag.get_nodes()]
+
     def get_out_def_json_file(self):
         return self._out_def_json_file
 
+    def find_task_nodes(self, task_name):
+        """Find task nodes by a full task name (e.g. atac.align).
+
+        Returns:
+            [(h, n)] where h is a hash of a matched node n
+        """
+        return self._dag.find_nodes_by_secondary_index(
+            CromwellMetadata.INDEX_TYPE_TASK_NAME, ('task', task_name)
+        )
+
+    def find_input_nodes(self, input_name):
+        """Find pipeline's input file nodes by an input name (e.g. atac.fastqs).
+
+        Returns:
+            [(h, n)] where h is a hash of a matched node n
+        """
+        return self._dag.find_nodes_by_secondary_index(
+            CromwellMetadata.INDEX_INPUT_NAME, input_name
+        )
+
     def __parse_input_json(self):
-        """Recursively parse input JSON to add input files to graph
+        """Recursively parse input JSON to find input files.
+
+        Returns:
+            List of CMNode for input files.
         """
+        nodes = []
         if self._input_json is None:
-            return
+            return nodes
 
         for file_name, file_path, shard_idx in find_valid_uris_in_dict(
             self._input_json
@@ -141,10 +732,15 @@ class CromwellMetadata:
                 all_outputs=None,
                 all_inputs=None,
             )
-            self._dag.add_node(n)
+            nodes.append(n)
+        return nodes
 
     def __parse_calls(
-        self, calls, parent_workflows, parent_workflow_shard_indices=tuple()
+        self,
+        calls,
+        parent_workflows,
+        parent_workflow_shard_indices=tuple(),
+        done_calls_only=False,
     ):
         """Recursively parse `calls` in Cromwell's metadata JSON for subworkflow.
         `calls` is a dict of { key: list_of_calls } with the following two key naming formats.
@@ -172,6 +768,12 @@ class CromwellMetadata:
                 Grander parent's index comes first.
                 The dimensions of `parent_workflows` and `parent_workflow_shard_indices` do not
                 necessarily match if there is a nested `scatter`.
+            done_calls_only:
+                Skip task calls which are not done yet (executionStatus is not Done).
+                e.g. calls still running in a metadata JSON of a running workflow.
+
+        Returns:
+            List of CMNode for tasks and their outputs.
         """
         if not parent_workflows or not isinstance(parent_workflows, tuple):
             raise ValueError(
@@ -180,43 +782,37 @@ class CromwellMetadata:
                 'then call with parent_workflows=(main_workflow_name,).'
             )
 
+        nodes = []
         for call_name, call_list in calls.items():
-            split_call_name = call_name.split('.')
-
-            if len(split_call_name) == 2:
-                subworkflow_or_task_alias = split_call_name[1]
-
-            elif len(split_call_name) == 1:
-                if not call_name.startswith('ScatterAt'):
-                    raise ValueError(
-                        'Wrong temporary call name format for a nested subworkflow.'
-                    )
-                subworkflow_or_task_alias = None
-
-            else:
-                raise ValueError('Wrong call name format. Too many dots.')
+            subworkflow_or_task_alias = get_subworkflow_or_task_alias(call_name)
 
             for c in call_list:
                 shard_idx = c['shardIndex']
 
                 # if it is a subworkflow, then recursively dive into it
                 if 'subWorkflowMetadata' in c:
-                    self.__parse_calls(
-                        c['subWorkflowMetadata']['calls'],
-                        parent_workflows=parent_workflows
-                        + (subworkflow_or_task_alias,),
-                        parent_workflow_shard_indices=parent_workflow_shard_indices
-                        + (shard_idx,),
+                    nodes.extend(
+                        self.__parse_calls(
+                            c['subWorkflowMetadata']['calls'],
+                            parent_workflows=parent_workflows
+                            + (subworkflow_or_task_alias,),
+                            parent_workflow_shard_indices=parent_workflow_shard_indices
+                            + (shard_idx,),
+                            done_calls_only=done_calls_only,
+                        )
                     )
                     continue
 
+                if done_calls_only and not is_call_done(c.get('executionStatus')):
+                    continue
+
                 none_free_parent_workflows = (
                     workflow
                     for workflow in parent_workflows + (subworkflow_or_task_alias,)
                     if workflow is not None
                 )
 
-                full_call_name = '.'.join(none_free_parent_workflows)
+                full_call_name = sys.intern('.'.join(none_free_parent_workflows))
                 shard_idx = parent_workflow_shard_indices + (shard_idx,)
 
                 in_files = None
@@ -227,28 +823,9 @@ class CromwellMetadata:
                 if 'outputs' in c:
                     out_files = find_valid_uris_in_dict(c['outputs'])
 
-                # add task itself to DAG
-                n = CMNode(
-                    type='task',
-                    shard_idx=shard_idx,
-                    task_name=full_call_name,
-                    output_name=None,
-                    output_path=None,
-                    all_outputs=tuple(out_files) if out_files else None,
-                    all_inputs=tuple(in_files) if in_files else None,
+                nodes.extend(
+                    make_cmnodes_for_call(
+                        full_call_name, shard_idx, in_files, out_files
+                    )
                 )
-                self._dag.add_node(n)
-
-                if out_files:
-                    for output_name, output_path, _ in out_files:
-                        # add each output file to DAG
-                        n = CMNode(
-                            type='output',
-                            shard_idx=shard_idx,
-                            task_name=full_call_name,
-                            output_name=output_name,
-                            output_path=output_path,
-                            all_outputs=None,
-                            all_inputs=None,
-                        )
-                        self._dag.add_node(n)
+        return nodes
@@ -0,0 +1,137 @@
+"""CromwellMetadataCache: on-disk cache of parsed metadata JSON.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+
+from autouri import AbsPath, AutoURI
+
+from .cromwell_metadata import CMNode, CromwellMetadata
+
+logger = logging.getLogger(__name__)
+
+
+def to_tuple(obj):
+    """Convert lists in an object loaded from JSON back into tuples.
+    Strings are interned as in CromwellMetadata.
+    """
+    if isinstance(obj, list):
+        return tuple(to_tuple(o) for o in obj)
+    if isinstance(obj, str):
+        return sys.intern(obj)
+    return obj
+
+
+class CromwellMetadataCache:
+    """Cache nodes of a task graph parsed from metadata JSON on a local directory.
+    Links are not stored since they are rebuilt from nodes in linear time.
+
+    Nodes are stored as JSON arrays of CMNode's fields, not as a pickle,
+    so that loading a cache file from a shared tmp_dir cannot run code.
+
+    A local metadata JSON file is keyed by its path, size, mtime and inode.
+    A remote one is keyed by its URI, size, mtime and md5 hash.
+    md5 hash is taken from cloud storage's metadata (e.g. ETag) or `.md5` file
+    if available. Otherwise, it is calculated from file contents.
+    Remote metadata JSON without md5 hash (e.g. on an HTTP server without ETag)
+    is not cached.
+    """
+
+    CACHE_FILE = 'croo.metadata_cache.{key}.json'
+    # bump it up when format of cache file or CMNode changes
+    CACHE_FORMAT_VERSION = 2
+
+    def __init__(self, cache_dir):
+        """
+        Args:
+            cache_dir:
+                LOCAL directory to store cache files.
+        """
+        self._cache_dir = cache_dir
+
+    def get_key(self, metadata_json):
+        """Make a cache key for a metadata JSON file/URI.
+
+        Returns:
+            Key string. None if metadata JSON doesn't exist or md5 hash is not available.
+        """
+        u = AutoURI(metadata_json)
+        if isinstance(u, AbsPath):
+            # no need to read a local file to hash it
+            try:
+                st = os.stat(u.uri)
+            except FileNotFoundError:
+                return None
+            key_obj = [
+                CromwellMetadataCache.CACHE_FORMAT_VERSION,
+                u.uri,
+                st.st_size,
+                st.st_mtime_ns,
+                st.st_dev,
+                st.st_ino,
+            ]
+        else:
+            m = u.get_metadata()
+            if not m.exists or m.md5 is None:
+                return None
+            key_obj = [
+                CromwellMetadataCache.CACHE_FORMAT_VERSION,
+                u.uri,
+                m.size,
+                m.mtime,
+                m.md5,
+            ]
+        return hashlib.md5(json.dumps(key_obj).encode()).hexdigest()
+
+    def get_cache_file(self, key):
+        return os.path.join(
+            self._cache_dir, CromwellMetadataCache.CACHE_FILE.format(key=key)
+        )
+
+    def load(self, key, debug=False, compact_dag=False):
+        """Load CromwellMetadata from cache.
+
+        Returns:
+            CromwellMetadata object. None if not cached or cache file is corrupted.
+        """
+        cache_file = self.get_cache_file(key)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file) as fp:
+                cached = json.load(fp)
+            nodes = [CMNode(*to_tuple(n)) for n in cached['nodes']]
+        except Exception:
+            logger.warning(
+                'Failed to load metadata cache. Ignoring it... {f}'.format(f=cache_file)
+            )
+            return None
+
+        logger.info('Loaded parsed metadata from cache. {f}'.format(f=cache_file))
+        return CromwellMetadata.from_nodes(
+            nodes,
+            workflow_id=cached['workflow_id'],
+            out_def_json_file=cached['out_def_json_file'],
+            debug=debug,
+            compact_dag=compact_dag,
+        )
+
+    def save(self, key, cm):
+        """Save CromwellMetadata to cache.
+        Cache file is written to a temporary file first and then renamed
+        so that a partially written file is never loaded.
+        """
+        os.makedirs(self._cache_dir, exist_ok=True)
+        cache_file = self.get_cache_file(key)
+        cached = {
+            'nodes': cm.get_nodes(),
+            'workflow_id': cm.get_workflow_id(),
+            'out_def_json_file': cm.get_out_def_json_file(),
+        }
+        tmp_cache_file = '{f}.{pid}.tmp'.format(f=cache_file, pid=os.getpid())
+        with open(tmp_cache_file, 'w') as fp:
+            json.dump(cached, fp, separators=(',', ':'))
+        os.replace(tmp_cache_file, cache_file)
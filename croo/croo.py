@@ -1,15 +1,33 @@
 import json
 import logging
 import os
-import re
+import resource
+import time
+from contextlib import contextmanager
 
 from autouri import GCSURI, S3URI, AbsPath, AutoURI
 
 from .cromwell_metadata import CromwellMetadata
+from .cromwell_metadata_cache import CromwellMetadataCache
+from .croo_checksum_cache import CrooChecksumCache
 from .croo_html_report import CrooHtmlReport
+from .croo_inline_exp import CrooInlineExp
+from .croo_local_copy import LOCAL_COPY_METHOD_COPY
+from .croo_manifest import CrooManifest
+from .croo_profiler import CrooProfiler
+from .croo_stats import CrooStats
+from .croo_throttle import DEFAULT_MAX_RETRIES, DEFAULT_RETRY_DELAY, make_throttles
+from .croo_tmp_cache import CrooTmpCache
+from .croo_transfer import (
+    DEFAULT_MULTIPART_NUM_THREADS,
+    DEFAULT_MULTIPART_PART_SIZE,
+    CrooTransfer,
+)
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_WATCH_INTERVAL = 60.0
+
 
 class Croo:
     """Cromwell output organizer (croo)
@@ -18,9 +36,9 @@ class Croo:
     and organize outputs as specified in output definition JSON
     """
 
-    RE_PATTERN_INLINE_EXP = r'\$\{(.*?)\}'
     KEY_TASK_GRAPH_TEMPLATE = 'task_graph_template'
     KEY_INPUT = 'inputs'
+    WATCH_MAX_CONSECUTIVE_FAILURES = 10
 
     def __init__(
         self,
@@ -39,6 +57,26 @@ class Croo:
         gcp_private_key=None,
         map_path_to_url=None,
         no_checksum=False,
+        task_graph_transitive_reduction=False,
+        compact_task_graph=False,
+        stream_metadata=False,
+        cache_metadata=False,
+        num_threads=1,
+        use_checksum_cache=True,
+        resume=False,
+        local_copy_method=LOCAL_COPY_METHOD_COPY,
+        multipart_threshold=None,
+        multipart_part_size=DEFAULT_MULTIPART_PART_SIZE,
+        multipart_num_threads=DEFAULT_MULTIPART_NUM_THREADS,
+        max_concurrent_transfers=None,
+        max_bytes_per_sec=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+        retry_delay=DEFAULT_RETRY_DELAY,
+        write_stats=True,
+        profile=False,
+        watch=False,
+        out_dir_per_workflow=False,
+        max_tmp_cache_size=None,
     ):
         """Initialize croo with output definition JSON
         Args:
@@ -47,76 +85,241 @@ class Croo:
                 (source) on out_dir (destination).
                 Try to soft-link it if both src and dest are on local storage.
                 Otherwise, original cromwell outputs will be just referenced.
+            task_graph_transitive_reduction:
+                Remove redundant links from the task graph in HTML report.
+            compact_task_graph:
+                Use a memory-efficient task graph (CompactDAG).
+                Useful for a huge workflow with 100k+ files.
+            stream_metadata:
+                Parse metadata JSON file as a stream without loading
+                the whole JSON document on memory. Requires ijson.
+                This is ignored if metadata_json is a dict.
+            cache_metadata:
+                Cache parsed metadata JSON on tmp_dir.
+                Metadata JSON is not parsed again if it has not changed.
+                This is ignored if metadata_json is a dict.
+            num_threads:
+                Number of threads to transfer (copy/link) files.
+            use_checksum_cache:
+                Cache md5 hashes of local files on tmp_dir.
+                md5 hash is used to check if a file can be skipped for copying.
+                Cached hash is valid only if file's size and mtime have not changed.
+                This is ignored if soft_link or no_checksum.
+            resume:
+                Skip files already transferred in a previous run.
+                A manifest of transferred files is written on out_dir
+                while organizing outputs. Entries in it are skipped
+                if source has not changed and transferred file still exists.
+            local_copy_method:
+                Method to make a copy of a local file on a local out_dir.
+                copy, hardlink, reflink (copy-on-write clone) or copy_file_range.
+                It falls back to copy if the method fails
+                (e.g. src and dest are on different devices).
+                This is ignored if soft_link.
+            multipart_threshold:
+                Upload a local file larger than this (in bytes)
+                to a cloud out_dir in parts in parallel.
+                Parallel composite upload on GCS and multipart upload on S3.
+                None to use storage client's default.
+            multipart_part_size:
+                Size of each part (in bytes) for multipart upload.
+            multipart_num_threads:
+                Number of threads to upload parts of a file.
+            max_concurrent_transfers:
+                dict of { backend: max_concurrency } to limit
+                the number of concurrent transfers from/to each storage backend.
+                backend is one of local, gs, s3 and http.
+                e.g. {'local': 4} not to overload an NFS server.
+            max_bytes_per_sec:
+                dict of { backend: max_bytes_per_sec } to limit
+                average bandwidth of transfers from/to each storage backend.
+            max_retries:
+                Maximum number of retrials for a transfer failed with
+                a transient error (e.g. connection error, HTTP 429/5xx).
+            retry_delay:
+                Delay (in seconds) before the first retrial.
+                It is doubled for each retrial.
+            write_stats:
+                Write performance metrics (timings of each phase,
+                bytes transferred, throughput per storage backend and
+                slowest transfers) as croo.stats.*.json on out_dir.
+            profile:
+                Enable CrooProfiler to record spans of hot paths and
+                write them as a trace file (croo.profile.*.json) on out_dir.
+                It can be opened as a flame chart on Perfetto UI or speedscope.
+                Profiling stops when organize_output() (or plan()) returns.
+            watch:
+                Prepare to watch a running workflow with watch().
+                Only calls done so far are taken from metadata JSON.
+                cache_metadata is ignored.
+            out_dir_per_workflow:
+                Organize outputs on out_dir/WORKFLOW_ID/ instead of out_dir.
+                Useful to organize outputs of many workflows on the same out_dir.
+            max_tmp_cache_size:
+                Maximum total size (in bytes) of files cached on tmp_dir
+                (e.g. localized metadata JSON and out_def JSON files).
+                Least recently accessed files are evicted. None for no limit.
+
+        metadata_json can be a local directory with snapshots of
+        metadata JSON files. The most recently modified *.json file is taken.
         """
-        self._tmp_dir = tmp_dir
-        if isinstance(metadata_json, dict):
-            self._metadata = metadata_json
-        else:
-            f = AutoURI(metadata_json).localize_on(self._tmp_dir, no_lock=True)
-            with open(f, 'r') as fp:
-                self._metadata = json.loads(fp.read())
-            if isinstance(self._metadata, list):
-                if len(self._metadata) > 1:
-                    logger.warning(
-                        'Multiple metadata JSON objects '
-                        'found in metadata JSON file. Taking the first '
-                        'one...'
-                    )
-                elif len(self._metadata) == 0:
-                    raise Exception('metadata JSON file is empty')
-                self._metadata = self._metadata[0]
-        self._out_dir = out_dir
-        self._cm = CromwellMetadata(self._metadata)
-        self._ucsc_genome_db = ucsc_genome_db
-        self._ucsc_genome_pos = ucsc_genome_pos
-
-        self._use_presigned_url_s3 = use_presigned_url_s3
-        self._use_presigned_url_gcs = use_presigned_url_gcs
-        self._duration_presigned_url_s3 = duration_presigned_url_s3
-        self._duration_presigned_url_gcs = duration_presigned_url_gcs
-        self._public_gcs = public_gcs
-        self._gcp_private_key = gcp_private_key
-        self._map_path_to_url = map_path_to_url
-        self._no_checksum = no_checksum
-
-        if isinstance(out_def_json, dict):
-            self._out_def_json = out_def_json
-        else:
-            if out_def_json is None:
-                out_def_json_file_from_wdl = self._cm.get_out_def_json_file()
-                if out_def_json_file_from_wdl is None:
-                    raise ValueError(
-                        'out_def JSON file is not defined. '
-                        'Define --out-def-json in cmd line arg or '
-                        'add "#CROO out_def [URL_OR_CLOUD_URI]" '
-                        'to your WDL'
-                    )
-                out_def_json = out_def_json_file_from_wdl
-            f = AutoURI(out_def_json).localize_on(self._tmp_dir)
-            with open(f, 'r') as fp:
-                self._out_def_json = json.loads(fp.read())
-
-        self._task_graph = self._cm.get_task_graph()
-        if Croo.KEY_TASK_GRAPH_TEMPLATE in self._out_def_json:
-            self._task_graph_template = self._out_def_json.pop(
-                Croo.KEY_TASK_GRAPH_TEMPLATE
+        self._profile = profile
+        if profile:
+            CrooProfiler.enable()
+        try:
+            self._stats = CrooStats()
+            start = time.perf_counter()
+            self._tmp_dir = tmp_dir
+            self._tmp_cache = CrooTmpCache(
+                tmp_dir, max_size=max_tmp_cache_size, out_dir=out_dir
+            )
+            self._metadata_json = metadata_json
+            self._stream_metadata = stream_metadata
+            self._watch = watch
+            if watch:
+                cache_metadata = False
+            with CrooProfiler.span('load_metadata'):
+                self._cm = None
+                if isinstance(metadata_json, dict):
+                    with self.__parse_metadata_phase():
+                        self._cm = CromwellMetadata(
+                            metadata_json,
+                            compact_dag=compact_task_graph,
+                            done_calls_only=watch,
+                        )
+                else:
+                    metadata_json = Croo.__find_metadata_json(metadata_json)
+                    cache_key = None
+                    if cache_metadata:
+                        cache = CromwellMetadataCache(self._tmp_dir)
+                        cache_key = cache.get_key(metadata_json)
+                        if cache_key is not None:
+                            with CrooProfiler.span('load_metadata_cache'):
+                                self._cm = cache.load(
+                                    cache_key, compact_dag=compact_task_graph
+                                )
+                            if self._cm is not None:
+                                self._tmp_cache.touch(cache.get_cache_file(cache_key))
+
+                    if self._cm is None:
+                        with CrooProfiler.span('localize_metadata'):
+                            fp = self._tmp_cache.open(
+                                metadata_json,
+                                'rb' if stream_metadata else 'r',
+                                no_lock=True,
+                            )
+                        if stream_metadata:
+                            with fp, self.__parse_metadata_phase():
+                                self._cm = CromwellMetadata.from_stream(
+                                    fp,
+                                    compact_dag=compact_task_graph,
+                                    done_calls_only=watch,
+                                )
+                        else:
+                            with fp, CrooProfiler.span('read_metadata_json'):
+                                metadata = Croo.__load_metadata_json(fp)
+                            with self.__parse_metadata_phase():
+                                self._cm = CromwellMetadata(
+                                    metadata,
+                                    compact_dag=compact_task_graph,
+                                    done_calls_only=watch,
+                                )
+                        if cache_key is not None:
+                            cache.save(cache_key, self._cm)
+                            # count it in size of tmp cache
+                            self._tmp_cache.touch(cache.get_cache_file(cache_key))
+            self._stats.add_phase_time('load_metadata', time.perf_counter() - start)
+            self._stats.add_phase_time(
+                'build_task_graph', self._cm.get_task_graph_build_time()
+            )
+            logger.info(
+                'Parsed metadata JSON. peak memory usage (max RSS)={mem:.1f} MB'.format(
+                    mem=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                )
+            )
+            if out_dir_per_workflow:
+                out_dir = os.path.join(out_dir, self._cm.get_workflow_id())
+            self._out_dir = out_dir
+            self._ucsc_genome_db = ucsc_genome_db
+            self._ucsc_genome_pos = ucsc_genome_pos
+
+            self._use_presigned_url_s3 = use_presigned_url_s3
+            self._use_presigned_url_gcs = use_presigned_url_gcs
+            self._duration_presigned_url_s3 = duration_presigned_url_s3
+            self._duration_presigned_url_gcs = duration_presigned_url_gcs
+            self._public_gcs = public_gcs
+            self._gcp_private_key = gcp_private_key
+            self._map_path_to_url = map_path_to_url
+            self._no_checksum = no_checksum
+            self._task_graph_transitive_reduction = task_graph_transitive_reduction
+
+            if isinstance(out_def_json, dict):
+                self._out_def_json = out_def_json
+            else:
+                if out_def_json is None:
+                    out_def_json_file_from_wdl = self._cm.get_out_def_json_file()
+                    if out_def_json_file_from_wdl is None:
+                        raise ValueError(
+                            'out_def JSON file is not defined. '
+                            'Define --out-def-json in cmd line arg or '
+                            'add "#CROO out_def [URL_OR_CLOUD_URI]" '
+                            'to your WDL'
+                        )
+                    out_def_json = out_def_json_file_from_wdl
+                with self._tmp_cache.open(out_def_json) as fp:
+                    self._out_def_json = json.loads(fp.read())
+
+            self._task_graph = self._cm.get_task_graph()
+            if Croo.KEY_TASK_GRAPH_TEMPLATE in self._out_def_json:
+                self._task_graph_template = self._out_def_json.pop(
+                    Croo.KEY_TASK_GRAPH_TEMPLATE
+                )
+            else:
+                self._task_graph_template = None
+            if Croo.KEY_INPUT in self._out_def_json:
+                self._input_def_json = self._out_def_json.pop(Croo.KEY_INPUT)
+            else:
+                self._input_def_json = None
+            self._soft_link = soft_link
+            self._local_copy_method = local_copy_method
+            self._multipart_threshold = multipart_threshold
+            self._multipart_part_size = multipart_part_size
+            self._multipart_num_threads = multipart_num_threads
+            self._throttles = make_throttles(
+                max_concurrency=max_concurrent_transfers,
+                max_bytes_per_sec=max_bytes_per_sec,
             )
-        else:
-            self._task_graph_template = None
-        if Croo.KEY_INPUT in self._out_def_json:
-            self._input_def_json = self._out_def_json.pop(Croo.KEY_INPUT)
-        else:
-            self._input_def_json = None
-        self._soft_link = soft_link
+            self._max_retries = max_retries
+            self._retry_delay = retry_delay
+            self._num_threads = num_threads
+            self._use_checksum_cache = use_checksum_cache
+            self._resume = resume
+            self._write_stats = write_stats
+        except Exception:
+            self.__stop_profiling()
+            raise
+
+    def get_workflow_id(self):
+        return self._cm.get_workflow_id()
+
+    def get_out_dir(self):
+        return self._out_dir
 
     def organize_output(self):
         """Organize outputs
         """
+        try:
+            self.__organize_output()
+        finally:
+            self.__stop_profiling()
+
+    def __organize_output(self):
         report = CrooHtmlReport(
             out_dir=self._out_dir,
             workflow_id=self._cm.get_workflow_id(),
             dag=self._task_graph,
             task_graph_template=self._task_graph_template,
+            task_graph_transitive_reduction=self._task_graph_transitive_reduction,
             public_gcs=self._public_gcs,
             gcp_private_key=self._gcp_private_key,
             use_presigned_url_gcs=self._use_presigned_url_gcs,
@@ -130,28 +333,18 @@ class Croo:
 
         if self._input_def_json is not None:
             for input_name, input_obj in self._input_def_json.items():
-                node_format = input_obj.get('node')
-                subgraph = input_obj.get('subgraph')
-
-                for _, node in self._task_graph.get_nodes():
-                    # if node is pipeline's input
-                    if (
-                        node.type != 'output'
-                        or node.task_name is not None
-                        or node.output_name != input_name
-                    ):
-                        continue
+                node_format = Croo.__compile_inline_exp(input_obj.get('node'))
+                subgraph = Croo.__compile_inline_exp(input_obj.get('subgraph'))
+
+                for _, node in self._cm.find_input_nodes(input_name):
                     full_path = node.output_path
                     shard_idx = node.shard_idx
 
                     if node_format is not None:
-                        interpreted_node_format = Croo.__interpret_inline_exp(
-                            node_format, full_path, shard_idx
-                        )
+                        env = CrooInlineExp.make_env(full_path, shard_idx)
+                        interpreted_node_format = node_format.render(env)
                         if subgraph is not None:
-                            interpreted_subgraph = Croo.__interpret_inline_exp(
-                                subgraph, full_path, shard_idx
-                            )
+                            interpreted_subgraph = subgraph.render(env)
                         else:
                             interpreted_subgraph = None
                         report.add_to_task_graph(
@@ -163,17 +356,461 @@ class Croo:
                             interpreted_subgraph,
                         )
 
+        # collect all outputs and transfer jobs first
+        with self.__open_checksum_cache_and_manifest() as (checksum_cache, manifest):
+            transfer = self.__make_transfer(checksum_cache, manifest, self._stats)
+            with self._stats.phase('collect_outputs'), CrooProfiler.span(
+                'interpret_inline_exp'
+            ):
+                outputs = self.__collect_outputs(transfer)
+
+            with self._stats.phase('transfer'), CrooProfiler.span('transfer'):
+                transfer.run()
+
+        start = time.perf_counter()
+
+        # build report in order of outputs
+        with CrooProfiler.span('build_report'):
+            for (
+                task_name,
+                output_name,
+                shard_idx,
+                full_path,
+                env,
+                job_id,
+                path,
+                table_item,
+                ucsc_track,
+                node_format,
+                subgraph,
+            ) in outputs:
+                target_uri = full_path
+                if job_id is not None:
+                    if transfer.get_error(job_id) is not None:
+                        continue
+                    target_uri = transfer.get_target_uri(job_id)
+
+                # get presigned URLs if possible
+                target_url = None
+                if (
+                    path is not None
+                    or table_item is not None
+                    or ucsc_track is not None
+                    or node_format is not None
+                ):
+                    target_url = self.__get_url(target_uri)
+
+                if table_item is not None:
+                    interpreted_table_item = table_item.render(env)
+                    # add to file table
+                    report.add_to_file_table(
+                        target_uri, target_url, interpreted_table_item
+                    )
+                if ucsc_track is not None and target_url is not None:
+                    interpreted_ucsc_track = ucsc_track.render(env)
+                    report.add_to_ucsc_track(target_url, interpreted_ucsc_track)
+                if node_format is not None:
+                    interpreted_node_format = node_format.render(env)
+                    if subgraph is not None:
+                        interpreted_subgraph = subgraph.render(env)
+                    else:
+                        interpreted_subgraph = None
+                    report.add_to_task_graph(
+                        output_name,
+                        task_name,
+                        shard_idx,
+                        full_path if target_url is None else target_url,
+                        interpreted_node_format,
+                        interpreted_subgraph,
+                    )
+        # write to html report
+        with CrooProfiler.span('write_html_report'):
+            report.save_to_file()
+        self._stats.add_phase_time('report', time.perf_counter() - start)
+
+        self._tmp_cache.evict()
+        self._stats.set_tmp_cache_stats(self._tmp_cache.get_stats())
+        if self._write_stats:
+            self._stats.save(
+                os.path.join(
+                    self._out_dir,
+                    CrooStats.STATS_FILE.format(workflow_id=self._cm.get_workflow_id()),
+                )
+            )
+        if self._profile:
+            CrooProfiler.save(
+                os.path.join(
+                    self._out_dir,
+                    CrooProfiler.TRACE_FILE.format(
+                        workflow_id=self._cm.get_workflow_id()
+                    ),
+                )
+            )
+
+        errors = transfer.get_errors()
+        if errors:
+            raise Exception(
+                'Failed to transfer {num_failed} out of {num_jobs} files. '
+                'First error: src={src}, target={target}, error={e}'.format(
+                    num_failed=len(errors),
+                    num_jobs=transfer.num_jobs,
+                    src=errors[0][0],
+                    target=errors[0][1],
+                    e=errors[0][2],
+                )
+            )
+
+    def watch(self, interval=DEFAULT_WATCH_INTERVAL, timeout=None):
+        """Organize outputs incrementally while a workflow is running.
+        Croo should be initialized with watch=True.
+
+        Metadata JSON source (a file rewritten while a workflow is running or
+        a local directory with snapshots of metadata JSON files)
+        is polled at an interval. If it has changed, only calls newly done since
+        the previous snapshot are added to the task graph and
+        their outputs are transferred (and written to a manifest).
+        Once the workflow is done, organize_output() makes
+        the final HTML report resuming from the manifest so that
+        files already transferred are skipped.
+
+        Reading a partially written metadata JSON file (e.g. JSON decode error)
+        is tried again at next polling. It raises after
+        WATCH_MAX_CONSECUTIVE_FAILURES consecutive failures.
+        Any other error (e.g. workflow ID mismatch) is raised immediately.
+
+        Args:
+            interval:
+                Polling interval in seconds.
+            timeout:
+                Stop watching after this (in seconds) and make the final report
+                with all calls done so far. None for no timeout.
+        """
+        try:
+            self.__watch(interval, timeout)
+        finally:
+            self.__stop_profiling()
+
+    def __watch(self, interval, timeout):
+        if not self._watch:
+            raise ValueError('Croo is not initialized with watch=True.')
+        if isinstance(self._metadata_json, dict):
+            raise ValueError('Cannot watch metadata JSON given as a dict.')
+
+        start = time.time()
+        snapshot = self.__get_metadata_snapshot()
+        new_nodes = self._cm.get_nodes()
+        num_failures = 0
+        while True:
+            if new_nodes:
+                self.__organize_new_outputs(new_nodes)
+            if self._cm.is_workflow_done():
+                logger.info(
+                    'Workflow is done. status={status}'.format(
+                        status=self._cm.get_workflow_status()
+                    )
+                )
+                break
+            if timeout is not None and time.time() - start > timeout:
+                logger.warning(
+                    'Stopped watching a running workflow after timeout. '
+                    'status={status}'.format(status=self._cm.get_workflow_status())
+                )
+                break
+
+            time.sleep(interval)
+            new_nodes = []
+            new_snapshot = self.__get_metadata_snapshot()
+            if new_snapshot == snapshot:
+                continue
+            try:
+                new_nodes = self.__update_metadata(new_snapshot[0])
+            except Exception as e:
+                # e.g. metadata JSON file is partially written. try again later
+                num_failures += 1
+                if (
+                    not Croo.__is_partial_read_error(e)
+                    or num_failures >= Croo.WATCH_MAX_CONSECUTIVE_FAILURES
+                ):
+                    raise
+                logger.warning(
+                    'Failed to read updated metadata JSON. '
+                    'num_failures={n}. {e}'.format(n=num_failures, e=e)
+                )
+                continue
+            num_failures = 0
+            snapshot = new_snapshot
+            logger.info(
+                'Metadata JSON updated. num_new_nodes={n}, status={status}'.format(
+                    n=len(new_nodes), status=self._cm.get_workflow_status()
+                )
+            )
+
+        self._resume = True
+        self.organize_output()
+
+    @contextmanager
+    def __parse_metadata_phase(self):
+        """Profile parsing metadata JSON and record how much it increased
+        resident memory in stats.
+        """
+        with CrooProfiler.span('parse_metadata'), self._stats.memory('parse_metadata'):
+            yield
+
+    def __stop_profiling(self):
+        """Disable CrooProfiler enabled for this Croo.
+        """
+        if self._profile:
+            self._profile = False
+            CrooProfiler.disable()
+
+    def __get_metadata_snapshot(self):
+        """Returns:
+        Tuple of (metadata_json_uri, mtime, size) of current metadata JSON source.
+        """
+        uri = Croo.__find_metadata_json(self._metadata_json)
+        m = AutoURI(uri).get_metadata(skip_md5=True)
+        return uri, m.mtime, m.size
+
+    @staticmethod
+    def __is_partial_read_error(e):
+        """Check if an error can be from reading metadata JSON file
+        while it is being rewritten.
+        """
+        if isinstance(e, (json.JSONDecodeError, OSError)):
+            return True
+        try:
+            import ijson
+        except ImportError:
+            return False
+        return isinstance(e, ijson.JSONError)
+
+    def __update_metadata(self, uri):
+        """Update task graph with new calls in metadata JSON.
+
+        Returns:
+            List of new nodes.
+        """
+        with CrooProfiler.span('load_metadata'):
+            with CrooProfiler.span('localize_metadata'):
+                fp = self._tmp_cache.open(
+                    uri, 'rb' if self._stream_metadata else 'r', no_lock=True
+                )
+            if self._stream_metadata:
+                with fp, self.__parse_metadata_phase():
+                    return self._cm.update_from_stream(fp)
+            with fp, CrooProfiler.span('read_metadata_json'):
+                metadata = Croo.__load_metadata_json(fp)
+            with self.__parse_metadata_phase():
+                return self._cm.update(metadata)
+
+    def __organize_new_outputs(self, nodes):
+        """Transfer outputs of new nodes only. HTML report is not written.
+        Succeeded transfers are written to a manifest and
+        failed ones are tried again in the final organize_output().
+        """
+        with self.__open_checksum_cache_and_manifest() as (checksum_cache, manifest):
+            transfer = self.__make_transfer(checksum_cache, manifest, self._stats)
+            with self._stats.phase('collect_outputs'), CrooProfiler.span(
+                'interpret_inline_exp'
+            ):
+                self.__collect_outputs(
+                    transfer, task_nodes={n for n in nodes if n.type == 'task'}
+                )
+            with self._stats.phase('transfer'), CrooProfiler.span('transfer'):
+                num_failed = transfer.run()
+        # append to manifest from now on
+        self._resume = True
+
+        logger.info(
+            'Transferred outputs of newly done calls. '
+            'num_jobs={num_jobs}, num_failed={num_failed}'.format(
+                num_jobs=transfer.num_jobs, num_failed=num_failed
+            )
+        )
+
+    def __get_manifest_uris(self):
+        """Returns:
+        Tuple of (manifest_uri_on_out_dir, local_manifest_file)
+        """
+        manifest_file = CrooManifest.MANIFEST_FILE.format(
+            workflow_id=self._cm.get_workflow_id()
+        )
+        manifest_uri = os.path.join(self._out_dir, manifest_file)
+        if isinstance(AutoURI(manifest_uri), AbsPath):
+            return manifest_uri, manifest_uri
+        return manifest_uri, os.path.join(self._tmp_dir, manifest_file)
+
+    def __open_manifest(self, read_only=False):
+        """Open a manifest. A manifest on a remote out_dir is
+        written on tmp_dir first and uploaded periodically and on close.
+        """
+        manifest_uri, local_manifest_file = self.__get_manifest_uris()
+        return CrooManifest(
+            local_manifest_file,
+            resume=self._resume,
+            read_only=read_only,
+            upload_uri=None if manifest_uri == local_manifest_file else manifest_uri,
+        )
+
+    def __get_url(self, uri):
+        """Get a public/presigned/mapped URL for a URI if possible.
+        None if not possible.
+        """
+        u = AutoURI(uri)
+
+        if isinstance(u, GCSURI):
+            if self._public_gcs:
+                return u.get_public_url()
+
+            elif self._use_presigned_url_gcs:
+                return u.get_presigned_url(
+                    duration=self._duration_presigned_url_gcs,
+                    private_key_file=self._gcp_private_key,
+                )
+
+        elif isinstance(u, S3URI):
+            if self._use_presigned_url_s3:
+                return u.get_presigned_url(duration=self._duration_presigned_url_s3)
+
+        elif isinstance(u, AbsPath):
+            if self._map_path_to_url:
+                return u.get_mapped_url(map_path_to_url=self._map_path_to_url)
+
+        return None
+
+    def plan(self, check_storage=False):
+        """Plan organizing outputs without transferring files and
+        writing anything on out_dir.
+        All inline expressions in output definition JSON are resolved.
+
+        Args:
+            check_storage:
+                Read metadata of files on storages to get file sizes and
+                to find files that will be skipped. See CrooTransfer.plan().
+                md5 hashes of local files are looked up in checksum cache
+                (opened read-only) or calculated without being cached.
+                A manifest is read for resuming.
+                Otherwise, storages are not accessed at all.
+
+        Returns:
+            dict with the following keys:
+                workflow_id:
+                    Workflow ID.
+                outputs:
+                    List of dict for each output file in out_def JSON.
+                    job_id is an index in jobs. None if there is no transfer.
+                jobs:
+                    List of dict for each transfer job. See CrooTransfer.plan().
+                summary:
+                    Number of outputs/jobs, number of skipped jobs and
+                    bytes to be transferred for each pair of storages (src->target).
+        """
+        self.__stop_profiling()
+        checksum_cache = None
+        manifest = None
+        if check_storage:
+            checksum_cache = self.__open_checksum_cache(read_only=True)
+            if self._resume:
+                manifest = self.__open_manifest(read_only=True)
+        try:
+            transfer = self.__make_transfer(checksum_cache, manifest)
+            outputs = self.__collect_outputs(transfer)
+            jobs = transfer.plan(check_storage=check_storage)
+        finally:
+            if checksum_cache is not None:
+                checksum_cache.close()
+            if manifest is not None:
+                manifest.close()
+
+        planned_outputs = []
+        for (
+            task_name,
+            output_name,
+            shard_idx,
+            full_path,
+            env,
+            job_id,
+            path,
+            table_item,
+            ucsc_track,
+            node_format,
+            subgraph,
+        ) in outputs:
+            planned_outputs.append(
+                {
+                    'task_name': task_name,
+                    'output_name': output_name,
+                    'shard_idx': list(shard_idx),
+                    'src': full_path,
+                    'target': None if job_id is None else jobs[job_id]['target'],
+                    'job_id': job_id,
+                    'table': None if table_item is None else table_item.render(env),
+                    'ucsc_track': (
+                        None if ucsc_track is None else ucsc_track.render(env)
+                    ),
+                    'node': None if node_format is None else node_format.render(env),
+                    'subgraph': None if subgraph is None else subgraph.render(env),
+                }
+            )
+
+        bytes_to_transfer = {}
+        for job in jobs:
+            if (
+                job['method'] == CrooManifest.METHOD_COPY
+                and not job['skip']
+                and job['size'] is not None
+            ):
+                storages = '{src}->{target}'.format(
+                    src=job['src_storage'], target=job['target_storage']
+                )
+                bytes_to_transfer[storages] = (
+                    bytes_to_transfer.get(storages, 0) + job['size']
+                )
+
+        return {
+            'workflow_id': self._cm.get_workflow_id(),
+            'outputs': planned_outputs,
+            'jobs': jobs,
+            'summary': {
+                'num_outputs': len(planned_outputs),
+                'num_jobs': len(jobs),
+                'num_skipped_jobs': (
+                    sum(1 for job in jobs if job['skip']) if check_storage else None
+                ),
+                'bytes_to_transfer': bytes_to_transfer if check_storage else None,
+            },
+        }
+
+    def __collect_outputs(self, transfer, task_nodes=None):
+        """Find all output files defined in out_def JSON and
+        add their transfer jobs to transfer.
+
+        Args:
+            task_nodes:
+                Set of task nodes. Outputs of other task nodes are ignored.
+                None to take all.
+
+        Returns:
+            List of tuples for each output file (
+                task_name, output_name, shard_idx, full_path, env, job_id,
+                path, table_item, ucsc_track, node_format, subgraph,
+            ).
+            env is inline expression variables for a file and
+            job_id is a transfer job ID (None if no path is defined).
+            Others are compiled inline expressions (CrooInlineExp).
+        """
+
+        outputs = []
         for task_name, out_vars in self._out_def_json.items():
             for output_name, output_obj in out_vars.items():
-                path = output_obj.get('path')
-                table_item = output_obj.get('table')
-                ucsc_track = output_obj.get('ucsc_track')
-                node_format = output_obj.get('node')
-                subgraph = output_obj.get('subgraph')
-
-                for _, node in self._task_graph.get_nodes():
-                    # look at output nodes only (not a task node)
-                    if task_name != node.task_name or node.type != 'task':
+                path = Croo.__compile_inline_exp(output_obj.get('path'))
+                table_item = Croo.__compile_inline_exp(output_obj.get('table'))
+                ucsc_track = Croo.__compile_inline_exp(output_obj.get('ucsc_track'))
+                node_format = Croo.__compile_inline_exp(output_obj.get('node'))
+                subgraph = Croo.__compile_inline_exp(output_obj.get('subgraph'))
+
+                for _, node in self._cm.find_task_nodes(task_name):
+                    if task_nodes is not None and node not in task_nodes:
                         continue
                     all_outputs = node.all_outputs
                     shard_idx = node.shard_idx
@@ -184,162 +821,113 @@ class Croo:
                         if k != output_name:
                             continue
 
-                        target_uri = full_path
+                        env = CrooInlineExp.make_env(full_path, shard_idx)
+                        job_id = None
                         if path is not None:
-                            interpreted_path = Croo.__interpret_inline_exp(
-                                path, full_path, shard_idx
-                            )
-
-                            au = AutoURI(full_path)
+                            interpreted_path = path.render(env)
                             target_path = os.path.join(self._out_dir, interpreted_path)
+                            job_id = transfer.add(full_path, target_path)
 
-                            if self._soft_link:
-                                au_target = AutoURI(target_path)
-                                if isinstance(au, AbsPath) and isinstance(
-                                    au_target, AbsPath
-                                ):
-                                    au.soft_link(target_path, force=True)
-                                    target_uri = target_path
-                                else:
-                                    target_uri = full_path
-                            else:
-                                target_uri = au.cp(
-                                    target_path,
-                                    no_checksum=self._no_checksum,
-                                    make_md5_file=True,
-                                    no_lock=True,
-                                )
-
-                        # get presigned URLs if possible
-                        target_url = None
-                        if (
-                            path is not None
-                            or table_item is not None
-                            or ucsc_track is not None
-                            or node_format is not None
-                        ):
-                            u = AutoURI(target_uri)
-
-                            if isinstance(u, GCSURI):
-                                if self._public_gcs:
-                                    target_url = u.get_public_url()
-
-                                elif self._use_presigned_url_gcs:
-                                    target_url = u.get_presigned_url(
-                                        duration=self._duration_presigned_url_gcs,
-                                        private_key_file=self._gcp_private_key,
-                                    )
-
-                            elif isinstance(u, S3URI):
-                                if self._use_presigned_url_s3:
-                                    target_url = u.get_presigned_url(
-                                        duration=self._duration_presigned_url_s3
-                                    )
-
-                            elif isinstance(u, AbsPath):
-                                if self._map_path_to_url:
-                                    target_url = u.get_mapped_url(
-                                        map_path_to_url=self._map_path_to_url
-                                    )
-
-                        if table_item is not None:
-                            interpreted_table_item = Croo.__interpret_inline_exp(
-                                table_item, full_path, shard_idx
-                            )
-                            # add to file table
-                            report.add_to_file_table(
-                                target_uri, target_url, interpreted_table_item
-                            )
-                        if ucsc_track is not None and target_url is not None:
-                            interpreted_ucsc_track = Croo.__interpret_inline_exp(
-                                ucsc_track, full_path, shard_idx
-                            )
-                            report.add_to_ucsc_track(target_url, interpreted_ucsc_track)
-                        if node_format is not None:
-                            interpreted_node_format = Croo.__interpret_inline_exp(
-                                node_format, full_path, shard_idx
-                            )
-                            if subgraph is not None:
-                                interpreted_subgraph = Croo.__interpret_inline_exp(
-                                    subgraph, full_path, shard_idx
-                                )
-                            else:
-                                interpreted_subgraph = None
-                            report.add_to_task_graph(
-                                output_name,
+                        outputs.append(
+                            (
                                 task_name,
+                                output_name,
                                 shard_idx,
-                                full_path if target_url is None else target_url,
-                                interpreted_node_format,
-                                interpreted_subgraph,
+                                full_path,
+                                env,
+                                job_id,
+                                path,
+                                table_item,
+                                ucsc_track,
+                                node_format,
+                                subgraph,
                             )
-        # write to html report
-        report.save_to_file()
+                        )
+        return outputs
 
-    @staticmethod
-    def __interpret_inline_exp(s, full_path, shard_idx):
-        """Interpret inline expression in output defition JSON
-        e.g. s can be "align/rep${i1}/${basename}"
-        Nested scatter can only be implemented by using subworkflows.
+    @contextmanager
+    def __open_checksum_cache_and_manifest(self):
+        """Open checksum cache and manifest for transfers.
+        Both are closed even if transfers fail
+        so that a manifest is still uploaded to a remote out_dir.
+        """
+        checksum_cache = self.__open_checksum_cache()
+        try:
+            manifest = self.__open_manifest()
+            try:
+                yield checksum_cache, manifest
+            finally:
+                manifest.close()
+        finally:
+            if checksum_cache is not None:
+                checksum_cache.close()
+
+    def __open_checksum_cache(self, read_only=False):
+        if self._use_checksum_cache and not self._soft_link and not self._no_checksum:
+            return CrooChecksumCache(self._tmp_dir, read_only=read_only)
+        return None
+
+    def __make_transfer(self, checksum_cache=None, manifest=None, stats=None):
+        return CrooTransfer(
+            num_threads=self._num_threads,
+            soft_link=self._soft_link,
+            no_checksum=self._no_checksum,
+            checksum_cache=checksum_cache,
+            manifest=manifest,
+            local_copy_method=self._local_copy_method,
+            multipart_threshold=self._multipart_threshold,
+            multipart_part_size=self._multipart_part_size,
+            multipart_num_threads=self._multipart_num_threads,
+            throttles=self._throttles,
+            max_retries=self._max_retries,
+            retry_delay=self._retry_delay,
+            stats=stats,
+        )
 
-        Args:
-            full_path: full absolute path for output file
-            shard_idx: tuple of scatter indices. -1 means no scatter
-                       e.g. (-1, 0, 1,):
-                            no scatter in main workflow
-                            scatter id 0 in subworkflow
-                            scatter id 1 in subsubworkflow
-
-        Supported expressions:
-            ${i} (int) : 0-based index for a main scatter loop
-            ${j} (int) : 0-based index for a nested scatter loop
-            ${k} (int) : 0-based index for a double-nested scatter loop
-            ${ll} (int) : 0-based index for a triple-nested scatter loop
-            ${m} (int) : 0-based index for a quadruple-nested scatter loop
-            ${n} (int) : 0-based index for a 5-nested scatter loop
-            ${o} (int) : 0-based index for a 6-nested scatter loop
-            ${basename} (str) : basename of file
-            ${dirname} (str)  : dirname of file
-            ${full_path} (str) : full_path of file (can be path, gs://, s3://)
-            ${shard_idx} : tuple of (i, j, k, ...) with dynamic length
+    @staticmethod
+    def __find_metadata_json(metadata_json):
+        """Find the most recently modified *.json file
+        if metadata_json is a local directory.
         """
-        result = s
-
-        i = None
-        if shard_idx[0] > -1:
-            i = shard_idx[0]
-        j = None
-        if len(shard_idx) > 1 and shard_idx[1] > -1:
-            j = shard_idx[1]
-        k = None
-        if len(shard_idx) > 2 and shard_idx[2] > -1:
-            k = shard_idx[2]
-        l = None
-        if len(shard_idx) > 3 and shard_idx[3] > -1:
-            l = shard_idx[3]
-        m = None
-        if len(shard_idx) > 4 and shard_idx[4] > -1:
-            m = shard_idx[4]
-        n = None
-        if len(shard_idx) > 5 and shard_idx[5] > -1:
-            n = shard_idx[5]
-        o = None
-        if len(shard_idx) > 6 and shard_idx[6] > -1:
-            o = shard_idx[6]
-
-        basename = os.path.basename(full_path)
-        dirname = os.path.dirname(full_path)
-        logger.debug(
-            'inline expression: basename={basename}, dirname={dirname}, '
-            'i={i}, j={j}, k={k}, l={l}, m={m}, n={n}, o={o}'.format(
-                basename=basename, dirname=dirname, i=i, j=j, k=k, l=l, m=m, n=n, o=o
+        if not os.path.isdir(metadata_json):
+            return metadata_json
+        json_files = [
+            os.path.abspath(os.path.join(metadata_json, f))
+            for f in os.listdir(metadata_json)
+            if f.endswith('.json')
+        ]
+        if not json_files:
+            raise ValueError(
+                'No metadata JSON file found in directory: {d}'.format(d=metadata_json)
             )
-        )
+        return max(json_files, key=os.path.getmtime)
 
-        while True:
-            m = re.search(Croo.RE_PATTERN_INLINE_EXP, result)
-            if m is None:
-                break
-            result = result.replace(m.group(0), str(eval(m.group(1))), 1)
+    @staticmethod
+    def __load_metadata_json(fp):
+        """Load metadata JSON from a file object.
+        Take the first one if it has a list of metadata JSON objects.
+        """
+        metadata = json.loads(fp.read())
+        if isinstance(metadata, list):
+            if len(metadata) > 1:
+                logger.warning(
+                    'Multiple metadata JSON objects '
+                    'found in metadata JSON file. Taking the first '
+                    'one...'
+                )
+            elif len(metadata) == 0:
+                raise Exception('metadata JSON file is empty')
+            metadata = metadata[0]
+        return metadata
 
-        return result
+    @staticmethod
+    def __compile_inline_exp(s):
+        """Compile a template string with inline expressions
+        in output definition JSON. See CrooInlineExp for details.
+
+        Returns:
+            CrooInlineExp object. None if s is None.
+        """
+        if s is None:
+            return None
+        return CrooInlineExp(s)
@@ -0,0 +1,272 @@
+"""CrooBatch: organize outputs of many workflows on a pool of worker processes.
+"""
+
+import glob
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from autouri import AutoURI
+
+from .croo import Croo
+from .croo_tmp_cache import CrooTmpCache
+
+logger = logging.getLogger(__name__)
+
+BATCH_SUMMARY_FILE = 'croo.batch_summary.json'
+BATCH_SPLIT_DIR = 'croo_batch'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+
+
+def find_metadata_json_files(patterns):
+    """Expand glob patterns of local metadata JSON files.
+    Remote URIs (gs://, s3://, http://) are taken as they are.
+
+    Returns:
+        List of metadata JSON files/URIs without duplicates
+        in order of patterns.
+    """
+    found = []
+    for pattern in patterns:
+        if '://' in pattern:
+            if glob.has_magic(pattern):
+                raise ValueError(
+                    'Glob pattern is not allowed for remote URI: {p}'.format(p=pattern)
+                )
+            files = [pattern]
+        else:
+            pattern = os.path.abspath(os.path.expanduser(pattern))
+            if glob.has_magic(pattern):
+                files = sorted(glob.glob(pattern))
+                if not files:
+                    raise ValueError(
+                        'No metadata JSON file matches: {p}'.format(p=pattern)
+                    )
+            else:
+                files = [pattern]
+        for f in files:
+            if f not in found:
+                found.append(f)
+    return found
+
+
+def split_metadata_json(metadata_json, tmp_dir, max_tmp_cache_size=None):
+    """Split a metadata JSON file with a list of metadata JSON objects
+    into files (one for each object) on tmp_dir.
+
+    Args:
+        max_tmp_cache_size:
+            See Croo's max_tmp_cache_size.
+
+    Returns:
+        List of split metadata JSON files.
+        None if metadata_json has a single JSON object.
+    """
+    tmp_cache = CrooTmpCache(tmp_dir, max_size=max_tmp_cache_size)
+    with tmp_cache.open(metadata_json, no_lock=True) as fp:
+        # peek first non-whitespace char not to parse a huge JSON object here
+        while True:
+            c = fp.read(1)
+            if not c.isspace():
+                break
+        if c != '[':
+            return None
+        fp.seek(0)
+        metadata = json.load(fp)
+
+    split_dir = os.path.join(tmp_dir, BATCH_SPLIT_DIR)
+    os.makedirs(split_dir, exist_ok=True)
+    split_files = []
+    for i, m in enumerate(metadata):
+        split_file = os.path.join(
+            split_dir,
+            '{basename}.{i}.{workflow_id}.json'.format(
+                basename=AutoURI(metadata_json).basename,
+                i=i,
+                workflow_id=m.get('id'),
+            ),
+        )
+        with open(split_file, 'w') as fp:
+            json.dump(m, fp)
+        split_files.append(split_file)
+    return split_files
+
+
+def organize_workflow(metadata_json, index, metadata_json_file, croo_kwargs):
+    """Organize outputs of a workflow. This runs on a worker process.
+
+    Args:
+        metadata_json:
+            Original metadata JSON file/URI in a batch.
+        index:
+            Index of a metadata JSON object in a metadata JSON file
+            with a list of objects.
+            None if metadata JSON file has not been split yet.
+        metadata_json_file:
+            Metadata JSON file to be organized.
+        croo_kwargs:
+            Keyword arguments for Croo.
+
+    Returns:
+        dict of result or a list of split metadata JSON files
+        if metadata JSON file has a list of objects and has not been split yet.
+    """
+    start = time.perf_counter()
+    result = {
+        'metadata_json': metadata_json,
+        'index': index,
+        'workflow_id': None,
+        'out_dir': None,
+        'status': STATUS_FAILED,
+        'error': None,
+    }
+    try:
+        if index is None:
+            split_files = split_metadata_json(
+                metadata_json,
+                croo_kwargs['tmp_dir'],
+                max_tmp_cache_size=croo_kwargs.get('max_tmp_cache_size'),
+            )
+            if split_files is not None:
+                return split_files
+
+        co = Croo(
+            metadata_json=metadata_json_file, out_dir_per_workflow=True, **croo_kwargs
+        )
+        result['workflow_id'] = co.get_workflow_id()
+        result['out_dir'] = co.get_out_dir()
+        co.organize_output()
+        result['status'] = STATUS_SUCCEEDED
+
+    except Exception as e:
+        logger.error(
+            'Failed to organize outputs. metadata_json={m}, index={i}\n{tb}'.format(
+                m=metadata_json, i=index, tb=traceback.format_exc()
+            )
+        )
+        result['error'] = str(e)
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class CrooBatch:
+    """Organize outputs of many workflows on a pool of worker processes.
+
+    Outputs of each workflow are organized on out_dir/WORKFLOW_ID/.
+    A metadata JSON file with a list of metadata JSON objects is split into
+    workflows. Worker processes are forked once and reused for all workflows
+    so that they do not pay startup costs (imports, autouri initialization)
+    for each workflow. They share caches on tmp_dir
+    (localized files, parsed metadata and md5 hashes).
+
+    A summary of all workflows (status, error and time taken)
+    is written as croo.batch_summary.json on out_dir.
+    """
+
+    def __init__(self, metadata_jsons, out_dir, tmp_dir, num_workers=1, **croo_kwargs):
+        """
+        Args:
+            metadata_jsons:
+                List of metadata JSON files/URIs.
+                Glob patterns are allowed for local files.
+            num_workers:
+                Number of worker processes.
+            croo_kwargs:
+                Keyword arguments for Croo except for metadata_json.
+        """
+        if num_workers < 1:
+            raise ValueError('num_workers must be >= 1.')
+        self._metadata_jsons = find_metadata_json_files(metadata_jsons)
+        self._out_dir = out_dir
+        self._num_workers = num_workers
+        self._croo_kwargs = dict(croo_kwargs, out_dir=out_dir, tmp_dir=tmp_dir)
+
+    def run(self):
+        """Organize outputs of all workflows and write a summary.
+        A failure of a workflow does not stop others.
+
+        Returns:
+            dict of summary.
+        """
+        start = time.perf_counter()
+        results = []
+        with ProcessPoolExecutor(max_workers=self._num_workers) as executor:
+            futures = {
+                executor.submit(
+                    organize_workflow,
+                    metadata_json,
+                    None,
+                    metadata_json,
+                    self._croo_kwargs,
+                ): (metadata_json, None)
+                for metadata_json in self._metadata_jsons
+            }
+            while futures:
+                for future in as_completed(list(futures)):
+                    metadata_json, index = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # e.g. worker process is killed
+                        result = {
+                            'metadata_json': metadata_json,
+                            'index': index,
+                            'workflow_id': None,
+                            'out_dir': None,
+                            'status': STATUS_FAILED,
+                            'error': str(e),
+                            'seconds': None,
+                        }
+                    if isinstance(result, list):
+                        for i, split_file in enumerate(result):
+                            future = executor.submit(
+                                organize_workflow,
+                                metadata_json,
+                                i,
+                                split_file,
+                                self._croo_kwargs,
+                            )
+                            futures[future] = (metadata_json, i)
+                        continue
+                    logger.info(
+                        'Batch: {status}, metadata_json={m}, index={i}, '
+                        'workflow_id={w}'.format(
+                            status=result['status'],
+                            m=metadata_json,
+                            i=index,
+                            w=result['workflow_id'],
+                        )
+                    )
+                    results.append(result)
+
+        results.sort(
+            key=lambda r: (
+                self._metadata_jsons.index(r['metadata_json']),
+                -1 if r['index'] is None else r['index'],
+            )
+        )
+        num_failed = sum(r['status'] == STATUS_FAILED for r in results)
+        summary = {
+            'num_workflows': len(results),
+            'num_succeeded': len(results) - num_failed,
+            'num_failed': num_failed,
+            'seconds': time.perf_counter() - start,
+            'workflows': results,
+        }
+        summary_file = os.path.join(self._out_dir, BATCH_SUMMARY_FILE)
+        AutoURI(summary_file).write(json.dumps(summary, indent=4), no_lock=True)
+        logger.info(
+            'Batch: succeeded={s}, failed={f}, {sec:.3f} sec. '
+            'Summary JSON file: {uri}'.format(
+                s=summary['num_succeeded'],
+                f=num_failed,
+                sec=summary['seconds'],
+                uri=summary_file,
+            )
+        )
+        return summary
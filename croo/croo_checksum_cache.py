@@ -0,0 +1,175 @@
+"""CrooChecksumCache: persistent md5 hash cache for local files.
+"""
+
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+from autouri import AbsPath
+
+logger = logging.getLogger(__name__)
+
+
+def calc_md5(path, chunk_size, num_read_ahead_chunks):
+    """Calculate md5 hash of a local file.
+    A reader thread reads chunks ahead while the current thread is hashing
+    so that disk I/O and hashing overlap (both release GIL for large buffers).
+    Only reading overlaps with hashing. A single md5 is still calculated
+    on one thread so hashing itself is not faster. Multiple files are hashed
+    in parallel only by multiple callers (e.g. CrooTransfer's worker threads).
+
+    Args:
+        chunk_size:
+            Size of each chunk to be read.
+        num_read_ahead_chunks:
+            Maximum number of chunks read ahead.
+    """
+    chunks = queue.Queue(maxsize=num_read_ahead_chunks)
+    stop = threading.Event()
+    errors = []
+
+    def read_chunks():
+        try:
+            with open(path, 'rb') as fp:
+                while not stop.is_set():
+                    chunk = fp.read(chunk_size)
+                    chunks.put(chunk)
+                    if not chunk:
+                        return
+        except Exception as e:
+            errors.append(e)
+            chunks.put(b'')
+
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    reader.start()
+
+    hash_md5 = hashlib.md5()
+    try:
+        for chunk in iter(chunks.get, b''):
+            hash_md5.update(chunk)
+    finally:
+        stop.set()
+        # unblock reader if it's waiting on a full queue
+        while reader.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                reader.join(0.01)
+
+    if errors:
+        raise errors[0]
+    return hash_md5.hexdigest()
+
+
+class CrooChecksumCache:
+    """md5 hashes of local files stored in a SQLite DB file.
+    Each hash is keyed by file path and valid only if file size and mtime
+    have not changed since it was calculated.
+
+    Thread-safe. A DB file can be shared among multiple processes.
+    """
+
+    DB_FILE = 'croo.checksum_cache.db'
+    MD5_CALC_CHUNK_SIZE = 4 * 1024 * 1024
+    MD5_CALC_NUM_READ_AHEAD_CHUNKS = 4
+    DB_TIMEOUT = 60.0
+
+    def __init__(self, cache_dir, read_only=False):
+        """
+        Args:
+            cache_dir:
+                LOCAL directory to store a DB file.
+            read_only:
+                Only look up md5 hashes in an existing DB file.
+                DB file (and cache_dir) is not created and
+                nothing is written to it.
+        """
+        self._db_file = os.path.join(cache_dir, CrooChecksumCache.DB_FILE)
+        self._read_only = read_only
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = None
+            if os.path.exists(self._db_file):
+                self._conn = sqlite3.connect(
+                    'file:{path}?mode=ro'.format(path=pathname2url(self._db_file)),
+                    timeout=CrooChecksumCache.DB_TIMEOUT,
+                    check_same_thread=False,
+                    uri=True,
+                )
+            return
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(
+            self._db_file, timeout=CrooChecksumCache.DB_TIMEOUT, check_same_thread=False
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS md5 ('
+                'uri TEXT PRIMARY KEY, size INTEGER, mtime REAL, md5 TEXT)'
+            )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, uri, size, mtime):
+        """Get a cached md5 hash. None if not found or outdated.
+        """
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT size, mtime, md5 FROM md5 WHERE uri = ?', (uri,)
+            ).fetchone()
+        if row is None or row[0] != size or row[1] != mtime:
+            return None
+        return row[2]
+
+    def put(self, uri, size, mtime, md5):
+        """Cache an md5 hash. Ignored if read-only.
+        """
+        if self._read_only:
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO md5 (uri, size, mtime, md5) '
+                'VALUES (?, ?, ?, ?)',
+                (uri, size, mtime, md5),
+            )
+
+    def get_metadata(self, au):
+        """Same as autouri's get_metadata() but md5 hash of a local file is
+        taken from cache or calculated and then cached.
+        For other storages (e.g. gs://, s3://), md5 hash is taken from
+        storage's metadata so it is not cached.
+
+        Args:
+            au:
+                AutoURI object.
+        Returns:
+            Tuple of (exists, mtime, size, md5)
+        """
+        if not isinstance(au, AbsPath):
+            return au.get_metadata()
+
+        m = au.get_metadata(skip_md5=True)
+        if not m.exists:
+            return m
+        md5 = self.get(au.uri, m.size, m.mtime)
+        if md5 is None:
+            md5 = au.md5_from_file
+            if md5 is None:
+                logger.debug('Calculating md5 hash of local file: {f}'.format(f=au.uri))
+                md5 = calc_md5(
+                    au.uri,
+                    chunk_size=CrooChecksumCache.MD5_CALC_CHUNK_SIZE,
+                    num_read_ahead_chunks=CrooChecksumCache.MD5_CALC_NUM_READ_AHEAD_CHUNKS,
+                )
+            self.put(au.uri, m.size, m.mtime, md5)
+        return m._replace(md5=md5)
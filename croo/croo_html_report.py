@@ -44,6 +44,7 @@ class CrooHtmlReport(object):
         workflow_id,
         dag,
         task_graph_template=None,
+        task_graph_transitive_reduction=False,
         public_gcs=None,
         gcp_private_key=None,
         use_presigned_url_gcs=False,
@@ -82,6 +83,7 @@ class CrooHtmlReport(object):
             workflow_id=workflow_id,
             dag=dag,
             template_d=task_graph_template,
+            transitive_reduction=task_graph_transitive_reduction,
         )
 
     def add_to_file_table(self, full_path, url, table_item):
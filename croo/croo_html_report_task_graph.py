@@ -6,6 +6,8 @@ from autouri import AutoURI
 from graphviz import Source
 from graphviz.backend import ExecutableNotFound
 
+from .croo_profiler import CrooProfiler
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,7 +15,9 @@ class CrooHtmlReportTaskGraph(object):
     TASK_GRAPH_DOT = 'croo.task_graph.{workflow_id}.dot'
     TASK_GRAPH_SVG = 'croo.task_graph.{workflow_id}.svg'
 
-    def __init__(self, out_dir, workflow_id, dag, template_d):
+    def __init__(
+        self, out_dir, workflow_id, dag, template_d, transitive_reduction=False
+    ):
         """
         Args:
             out_dir:
@@ -25,11 +29,15 @@ class CrooHtmlReportTaskGraph(object):
                 This dot file will be converted into SVG and finally be embedded in HTML
                 Refer to the function caper.dict_tool.dict_to_dot_str() for details
                 https://github.com/ENCODE-DCC/caper/blob/master/caper/dict_tool.py#L190
+            transitive_reduction:
+                Remove redundant links (edges) from the task graph.
+                Useful to render a huge graph faster.
         """
         self._out_dir = out_dir
         self._workflow_id = workflow_id
         self._dag = dag
         self._template_d = template_d
+        self._transitive_reduction = transitive_reduction
         self._items = {}
 
     def add(self, output_name, task_name, shard_idx, url, node_format, subgraph):
@@ -87,19 +95,22 @@ class CrooHtmlReportTaskGraph(object):
                 return None
 
         # convert to dot string
-        dot_str = self._dag.to_dot(
-            fnc_node_format=fnc_node_format,
-            fnc_href=fnc_href,
-            fnc_subgraph=fnc_subgraph,
-            template=self._template_d,
-        )
+        with CrooProfiler.span('to_dot'):
+            dot_str = self._dag.to_dot(
+                fnc_node_format=fnc_node_format,
+                fnc_href=fnc_href,
+                fnc_subgraph=fnc_subgraph,
+                template=self._template_d,
+                transitive_reduction=self._transitive_reduction,
+            )
 
         with tempfile.TemporaryDirectory() as tmp_dir:
             # temporary dot, svg from graphviz.Source.render
             tmp_dot = os.path.join(tmp_dir, '_tmp_.dot')
 
             try:
-                svg = Source(dot_str, format='svg').render(filename=tmp_dot)
+                with CrooProfiler.span('graphviz_render'):
+                    svg = Source(dot_str, format='svg').render(filename=tmp_dot)
             except (ExecutableNotFound, FileNotFoundError):
                 logger.error(
                     'Importing graphviz failed. Task graph will not be available. '
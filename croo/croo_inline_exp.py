@@ -0,0 +1,293 @@
+"""CrooInlineExp: compiled inline expression template in output definition JSON.
+"""
+
+import ast
+import operator
+import os
+import re
+import sys
+
+
+class CrooInlineExp:
+    """Template string with inline expressions (e.g. "align/rep${i+1}/${basename}").
+    Each expression in ${...} is parsed once and compiled into a Python closure.
+    Python's eval() is not used.
+
+    Supported expressions:
+        Variables:
+            ${i} (int) : 0-based index for a main scatter loop
+            ${j} (int) : 0-based index for a nested scatter loop
+            ${k} (int) : 0-based index for a double-nested scatter loop
+            ${l} or ${ll} (int) : 0-based index for a triple-nested scatter loop
+            ${m} (int) : 0-based index for a quadruple-nested scatter loop
+            ${n} (int) : 0-based index for a 5-nested scatter loop
+            ${o} (int) : 0-based index for a 6-nested scatter loop
+            ${basename} (str) : basename of file
+            ${dirname} (str)  : dirname of file
+            ${full_path} (str) : full_path of file (can be path, gs://, s3://)
+            ${shard_idx} : tuple of (i, j, k, ...) with dynamic length
+            Scatter index variable is None if there is no such scatter loop.
+        Literals: numbers, strings, None, True, False, tuples and lists.
+        Operators: + - * / // %, comparisons, and/or/not, x if cond else y.
+        Subscripts and slices: e.g. ${basename.split('.')[0]}, ${shard_idx[-1]}
+        Functions: see FUNCTIONS.
+        String methods: see STR_METHODS. e.g. ${basename.replace('_', ' ')}
+    """
+
+    RE_PATTERN_INLINE_EXP = re.compile(r'\$\{(.*?)\}')
+    SHARD_IDX_VARS = ('i', 'j', 'k', 'l', 'm', 'n', 'o')
+    VAR_ALIASES = {'ll': 'l'}
+    VARS = SHARD_IDX_VARS + ('basename', 'dirname', 'full_path', 'shard_idx')
+    FUNCTIONS = {
+        'abs': abs,
+        'float': float,
+        'int': int,
+        'len': len,
+        'max': max,
+        'min': min,
+        'round': round,
+        'str': str,
+    }
+    STR_METHODS = frozenset(
+        (
+            'capitalize',
+            'endswith',
+            'join',
+            'lower',
+            'lstrip',
+            'replace',
+            'rsplit',
+            'rstrip',
+            'split',
+            'startswith',
+            'strip',
+            'title',
+            'upper',
+            'zfill',
+        )
+    )
+    BIN_OPS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+    }
+    UNARY_OPS = {ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Not: operator.not_}
+    CMP_OPS = {
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+        ast.Is: operator.is_,
+        ast.IsNot: operator.is_not,
+        ast.In: lambda a, b: a in b,
+        ast.NotIn: lambda a, b: a not in b,
+    }
+
+    def __init__(self, s):
+        """Parse and compile all inline expressions in a template string.
+        Raises ValueError if any expression is invalid or not supported.
+
+        Args:
+            s:
+                Template string with inline expressions.
+        """
+        self._s = s
+        # list of either a literal string or a compiled expression
+        self._parts = []
+        pos = 0
+        for m in CrooInlineExp.RE_PATTERN_INLINE_EXP.finditer(s):
+            if m.start() > pos:
+                self._parts.append(s[pos : m.start()])
+            self._parts.append(CrooInlineExp.__compile_exp(m.group(1)))
+            pos = m.end()
+        if pos < len(s):
+            self._parts.append(s[pos:])
+
+    def __str__(self):
+        return self._s
+
+    @staticmethod
+    def make_env(full_path, shard_idx):
+        """Make variables for inline expressions for a file.
+        Make it once for a file and share it for all templates.
+
+        Args:
+            full_path: full absolute path for output file
+            shard_idx: tuple of scatter indices. -1 means no scatter
+                       e.g. (-1, 0, 1,):
+                            no scatter in main workflow
+                            scatter id 0 in subworkflow
+                            scatter id 1 in subsubworkflow
+        """
+        env = {
+            'basename': os.path.basename(full_path),
+            'dirname': os.path.dirname(full_path),
+            'full_path': full_path,
+            'shard_idx': shard_idx,
+        }
+        for d, var in enumerate(CrooInlineExp.SHARD_IDX_VARS):
+            if len(shard_idx) > d and shard_idx[d] > -1:
+                env[var] = shard_idx[d]
+            else:
+                env[var] = None
+        return env
+
+    def render(self, env):
+        """Render template with variables made by make_env().
+        """
+        return ''.join(p if isinstance(p, str) else str(p(env)) for p in self._parts)
+
+    @staticmethod
+    def __compile_exp(exp):
+        try:
+            tree = ast.parse(exp.strip(), mode='eval')
+        except SyntaxError:
+            raise ValueError('Invalid inline expression: ${{{exp}}}'.format(exp=exp))
+        return CrooInlineExp.__compile(tree.body, exp)
+
+    @staticmethod
+    def __compile(node, exp):
+        """Compile an AST node into a closure taking variables (env).
+        """
+        compile_ = CrooInlineExp.__compile
+
+        if sys.version_info < (3, 8) and isinstance(
+            node, (ast.Num, ast.Str, ast.NameConstant)
+        ):
+            value = node.n if isinstance(node, ast.Num) else node.s
+            if isinstance(node, ast.NameConstant):
+                value = node.value
+            return lambda env: value
+
+        if isinstance(node, ast.Constant):
+            value = node.value
+            return lambda env: value
+
+        if isinstance(node, ast.Name):
+            var = CrooInlineExp.VAR_ALIASES.get(node.id, node.id)
+            if var not in CrooInlineExp.VARS:
+                raise ValueError(
+                    'Unknown variable {var} in inline expression: ${{{exp}}}'.format(
+                        var=node.id, exp=exp
+                    )
+                )
+            return lambda env: env[var]
+
+        if isinstance(node, (ast.Tuple, ast.List)):
+            elts = [compile_(e, exp) for e in node.elts]
+            seq_type = tuple if isinstance(node, ast.Tuple) else list
+            return lambda env: seq_type(e(env) for e in elts)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in CrooInlineExp.BIN_OPS:
+            op = CrooInlineExp.BIN_OPS[type(node.op)]
+            left = compile_(node.left, exp)
+            right = compile_(node.right, exp)
+            return lambda env: op(left(env), right(env))
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in CrooInlineExp.UNARY_OPS:
+            op = CrooInlineExp.UNARY_OPS[type(node.op)]
+            operand = compile_(node.operand, exp)
+            return lambda env: op(operand(env))
+
+        if isinstance(node, ast.Compare) and all(
+            type(op) in CrooInlineExp.CMP_OPS for op in node.ops
+        ):
+            left = compile_(node.left, exp)
+            ops = [CrooInlineExp.CMP_OPS[type(op)] for op in node.ops]
+            comparators = [compile_(c, exp) for c in node.comparators]
+
+            def fnc_compare(env):
+                a = left(env)
+                for op, comparator in zip(ops, comparators):
+                    b = comparator(env)
+                    if not op(a, b):
+                        return False
+                    a = b
+                return True
+
+            return fnc_compare
+
+        if isinstance(node, ast.BoolOp):
+            values = [compile_(v, exp) for v in node.values]
+            is_and = isinstance(node.op, ast.And)
+
+            def fnc_bool_op(env):
+                for v in values:
+                    result = v(env)
+                    if bool(result) != is_and:
+                        return result
+                return result
+
+            return fnc_bool_op
+
+        if isinstance(node, ast.IfExp):
+            test = compile_(node.test, exp)
+            body = compile_(node.body, exp)
+            orelse = compile_(node.orelse, exp)
+            return lambda env: body(env) if test(env) else orelse(env)
+
+        if isinstance(node, ast.Subscript):
+            value = compile_(node.value, exp)
+            index = compile_(node.slice, exp)
+            return lambda env: value(env)[index(env)]
+
+        if sys.version_info < (3, 9) and isinstance(node, ast.Index):
+            return compile_(node.value, exp)
+
+        if isinstance(node, ast.Slice):
+            lower, upper, step = (
+                compile_(v, exp) if v is not None else (lambda env: None)
+                for v in (node.lower, node.upper, node.step)
+            )
+            return lambda env: slice(lower(env), upper(env), step(env))
+
+        if isinstance(node, ast.Call) and not any(
+            isinstance(a, ast.Starred) for a in node.args
+        ):
+            args = [compile_(a, exp) for a in node.args]
+            kwargs = {}
+            for kw in node.keywords:
+                if kw.arg is None:
+                    break
+                kwargs[kw.arg] = compile_(kw.value, exp)
+            else:
+                if isinstance(node.func, ast.Name):
+                    fnc = CrooInlineExp.FUNCTIONS.get(node.func.id)
+                    if fnc is not None:
+                        return lambda env: fnc(
+                            *[a(env) for a in args],
+                            **{k: v(env) for k, v in kwargs.items()}
+                        )
+                elif (
+                    isinstance(node.func, ast.Attribute)
+                    and node.func.attr in CrooInlineExp.STR_METHODS
+                ):
+                    obj = compile_(node.func.value, exp)
+                    method = node.func.attr
+
+                    def fnc_str_method(env):
+                        o = obj(env)
+                        if not isinstance(o, str):
+                            raise ValueError(
+                                'Method {method} is called for a non-string '
+                                'object {o} in inline expression: ${{{exp}}}'.format(
+                                    method=method, o=o, exp=exp
+                                )
+                            )
+                        return getattr(o, method)(
+                            *[a(env) for a in args],
+                            **{k: v(env) for k, v in kwargs.items()}
+                        )
+
+                    return fnc_str_method
+
+        raise ValueError(
+            'Unsupported syntax {node} in inline expression: ${{{exp}}}'.format(
+                node=type(node).__name__, exp=exp
+            )
+        )
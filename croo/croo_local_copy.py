@@ -0,0 +1,101 @@
+"""Methods to copy a local file to another local path for Croo.
+"""
+
+import errno
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+LOCAL_COPY_METHOD_COPY = 'copy'
+LOCAL_COPY_METHOD_HARDLINK = 'hardlink'
+LOCAL_COPY_METHOD_REFLINK = 'reflink'
+LOCAL_COPY_METHOD_COPY_FILE_RANGE = 'copy_file_range'
+LOCAL_COPY_METHODS = (
+    LOCAL_COPY_METHOD_COPY,
+    LOCAL_COPY_METHOD_HARDLINK,
+    LOCAL_COPY_METHOD_REFLINK,
+    LOCAL_COPY_METHOD_COPY_FILE_RANGE,
+)
+
+# ioctl request code to clone a file on Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+COPY_FILE_RANGE_CHUNK_SIZE = 1024 * 1024 * 1024
+
+
+def hard_link(src, target):
+    os.link(src, target)
+
+
+def reflink(src, target):
+    """Clone a file (copy-on-write) with Linux's FICLONE ioctl.
+    Data blocks are shared until one of them is modified.
+    Supported on btrfs, XFS (reflink=1), bcachefs, OCFS2, ...
+    """
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflink is supported on Linux only.')
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(target, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_file_range(src, target):
+    """Copy a file within kernel with copy_file_range(2).
+    Data is not copied through user space and
+    file system can offload it (e.g. server-side copy on NFS 4.2).
+    """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available.')
+    with open(src, 'rb') as fsrc, open(target, 'wb') as fdst:
+        while os.copy_file_range(
+            fsrc.fileno(), fdst.fileno(), COPY_FILE_RANGE_CHUNK_SIZE
+        ):
+            pass
+
+
+FNC_LOCAL_COPY = {
+    LOCAL_COPY_METHOD_HARDLINK: hard_link,
+    LOCAL_COPY_METHOD_REFLINK: reflink,
+    LOCAL_COPY_METHOD_COPY_FILE_RANGE: copy_file_range,
+}
+
+
+def local_copy(src, target, method):
+    """Copy a local file to a local target with a method.
+    An existing target is replaced.
+
+    Args:
+        method:
+            One of LOCAL_COPY_METHODS except for LOCAL_COPY_METHOD_COPY.
+    Returns:
+        True if done. False if method failed (e.g. source and target are
+        on different devices or file system does not support it).
+        Caller should fall back to a plain copy.
+    """
+    if method not in FNC_LOCAL_COPY:
+        raise ValueError('Unsupported local copy method: {m}'.format(m=method))
+
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            if not os.path.islink(target) and os.path.samefile(src, target):
+                return True
+            os.remove(target)
+        FNC_LOCAL_COPY[method](src, target)
+        return True
+
+    except OSError as e:
+        logger.debug(
+            'Failed to {method}. falling back to copy. src={src}, target={target}, '
+            'error={e}'.format(method=method, src=src, target=target, e=e)
+        )
+        # remove an empty/partial target
+        if method != LOCAL_COPY_METHOD_HARDLINK and os.path.isfile(target):
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+        return False
@@ -0,0 +1,216 @@
+"""CrooManifest: manifest of transferred files for resuming.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from autouri import AbsPath, AutoURI
+
+logger = logging.getLogger(__name__)
+
+
+class CrooManifest:
+    """Manifest of completed transfer jobs written as JSON lines.
+    Each line is written (and flushed) as soon as a job is done so that
+    the manifest is valid even if croo dies halfway.
+
+    Each entry has:
+        src: source URI.
+        target: target URI defined in output definition JSON.
+        target_uri: actual URI of a transferred file.
+            It can be the same as source if source is just referenced.
+        method: soft_link, hard_link, copy or reference.
+        size, mtime, md5: metadata of source. md5 can be None.
+        timestamp: time when the job is done (seconds since epoch).
+
+    A manifest for a remote out_dir is written on a LOCAL file first and
+    uploaded periodically (every UPLOAD_EVERY entries or UPLOAD_INTERVAL
+    seconds) and on close() so that a remote manifest is never far behind.
+    """
+
+    MANIFEST_FILE = 'croo.manifest.{workflow_id}.jsonl'
+    METHOD_SOFT_LINK = 'soft_link'
+    METHOD_HARD_LINK = 'hard_link'
+    METHOD_COPY = 'copy'
+    METHOD_REFERENCE = 'reference'
+    UPLOAD_EVERY = 1000
+    UPLOAD_INTERVAL = 60.0
+    REMOTE_MANIFEST_EXT = '.remote'
+
+    def __init__(self, manifest_file, resume=False, read_only=False, upload_uri=None):
+        """
+        Args:
+            manifest_file:
+                LOCAL manifest file.
+            resume:
+                Load entries from an existing manifest file and append to it.
+                Otherwise, start a new manifest file.
+            read_only:
+                Only load entries. Nothing is written to manifest file.
+            upload_uri:
+                Remote URI where manifest file is uploaded.
+                For resuming, a manifest on it is merged with a local one
+                (e.g. partially uploaded one and a newer local one left by
+                a previous run on the same tmp_dir).
+                An entry with a newer timestamp wins.
+        """
+        self._manifest_file = manifest_file
+        self._upload_uri = upload_uri
+        # { (src, target): entry }
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._upload_lock = threading.Lock()
+        self._num_entries_not_uploaded = 0
+        self._last_upload_time = time.time()
+
+        merged = False
+        if resume:
+            if upload_uri is not None and AutoURI(upload_uri).exists:
+                remote_manifest_file = manifest_file + CrooManifest.REMOTE_MANIFEST_EXT
+                AutoURI(upload_uri).cp(remote_manifest_file, no_lock=True)
+                self.__load(remote_manifest_file)
+                os.remove(remote_manifest_file)
+                merged = True
+            if os.path.exists(manifest_file):
+                self.__load(manifest_file)
+            logger.info(
+                'Loaded manifest for resuming. num_entries={n}, f={f}'.format(
+                    n=len(self._entries), f=manifest_file
+                )
+            )
+
+        if read_only:
+            self._fp = None
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+            if merged:
+                # rewrite local manifest with merged entries
+                # since it is uploaded to overwrite remote one
+                self._fp = open(manifest_file, 'w')
+                for entry in self._entries.values():
+                    self._fp.write(json.dumps(entry) + '\n')
+                self._fp.flush()
+            else:
+                self._fp = open(manifest_file, 'a' if resume else 'w')
+
+    @property
+    def manifest_file(self):
+        return self._manifest_file
+
+    def close(self):
+        with self._lock:
+            if self._fp is None:
+                return
+            self._fp.close()
+            self._fp = None
+        self.upload()
+
+    def upload(self):
+        """Upload manifest file to upload_uri if defined.
+        """
+        if self._upload_uri is None:
+            return
+        with self._upload_lock:
+            with self._lock:
+                self._num_entries_not_uploaded = 0
+                self._last_upload_time = time.time()
+            AutoURI(self._manifest_file).cp(self._upload_uri, no_lock=True)
+        logger.debug(
+            'Uploaded manifest. f={f}, uri={uri}'.format(
+                f=self._manifest_file, uri=self._upload_uri
+            )
+        )
+
+    def add(self, src, target, target_uri, method, m_src=None):
+        """Add an entry for a completed job.
+
+        Args:
+            m_src:
+                autouri's metadata of source. Tuple of (exists, mtime, size, md5).
+        """
+        entry = {
+            'src': src,
+            'target': target,
+            'target_uri': target_uri,
+            'method': method,
+            'size': m_src.size if m_src else None,
+            'mtime': m_src.mtime if m_src else None,
+            'md5': m_src.md5 if m_src else None,
+            'timestamp': time.time(),
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            if self._fp is None:
+                raise ValueError('Cannot add an entry to a read-only manifest.')
+            self._entries[(src, target)] = entry
+            self._fp.write(line)
+            self._fp.flush()
+            self._num_entries_not_uploaded += 1
+            upload = self._upload_uri is not None and (
+                self._num_entries_not_uploaded >= CrooManifest.UPLOAD_EVERY
+                or time.time() - self._last_upload_time >= CrooManifest.UPLOAD_INTERVAL
+            )
+        # don't wait for another thread uploading it
+        if upload and not self._upload_lock.locked():
+            self.upload()
+
+    def __load(self, manifest_file):
+        """Load entries from a manifest file.
+        An entry with a newer timestamp wins if entries for the same job exist.
+        """
+        with open(manifest_file) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written last line
+                    continue
+                key = (entry['src'], entry['target'])
+                old = self._entries.get(key)
+                if old is None or old['timestamp'] <= entry['timestamp']:
+                    self._entries[key] = entry
+
+    def find_valid_entry(self, src, target, thread_id=-1):
+        """Find a completed entry for a job which is still valid.
+        An entry is valid if source has not changed (same size and mtime)
+        and its transferred file (or link) still exists.
+
+        Returns:
+            entry dict. None if not found or not valid.
+        """
+        entry = self._entries.get((src, target))
+        if entry is None:
+            return None
+        if entry['method'] == CrooManifest.METHOD_REFERENCE:
+            return entry
+
+        m_src = AutoURI(src, thread_id=thread_id).get_metadata(skip_md5=True)
+        if (
+            not m_src.exists
+            or m_src.size != entry['size']
+            or m_src.mtime != entry['mtime']
+        ):
+            return None
+
+        target_uri = entry['target_uri']
+        if entry['method'] == CrooManifest.METHOD_SOFT_LINK:
+            if not os.path.islink(target_uri) or os.readlink(target_uri) != src:
+                return None
+            return entry
+
+        au_target = AutoURI(target_uri, thread_id=thread_id)
+        if isinstance(au_target, AbsPath):
+            if not os.path.isfile(target_uri):
+                return None
+            size = os.path.getsize(target_uri)
+        else:
+            m_target = au_target.get_metadata(skip_md5=True)
+            if not m_target.exists:
+                return None
+            size = m_target.size
+        if size != entry['size']:
+            return None
+        return entry
@@ -0,0 +1,158 @@
+"""CrooProfiler: named spans for profiling croo's hot paths.
+"""
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from autouri import AutoURI
+
+logger = logging.getLogger(__name__)
+
+
+class CrooProfiler:
+    """Record named spans (e.g. metadata parsing, DAG construction, transfers)
+    as Chrome trace events (complete events with "ph": "X").
+    A trace file can be opened on chrome://tracing, Perfetto UI or speedscope
+    as a flame chart with a row for each thread.
+
+    Each span has peak memory usage (max RSS) at its end and
+    how much the span increased it, so a phase that raised peak memory can be
+    found. A summary for each span name (count, total seconds and max RSS)
+    is stored as "otherData" in a trace file.
+
+    Profiling is global and disabled by default.
+    span() is a no-op if it's not enabled.
+    enable() and disable() are counted so that profiling stays enabled
+    until all users (e.g. Croo objects) disable it.
+    Recorded spans are cleared when the last user disables it.
+    """
+
+    TRACE_FILE = 'croo.profile.{workflow_id}.json'
+
+    _enabled = False
+    _num_enabled = 0
+    _lock = threading.Lock()
+    _events = []
+    _start = 0.0
+
+    @staticmethod
+    def enable():
+        """Enable profiling.
+        Spans recorded for other users are kept.
+        """
+        with CrooProfiler._lock:
+            if CrooProfiler._num_enabled == 0:
+                CrooProfiler._events = []
+                CrooProfiler._start = time.perf_counter()
+            CrooProfiler._num_enabled += 1
+            CrooProfiler._enabled = True
+
+    @staticmethod
+    def disable():
+        """Disable profiling if there are no other users
+        and then clear all recorded spans.
+        """
+        with CrooProfiler._lock:
+            CrooProfiler._num_enabled = max(CrooProfiler._num_enabled - 1, 0)
+            if CrooProfiler._num_enabled == 0:
+                CrooProfiler._enabled = False
+                CrooProfiler._events = []
+
+    @staticmethod
+    def is_enabled():
+        return CrooProfiler._enabled
+
+    @staticmethod
+    @contextmanager
+    def span(name, **args):
+        """Record a span.
+
+        Args:
+            args:
+                Extra information to be shown for a span (e.g. file name).
+        """
+        if not CrooProfiler._enabled:
+            yield
+            return
+
+        max_rss_start = CrooProfiler.__get_max_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            max_rss_end = CrooProfiler.__get_max_rss_mb()
+            args['max_rss_mb'] = max_rss_end
+            args['max_rss_increase_mb'] = max_rss_end - max_rss_start
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': (start - CrooProfiler._start) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            }
+            with CrooProfiler._lock:
+                CrooProfiler._events.append(event)
+
+    @staticmethod
+    def get_summary():
+        """Summary for each span name.
+
+        Returns:
+            dict of { name: {'count', 'seconds', 'max_rss_mb', 'max_rss_increase_mb'} }
+            in order of first appearance.
+        """
+        summary = {}
+        with CrooProfiler._lock:
+            events = list(CrooProfiler._events)
+        for event in sorted(events, key=lambda e: e['ts']):
+            s = summary.setdefault(
+                event['name'],
+                {
+                    'count': 0,
+                    'seconds': 0.0,
+                    'max_rss_mb': 0.0,
+                    'max_rss_increase_mb': 0.0,
+                },
+            )
+            s['count'] += 1
+            s['seconds'] += event['dur'] / 1e6
+            s['max_rss_mb'] = max(s['max_rss_mb'], event['args']['max_rss_mb'])
+            s['max_rss_increase_mb'] = max(
+                s['max_rss_increase_mb'], event['args']['max_rss_increase_mb']
+            )
+        return summary
+
+    @staticmethod
+    def save(uri):
+        """Write all spans as a Chrome trace JSON file on uri.
+        """
+        with CrooProfiler._lock:
+            events = list(CrooProfiler._events)
+        summary = CrooProfiler.get_summary()
+        trace = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'phases': summary},
+        }
+        AutoURI(uri).write(json.dumps(trace), no_lock=True)
+
+        for name, s in summary.items():
+            logger.info(
+                'Profile: {name}: count={count}, {seconds:.3f} sec, '
+                'max RSS={max_rss_mb:.1f} MB (+{max_rss_increase_mb:.1f} MB)'.format(
+                    name=name, **s
+                )
+            )
+        logger.info('Profile trace file: {uri}'.format(uri=uri))
+
+    @staticmethod
+    def __get_max_rss_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
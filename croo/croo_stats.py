@@ -0,0 +1,213 @@
+"""CrooStats: performance metrics of a croo run.
+"""
+
+import heapq
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from autouri import AutoURI
+
+logger = logging.getLogger(__name__)
+
+
+class CrooStats:
+    """Collect timings of each phase (e.g. metadata parsing, transfers and
+    report rendering) and metrics of each transfer.
+    Thread-safe.
+
+    A transfer is recorded with its status:
+        transferred: file is copied or linked.
+        skipped_identical: target is identical to source (checksum).
+        skipped_manifest: job is already completed in manifest (resume).
+        failed: transfer failed.
+    """
+
+    STATS_FILE = 'croo.stats.{workflow_id}.json'
+    STATUS_TRANSFERRED = 'transferred'
+    STATUS_SKIPPED_IDENTICAL = 'skipped_identical'
+    STATUS_SKIPPED_MANIFEST = 'skipped_manifest'
+    STATUS_FAILED = 'failed'
+    DEFAULT_NUM_SLOWEST = 10
+
+    def __init__(self, num_slowest=DEFAULT_NUM_SLOWEST):
+        """
+        Args:
+            num_slowest:
+                Number of slowest transfers to be kept.
+        """
+        self._num_slowest = num_slowest
+        self._lock = threading.Lock()
+        # { phase: seconds } in order of phases
+        self._phases = {}
+        # { phase: MB } increase of resident memory (RSS) during a phase
+        self._rss_increase = {}
+        # { status: num_files }
+        self._num_files = {}
+        # { method: num_files } for transferred files
+        self._num_files_by_method = {}
+        # { 'SRC_BACKEND->TARGET_BACKEND': [num_files, bytes, seconds] }
+        self._backends = {}
+        self._bytes_transferred = 0
+        # files copied from another target of the same source
+        self._num_deduplicated_files = 0
+        self._bytes_saved = 0
+        # min-heap of (seconds, seq, transfer) for slowest transfers
+        self._slowest = []
+        self._seq = 0
+        self._tmp_cache = None
+
+    def add_phase_time(self, phase, seconds):
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        """Measure wall time of a phase. Time is accumulated
+        if the same phase is measured multiple times.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(phase, time.perf_counter() - start)
+
+    def add_rss_increase(self, phase, mb):
+        with self._lock:
+            self._rss_increase[phase] = self._rss_increase.get(phase, 0.0) + mb
+
+    @contextmanager
+    def memory(self, phase):
+        """Measure increase of resident memory (RSS) during a phase
+        (e.g. memory taken by a task graph built from metadata JSON).
+        Increase is accumulated if the same phase is measured multiple times.
+        Not measured if RSS is not available (/proc/self/statm on Linux).
+        """
+        start = CrooStats.__get_rss_mb()
+        try:
+            yield
+        finally:
+            end = CrooStats.__get_rss_mb()
+            if start is not None and end is not None:
+                self.add_rss_increase(phase, end - start)
+
+    def set_tmp_cache_stats(self, tmp_cache_stats):
+        """
+        Args:
+            tmp_cache_stats:
+                dict returned by CrooTmpCache.get_stats().
+        """
+        with self._lock:
+            self._tmp_cache = tmp_cache_stats
+
+    def add_deduplicated(self, size):
+        """Add a file copied (or hard-linked) from another target of the
+        same source instead of being transferred from source again.
+
+        Args:
+            size:
+                Number of bytes not transferred from source.
+        """
+        with self._lock:
+            self._num_deduplicated_files += 1
+            self._bytes_saved += size
+
+    def add_transfer(
+        self, src, target, src_backend, target_backend, method, status, size, seconds
+    ):
+        """
+        Args:
+            method:
+                One of CrooManifest.METHOD_*. None if failed.
+            status:
+                One of STATUS_*.
+            size:
+                Number of bytes actually moved to target.
+                0 for links and skipped transfers.
+        """
+        transfer = {
+            'src': src,
+            'target': target,
+            'method': method,
+            'status': status,
+            'size': size,
+            'seconds': seconds,
+        }
+        backends = '{src}->{target}'.format(src=src_backend, target=target_backend)
+        with self._lock:
+            self._num_files[status] = self._num_files.get(status, 0) + 1
+            if status == CrooStats.STATUS_TRANSFERRED:
+                self._num_files_by_method[method] = (
+                    self._num_files_by_method.get(method, 0) + 1
+                )
+                b = self._backends.setdefault(backends, [0, 0, 0.0])
+                b[0] += 1
+                b[1] += size
+                b[2] += seconds
+                self._bytes_transferred += size
+
+            self._seq += 1
+            item = (seconds, self._seq, transfer)
+            if len(self._slowest) < self._num_slowest:
+                heapq.heappush(self._slowest, item)
+            elif self._num_slowest:
+                heapq.heappushpop(self._slowest, item)
+
+    def to_dict(self):
+        with self._lock:
+            transfer_time = self._phases.get('transfer')
+            return {
+                'phases': dict(self._phases),
+                'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 1024,
+                'rss_increase_mb': dict(self._rss_increase),
+                'num_files': dict(self._num_files),
+                'num_files_by_method': dict(self._num_files_by_method),
+                'bytes_transferred': self._bytes_transferred,
+                'num_deduplicated_files': self._num_deduplicated_files,
+                'bytes_saved': self._bytes_saved,
+                'throughput_mb_per_sec': CrooStats.__mb_per_sec(
+                    self._bytes_transferred, transfer_time
+                ),
+                'backends': {
+                    backends: {
+                        'num_files': num_files,
+                        'bytes': size,
+                        'seconds': seconds,
+                        'mb_per_sec_per_file': CrooStats.__mb_per_sec(size, seconds),
+                    }
+                    for backends, (num_files, size, seconds) in self._backends.items()
+                },
+                'tmp_cache': self._tmp_cache,
+                'slowest_transfers': [
+                    transfer
+                    for _, _, transfer in sorted(
+                        self._slowest, key=lambda x: x[0], reverse=True
+                    )
+                ],
+            }
+
+    def save(self, uri):
+        """Write stats as JSON on uri.
+        """
+        AutoURI(uri).write(json.dumps(self.to_dict(), indent=4), no_lock=True)
+        logger.info('Stats JSON file: {uri}'.format(uri=uri))
+
+    @staticmethod
+    def __get_rss_mb():
+        try:
+            with open('/proc/self/statm') as fp:
+                num_pages = int(fp.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return None
+        return num_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+    @staticmethod
+    def __mb_per_sec(size, seconds):
+        if not seconds:
+            return None
+        return size / seconds / (1024 * 1024)
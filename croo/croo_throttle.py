@@ -0,0 +1,200 @@
+"""CrooThrottle: per-storage limits on concurrency and bandwidth for transfers.
+"""
+
+import errno
+import threading
+import time
+
+from autouri import GCSURI, S3URI, AbsPath, HTTPURL
+
+BACKEND_LOCAL = 'local'
+BACKEND_GCS = 'gs'
+BACKEND_S3 = 's3'
+BACKEND_HTTP = 'http'
+BACKENDS = (BACKEND_LOCAL, BACKEND_GCS, BACKEND_S3, BACKEND_HTTP)
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+
+TRANSIENT_HTTP_STATUS_CODES = frozenset((408, 429, 500, 502, 503, 504))
+TRANSIENT_ERRNOS = frozenset(
+    (
+        errno.EAGAIN,
+        errno.EBUSY,
+        errno.EINTR,
+        errno.ETIMEDOUT,
+        errno.ECONNRESET,
+        errno.ECONNREFUSED,
+        errno.ECONNABORTED,
+        errno.EPIPE,
+        errno.ESTALE,
+    )
+)
+TRANSIENT_S3_ERROR_CODES = frozenset(
+    (
+        'RequestTimeout',
+        'RequestTimeTooSkewed',
+        'SlowDown',
+        'Throttling',
+        'ThrottlingException',
+        'InternalError',
+        'ServiceUnavailable',
+    )
+)
+
+
+def get_backend(au):
+    """Get a backend name (one of BACKENDS) of AutoURI object.
+    None if unknown.
+    """
+    if isinstance(au, AbsPath):
+        return BACKEND_LOCAL
+    if isinstance(au, GCSURI):
+        return BACKEND_GCS
+    if isinstance(au, S3URI):
+        return BACKEND_S3
+    if isinstance(au, HTTPURL):
+        return BACKEND_HTTP
+    return None
+
+
+def is_transient_error(e):
+    """Check if an error raised in a transfer is transient and worth retrying:
+    connection errors, time-outs, throttling and server-side errors (HTTP 5xx)
+    on any storage and temporary OS errors (e.g. stale NFS file handle).
+
+    Errors from storage client libraries (requests, google-cloud-storage, boto3)
+    are identified by their attributes so that those libraries are not imported here.
+    """
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    if isinstance(e, OSError) and e.errno in TRANSIENT_ERRNOS:
+        return True
+
+    # requests.exceptions.ConnectionError and Timeout
+    # are not subclasses of built-in ConnectionError
+    if type(e).__module__.startswith(('requests', 'urllib3')) and type(e).__name__ in (
+        'ConnectionError',
+        'Timeout',
+        'ReadTimeout',
+        'ConnectTimeout',
+    ):
+        return True
+    # requests.exceptions.HTTPError
+    response = getattr(e, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    if status_code in TRANSIENT_HTTP_STATUS_CODES:
+        return True
+    # google.api_core.exceptions.GoogleAPICallError
+    if type(e).__module__.startswith('google') and (
+        getattr(e, 'code', None) in TRANSIENT_HTTP_STATUS_CODES
+    ):
+        return True
+    # botocore.exceptions.ClientError
+    if isinstance(response, dict):
+        if response.get('Error', {}).get('Code') in TRANSIENT_S3_ERROR_CODES:
+            return True
+        if (
+            response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            in TRANSIENT_HTTP_STATUS_CODES
+        ):
+            return True
+    # botocore.exceptions.EndpointConnectionError, ConnectionClosedError, ...
+    if type(e).__module__.startswith('botocore') and type(e).__name__.endswith(
+        ('ConnectionError', 'ConnectionClosedError', 'TimeoutError')
+    ):
+        return True
+    return False
+
+
+class CrooThrottle:
+    """Limits on transfers from/to a storage backend.
+
+    Concurrency is limited with a semaphore.
+    Bandwidth is limited with a coarse token bucket on a whole file:
+    a transfer of N bytes is charged to the bucket once it is done and
+    the worker waits until the bucket has budget for it.
+    The first transfer is not delayed so that
+    the average rate is limited over multiple files but
+    a single large file is not throttled on the fly.
+    """
+
+    def __init__(self, max_concurrency=None, max_bytes_per_sec=None):
+        """
+        Args:
+            max_concurrency:
+                Maximum number of concurrent transfers. None for no limit.
+            max_bytes_per_sec:
+                Maximum average bytes per second. None for no limit.
+        """
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError('max_concurrency must be >= 1.')
+        if max_bytes_per_sec is not None and max_bytes_per_sec <= 0:
+            raise ValueError('max_bytes_per_sec must be > 0.')
+        self._max_bytes_per_sec = max_bytes_per_sec
+        self._semaphore = (
+            None
+            if max_concurrency is None
+            else threading.BoundedSemaphore(max_concurrency)
+        )
+        self._lock = threading.Lock()
+        # time when the bucket gets enough budget for the next transfer
+        self._next_time = 0.0
+
+    @property
+    def limits_bandwidth(self):
+        return self._max_bytes_per_sec is not None
+
+    def acquire(self):
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+
+    def release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def wait_for_bandwidth(self, num_bytes):
+        """Reserve budget for num_bytes and wait until it is available.
+
+        Returns:
+            Time (in seconds) waited.
+        """
+        if self._max_bytes_per_sec is None or not num_bytes:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + num_bytes / self._max_bytes_per_sec
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def make_throttles(max_concurrency=None, max_bytes_per_sec=None):
+    """Make throttles for backends.
+
+    Args:
+        max_concurrency:
+            dict of { backend: max_concurrency }
+        max_bytes_per_sec:
+            dict of { backend: max_bytes_per_sec }
+    Returns:
+        dict of { backend: CrooThrottle }
+    """
+    max_concurrency = max_concurrency or {}
+    max_bytes_per_sec = max_bytes_per_sec or {}
+    for backend in set(max_concurrency) | set(max_bytes_per_sec):
+        if backend not in BACKENDS:
+            raise ValueError(
+                'Unknown storage backend: {b}. Choose from {backends}.'.format(
+                    b=backend, backends=BACKENDS
+                )
+            )
+    return {
+        backend: CrooThrottle(
+            max_concurrency=max_concurrency.get(backend),
+            max_bytes_per_sec=max_bytes_per_sec.get(backend),
+        )
+        for backend in set(max_concurrency) | set(max_bytes_per_sec)
+    }
@@ -0,0 +1,305 @@
+"""CrooTmpCache: size-bounded LRU cache of files localized on tmp_dir.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from autouri import AbsPath, AutoURI
+
+from .croo_checksum_cache import CrooChecksumCache
+from .croo_manifest import CrooManifest
+
+logger = logging.getLogger(__name__)
+
+
+def is_same_or_sub_dir(d, parent):
+    """Check if a LOCAL directory d is parent itself or under it.
+    Remote URIs (e.g. gs://) are never under a LOCAL directory.
+    """
+    if '://' in d:
+        return False
+    d = os.path.realpath(os.path.expanduser(d))
+    parent = os.path.realpath(os.path.expanduser(parent))
+    return d == parent or d.startswith(os.path.join(parent, ''))
+
+
+class CrooTmpCache:
+    """Remote files (e.g. metadata JSON and out_def JSON) localized on
+    a LOCAL tmp_dir by autouri. A localized file is reused (hit) if
+    it has not changed on the source. Otherwise, it is downloaded (miss).
+
+    Access time of a file is updated explicitly on each access so that
+    LRU eviction works on a file system mounted with noatime/relatime.
+    Modification time is kept since autouri compares it with source's one.
+
+    If total size of files on tmp_dir exceeds max_size, least recently
+    accessed files are evicted. Files that are not caches are
+    never evicted and not counted (see EXCLUDED_PREFIXES).
+    Since everything else on tmp_dir is evicted, tmp_dir must not be
+    out_dir itself or its parent.
+
+    Files being localized (locked) or accessed within EVICT_GRACE_PERIOD
+    seconds are not evicted since they can be in use by another process.
+
+    Sizes of cached files are kept on memory and updated on each access.
+    tmp_dir is scanned only on the first eviction and when
+    total size on memory exceeds max_size. Files added by other processes
+    sharing tmp_dir are counted at next scan.
+
+    Use open() to read a localized file. Files are evicted after it is
+    opened so that it can be read even if it is evicted right after
+    (e.g. by another process sharing tmp_dir).
+
+    Thread-safe. tmp_dir can be shared among multiple processes.
+    """
+
+    # files/directories on top of tmp_dir that are not evicted:
+    # md5 checksum DB, manifests and split metadata JSON files of croo batch
+    EXCLUDED_PREFIXES = (
+        CrooChecksumCache.DB_FILE,
+        CrooManifest.MANIFEST_FILE.split('{')[0],
+        'croo_batch',
+    )
+
+    # number of retrials to localize a file evicted before it is opened
+    OPEN_MAX_RETRIES = 3
+
+    # files accessed within this (in seconds) are not evicted
+    EVICT_GRACE_PERIOD = 10.0
+
+    def __init__(self, tmp_dir, max_size=None, out_dir=None):
+        """
+        Args:
+            tmp_dir:
+                LOCAL temporary directory.
+            max_size:
+                Maximum total size (in bytes) of cached files on tmp_dir.
+                None for no limit.
+            out_dir:
+                Output directory. Checked against tmp_dir
+                so that outputs are not evicted.
+        """
+        if max_size is not None and max_size < 0:
+            raise ValueError('max_size must be >= 0.')
+        if (
+            max_size is not None
+            and out_dir is not None
+            and is_same_or_sub_dir(out_dir, tmp_dir)
+        ):
+            raise ValueError(
+                'Cannot limit size of tmp_dir which is out_dir itself or its parent. '
+                'tmp_dir={tmp_dir}, out_dir={out_dir}'.format(
+                    tmp_dir=tmp_dir, out_dir=out_dir
+                )
+            )
+        self._tmp_dir = tmp_dir
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_evicted_files = 0
+        self._evicted_bytes = 0
+        # { abs_path: size } of cached files. None if tmp_dir is not scanned yet
+        self._sizes = None
+        self._total_size = 0
+
+    def open(self, uri, mode='r', no_lock=False):
+        """Localize a file on tmp_dir and open it.
+        A local file is not localized.
+
+        Returns:
+            File object of localized file. Caller should close it.
+        """
+        for retry in range(CrooTmpCache.OPEN_MAX_RETRIES + 1):
+            f = self.localize(uri, no_lock=no_lock)
+            try:
+                fp = open(f, mode)
+                break
+            except FileNotFoundError:
+                # evicted by another process before it is opened
+                if retry == CrooTmpCache.OPEN_MAX_RETRIES:
+                    raise
+        self.evict(protected=(f,))
+        return fp
+
+    def localize(self, uri, no_lock=False):
+        """Localize a file on tmp_dir. A local file is not localized.
+        Files are not evicted here. See open().
+
+        Returns:
+            Path of localized file.
+        """
+        au = AutoURI(uri)
+        if isinstance(au, AbsPath):
+            return au.uri
+
+        loc_file = os.path.join(self._tmp_dir, au.loc_dirname, au.basename)
+        before = CrooTmpCache.__stat(loc_file)
+        f = au.localize_on(self._tmp_dir, no_lock=no_lock)
+        after = CrooTmpCache.__stat(f)
+        hit = (
+            f == loc_file
+            and before is not None
+            and after is not None
+            and (before.st_size, before.st_mtime_ns)
+            == (after.st_size, after.st_mtime_ns)
+        )
+        with self._lock:
+            if hit:
+                self._num_hits += 1
+            else:
+                self._num_misses += 1
+        logger.debug(
+            'tmp cache {hit}: {uri}'.format(hit='hit' if hit else 'miss', uri=uri)
+        )
+
+        self.touch(f)
+        return f
+
+    def touch(self, path):
+        """Update access time of a cached file.
+        """
+        try:
+            st = os.stat(path)
+            os.utime(path, ns=(int(time.time() * 1e9), st.st_mtime_ns))
+        except OSError:
+            return
+        # keep size of a cached file on memory
+        path = os.path.abspath(path)
+        tmp_dir = os.path.join(os.path.abspath(self._tmp_dir), '')
+        if not path.startswith(tmp_dir) or self.__is_excluded(path):
+            return
+        with self._lock:
+            if self._sizes is not None:
+                self._total_size += st.st_size - self._sizes.get(path, 0)
+                self._sizes[path] = st.st_size
+
+    def evict(self, protected=()):
+        """Evict least recently accessed files until total size of
+        cached files is within max_size.
+        Nothing is done without scanning tmp_dir if total size on memory
+        is within max_size.
+
+        Args:
+            protected:
+                Files not to be evicted (e.g. files just localized).
+        """
+        if self._max_size is None or not os.path.isdir(self._tmp_dir):
+            return
+        with self._lock:
+            if self._sizes is not None and self._total_size <= self._max_size:
+                return
+
+        # scan again since other processes sharing tmp_dir can add/evict files
+        files = self.__scan()
+        total_size = sum(size for _, size, _ in files)
+        if total_size <= self._max_size:
+            return
+
+        protected = {os.path.abspath(p) for p in protected}
+        accessed_before = int((time.time() - CrooTmpCache.EVICT_GRACE_PERIOD) * 1e9)
+        num_evicted_files = 0
+        evicted_bytes = 0
+        for atime, size, path in sorted(files):
+            if total_size <= self._max_size:
+                break
+            if atime > accessed_before:
+                # all remaining files are accessed within grace period
+                break
+            if path in protected or os.path.exists(path + AutoURI.LOCK_FILE_EXT):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # evicted by another process
+                pass
+            except OSError as e:
+                logger.warning(
+                    'Failed to evict a file from tmp cache. {f}, {e}'.format(
+                        f=path, e=e
+                    )
+                )
+                continue
+            else:
+                num_evicted_files += 1
+                evicted_bytes += size
+            total_size -= size
+            with self._lock:
+                self._total_size -= self._sizes.pop(path, 0)
+            self.__remove_empty_dirs(os.path.dirname(path))
+
+        with self._lock:
+            self._num_evicted_files += num_evicted_files
+            self._evicted_bytes += evicted_bytes
+        logger.info(
+            'Evicted {n} files ({b} bytes) from tmp cache. '
+            'size={size}, max_size={max_size}, tmp_dir={d}'.format(
+                n=num_evicted_files,
+                b=evicted_bytes,
+                size=total_size,
+                max_size=self._max_size,
+                d=self._tmp_dir,
+            )
+        )
+
+    def get_stats(self):
+        """Returns:
+        dict of hit/miss counts and eviction counts.
+        """
+        with self._lock:
+            return {
+                'num_hits': self._num_hits,
+                'num_misses': self._num_misses,
+                'num_evicted_files': self._num_evicted_files,
+                'evicted_bytes': self._evicted_bytes,
+                'max_size': self._max_size,
+            }
+
+    def __scan(self):
+        """Find all cached files on tmp_dir and keep their sizes on memory.
+
+        Returns:
+            List of (atime_ns, size, abs_path) of cached files.
+        """
+        files = []
+        for root, _, basenames in os.walk(os.path.abspath(self._tmp_dir)):
+            for basename in basenames:
+                path = os.path.join(root, basename)
+                if self.__is_excluded(path):
+                    continue
+                st = CrooTmpCache.__stat(path)
+                if st is None:
+                    continue
+                files.append((st.st_atime_ns, st.st_size, path))
+
+        with self._lock:
+            self._sizes = {path: size for _, size, path in files}
+            self._total_size = sum(self._sizes.values())
+        return files
+
+    def __is_excluded(self, path):
+        rel_path = os.path.relpath(path, self._tmp_dir)
+        if rel_path.split(os.sep)[0].startswith(CrooTmpCache.EXCLUDED_PREFIXES):
+            return True
+        # lock file can be held by another process
+        return path.endswith(AutoURI.LOCK_FILE_EXT)
+
+    def __remove_empty_dirs(self, d):
+        tmp_dir = os.path.abspath(self._tmp_dir)
+        d = os.path.abspath(d)
+        while d != tmp_dir and d.startswith(tmp_dir):
+            try:
+                os.rmdir(d)
+            except OSError:
+                # not empty
+                return
+            d = os.path.dirname(d)
+
+    @staticmethod
+    def __stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
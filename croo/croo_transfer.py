@@ -0,0 +1,928 @@
+"""CrooTransfer: file transfer scheduler for Croo.
+"""
+
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from autouri import GCSURI, S3URI, AbsPath, AutoURI
+
+from .croo_local_copy import (
+    LOCAL_COPY_METHOD_COPY,
+    LOCAL_COPY_METHOD_HARDLINK,
+    LOCAL_COPY_METHODS,
+    local_copy,
+)
+from .croo_manifest import CrooManifest
+from .croo_profiler import CrooProfiler
+from .croo_stats import CrooStats
+from .croo_throttle import get_backend, is_transient_error
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MULTIPART_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_MULTIPART_NUM_THREADS = 8
+
+
+def split_into_parts(size, part_size, max_num_parts=None):
+    """Split a file into parts for multipart upload.
+
+    Args:
+        part_size:
+            Size of each part. The last part can be smaller.
+        max_num_parts:
+            Maximum number of parts. part_size is increased
+            if file is too big to be split into this number of parts.
+    Returns:
+        List of tuples of (offset, size) for each part.
+    """
+    if max_num_parts is not None and part_size * max_num_parts < size:
+        part_size = -(-size // max_num_parts)
+    return [
+        (offset, min(part_size, size - offset)) for offset in range(0, size, part_size)
+    ] or [(0, 0)]
+
+
+class CrooTransfer:
+    """Collect file transfer jobs (source, target) first and
+    run them all at once on a bounded thread pool.
+
+    Each job makes a copy of source on target or a soft link if soft_link
+    (only if both source and target are local).
+    Otherwise source is just referenced and target is not used.
+    A local source can be hard-linked, reflinked (copy-on-write clone)
+    or copied with copy_file_range() on a local target instead of making
+    a plain copy. See local_copy_method.
+
+    Copying between two GCS buckets is done on the server side with
+    GCS's rewrite API. It never downloads an object on a local machine
+    and also works for a huge object and between different locations or
+    storage classes, which copy_blob() cannot do within a single request.
+    Copying between two S3 buckets is already done on the server side by autouri
+    (copy_object() or multipart copy for an object >= 5GB).
+
+    A local file larger than multipart_threshold is uploaded to
+    a cloud bucket in parts in parallel.
+    On GCS, parts are uploaded as temporary objects and then
+    composed into a target object (parallel composite upload).
+    Note that a composite object does not have an md5 hash (crc32c only).
+    On S3, it's a multipart upload with tunable part size and concurrency.
+
+    If the same source is copied to multiple targets then
+    source is copied only once to the first target and other targets are
+    copied from the first one. It is a hard link if both are local.
+    Otherwise it is a copy within the same storage (e.g. server-side copy on GCS).
+
+    Errors are collected for each job instead of being raised immediately
+    so that all other jobs can finish.
+    """
+
+    GCS_MAX_COMPOSE_COMPONENTS = 32
+    GCS_COMPOSITE_PART_NAME = '{path}.croo_part{i:02d}'
+    # thread IDs for clients of part upload threads start from this
+    # not to overlap with those of worker threads (0, 1, ...)
+    PART_THREAD_ID_OFFSET = 1000000
+
+    def __init__(
+        self,
+        num_threads=1,
+        soft_link=True,
+        no_checksum=False,
+        checksum_cache=None,
+        manifest=None,
+        local_copy_method=LOCAL_COPY_METHOD_COPY,
+        multipart_threshold=None,
+        multipart_part_size=DEFAULT_MULTIPART_PART_SIZE,
+        multipart_num_threads=DEFAULT_MULTIPART_NUM_THREADS,
+        throttles=None,
+        max_retries=0,
+        retry_delay=1.0,
+        stats=None,
+    ):
+        """
+        Args:
+            num_threads:
+                Number of threads for transfer.
+            soft_link:
+                Soft-link source to target instead of making a copy.
+                See Croo.__init__() for details.
+            no_checksum:
+                Always overwrite on target even if md5-identical files exist.
+            checksum_cache:
+                CrooChecksumCache object to look up md5 hashes of local files
+                before calculating them.
+            manifest:
+                CrooManifest object. Each completed job is written to it.
+                A job is skipped if it is already completed in manifest
+                (e.g. loaded from a previous run for resuming).
+            local_copy_method:
+                Method to copy a local source to a local target.
+                One of croo_local_copy.LOCAL_COPY_METHODS.
+                It falls back to a plain copy if the method fails
+                (e.g. source and target are on different devices).
+            multipart_threshold:
+                Upload a local file in parts in parallel to gs:// or s3://
+                if it's larger than this (in bytes).
+                None to use storage client's default
+                (single stream on GCS, boto3's default multipart upload on S3).
+            multipart_part_size:
+                Size of each part (in bytes).
+                It's increased if a file is too big for storage's
+                limit on the number of parts.
+            multipart_num_threads:
+                Number of threads to upload parts of a file.
+            throttles:
+                dict of { backend: CrooThrottle } to limit concurrency and
+                bandwidth of transfers from/to each backend
+                (one of croo_throttle.BACKENDS).
+                A transfer between two backends is limited by both.
+            max_retries:
+                Maximum number of retrials for a transfer failed with
+                a transient error (e.g. connection error, HTTP 429/5xx).
+            retry_delay:
+                Delay (in seconds) before the first retrial.
+                It is doubled for each retrial (exponential backoff with jitter).
+            stats:
+                CrooStats object. Each job is added to it.
+        """
+        if num_threads < 1:
+            raise ValueError('num_threads must be >= 1.')
+        if local_copy_method not in LOCAL_COPY_METHODS:
+            raise ValueError(
+                'Unsupported local copy method: {m}'.format(m=local_copy_method)
+            )
+        if multipart_part_size < 1 or multipart_num_threads < 1:
+            raise ValueError(
+                'multipart_part_size and multipart_num_threads must be >= 1.'
+            )
+        self._local_copy_method = local_copy_method
+        self._multipart_threshold = multipart_threshold
+        self._multipart_part_size = multipart_part_size
+        self._multipart_num_threads = multipart_num_threads
+        self._throttles = throttles or {}
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._stats = stats
+        self._num_threads = num_threads
+        self._soft_link = soft_link
+        self._no_checksum = no_checksum
+        self._checksum_cache = checksum_cache
+        self._manifest = manifest
+
+        # list of (src, target) for each job
+        self._jobs = []
+        # { target: job_id }
+        self._job_ids = {}
+        # results of each job after run()
+        self._target_uris = None
+        # result of plan()
+        self._plan = None
+        self._errors = None
+        # bytes not transferred from source thanks to deduplication
+        self._bytes_saved = 0
+        self._bytes_saved_lock = threading.Lock()
+
+        # each worker thread gets its own thread ID for autouri
+        # so that storage clients are not shared among threads
+        self._thread_local = threading.local()
+        self._thread_id_lock = threading.Lock()
+        self._num_thread_ids = 0
+        # fixed pool of thread IDs for part upload threads.
+        # a part upload takes one and gives it back when done so that
+        # number of storage clients is bounded regardless of number of files
+        self._part_thread_ids = queue.Queue()
+        for i in range(num_threads * multipart_num_threads):
+            self._part_thread_ids.put(CrooTransfer.PART_THREAD_ID_OFFSET + i)
+
+    def add(self, src, target):
+        """Add a transfer job.
+        A job for the same target is added only once.
+        If a different source is added for the same target then
+        the last one wins as if jobs were run serially.
+
+        Returns:
+            Job ID (int). Job IDs are given in order of addition.
+        """
+        job_id = self._job_ids.get(target)
+        if job_id is not None:
+            if self._jobs[job_id][0] != src:
+                logger.warning(
+                    'Different files are transferred to the same target. '
+                    'Taking the last one. target={target}, src1={src1}, '
+                    'src2={src2}'.format(
+                        target=target, src1=self._jobs[job_id][0], src2=src
+                    )
+                )
+                self._jobs[job_id] = (src, target)
+            return job_id
+        job_id = len(self._jobs)
+        self._jobs.append((src, target))
+        self._job_ids[target] = job_id
+        return job_id
+
+    @property
+    def num_jobs(self):
+        return len(self._jobs)
+
+    @property
+    def bytes_saved(self):
+        """Bytes not transferred from sources thanks to deduplication.
+        """
+        return self._bytes_saved
+
+    def run(self):
+        """Run all jobs on a thread pool and wait for them to finish.
+
+        Returns:
+            Number of failed jobs.
+        """
+        self._target_uris = [None] * len(self._jobs)
+        self._errors = [None] * len(self._jobs)
+        self._bytes_saved = 0
+
+        groups = self.__group_jobs()
+        # exceptions are caught in each job
+        self.__map_groups(self.__run_group, groups)
+
+        num_failed = len(self._jobs) - self._errors.count(None)
+        logger.info(
+            'Transfer done. num_jobs={num_jobs}, num_failed={num_failed}, '
+            'num_unique_sources={num_srcs}, bytes_saved={bytes_saved}'.format(
+                num_jobs=len(self._jobs),
+                num_failed=num_failed,
+                num_srcs=len(groups),
+                bytes_saved=self._bytes_saved,
+            )
+        )
+        return num_failed
+
+    def plan(self, check_storage=False):
+        """Plan all jobs without transferring files.
+
+        Args:
+            check_storage:
+                Read metadata of sources and targets to get file sizes and
+                to check if a job will be skipped (identical target already exists
+                or completed in manifest). Nothing is written on storages.
+                md5 hashes of local files can be calculated for checking.
+                Otherwise, storages are not accessed at all.
+
+        Returns:
+            List of dict for each job in order of job IDs:
+                src, target: source and target.
+                method: soft_link, hard_link, copy or reference.
+                    A job copying a source already copied by another job is
+                    a hard link (if possible) or a copy from another job's target.
+                src_storage, target_storage: class names of autouri storages.
+                size: size of source. None if not check_storage.
+                skip: job will be skipped. None if not check_storage.
+        """
+        self._plan = [None] * len(self._jobs)
+        self.__map_groups(
+            lambda group: self.__plan_group(group, check_storage),
+            self.__group_jobs(),
+        )
+        return self._plan
+
+    def get_target_uri(self, job_id):
+        """Get target URI of a finished job.
+        It can be source itself if it is just referenced.
+        None if the job failed.
+        """
+        return self._target_uris[job_id]
+
+    def get_error(self, job_id):
+        """Get an exception raised in a job. None if the job succeeded.
+        """
+        return self._errors[job_id]
+
+    def get_errors(self):
+        """Get all errors.
+
+        Returns:
+            [(src, target, exception)] in order of job IDs.
+        """
+        return [
+            (src, target, e)
+            for (src, target), e in zip(self._jobs, self._errors)
+            if e is not None
+        ]
+
+    def __get_thread_id(self):
+        thread_id = getattr(self._thread_local, 'thread_id', None)
+        if thread_id is None:
+            with self._thread_id_lock:
+                thread_id = self._num_thread_ids
+                self._num_thread_ids += 1
+            self._thread_local.thread_id = thread_id
+        return thread_id
+
+    def __group_jobs(self):
+        """Group jobs with the same source. No need to dedup soft-linking.
+
+        Returns:
+            List of lists of job IDs.
+        """
+        if self._soft_link:
+            return [[job_id] for job_id in range(len(self._jobs))]
+        groups_by_src = OrderedDict()
+        for job_id, (src, _) in enumerate(self._jobs):
+            groups_by_src.setdefault(src, []).append(job_id)
+        return list(groups_by_src.values())
+
+    def __map_groups(self, fnc_group, groups):
+        """Call fnc_group(group) for each group on a thread pool.
+        """
+        if self._num_threads == 1:
+            for group in groups:
+                fnc_group(group)
+        else:
+            with ThreadPoolExecutor(max_workers=self._num_threads) as executor:
+                list(executor.map(fnc_group, groups))
+
+    def __run_group(self, group):
+        """Run jobs with the same source.
+        Source is transferred for the first job only and
+        other jobs copy from the first job's target.
+        """
+        thread_id = self.__get_thread_id()
+        first_job_id = group[0]
+        m_src = self.__run_job(first_job_id, thread_id)
+        if len(group) == 1:
+            return
+
+        first_target_uri = self._target_uris[first_job_id]
+        size = None
+        for job_id in group[1:]:
+            if first_target_uri is None:
+                self._errors[job_id] = self._errors[first_job_id]
+                continue
+            self.__run_job(job_id, thread_id, src=first_target_uri, m_src=m_src)
+            if self._errors[job_id] is None:
+                if size is None:
+                    if m_src is not None and m_src.size is not None:
+                        size = m_src.size
+                    else:
+                        size = AutoURI(first_target_uri, thread_id=thread_id).size
+                with self._bytes_saved_lock:
+                    self._bytes_saved += size
+                if self._stats is not None:
+                    self._stats.add_deduplicated(size)
+
+    def __plan_group(self, group, check_storage):
+        thread_id = self.__get_thread_id()
+        first_target = self._jobs[group[0]][1]
+        size = None
+        for i, job_id in enumerate(group):
+            src, target = self._jobs[job_id]
+            au = AutoURI(src, thread_id=thread_id)
+            au_target = AutoURI(target, thread_id=thread_id)
+
+            if self._soft_link:
+                if isinstance(au, AbsPath) and isinstance(au_target, AbsPath):
+                    method = CrooManifest.METHOD_SOFT_LINK
+                else:
+                    method = CrooManifest.METHOD_REFERENCE
+            elif (
+                i > 0 and isinstance(au_target, AbsPath) and os.path.isabs(first_target)
+            ) or (
+                self._local_copy_method == LOCAL_COPY_METHOD_HARDLINK
+                and isinstance(au, AbsPath)
+                and isinstance(au_target, AbsPath)
+            ):
+                method = CrooManifest.METHOD_HARD_LINK
+            else:
+                method = CrooManifest.METHOD_COPY
+
+            skip = None
+            if check_storage:
+                skip = False
+                if self._manifest is not None:
+                    entry = self._manifest.find_valid_entry(
+                        src, target, thread_id=thread_id
+                    )
+                    skip = entry is not None
+                if method != CrooManifest.METHOD_REFERENCE and size is None:
+                    size = self.__get_metadata(au, skip_md5=True).size
+                if not skip and i == 0 and not self._soft_link:
+                    if not self._no_checksum:
+                        skip, _ = self.__check_identical(
+                            au, au_target, make_md5_file=False
+                        )
+
+            self._plan[job_id] = {
+                'src': src,
+                'target': target,
+                'method': method,
+                'src_storage': type(au).__name__,
+                'target_storage': type(au_target).__name__,
+                'size': size,
+                'skip': skip,
+            }
+
+    def __run_job(self, job_id, thread_id, src=None, m_src=None):
+        """
+        Args:
+            src:
+                Copy from this (a target of another job) instead of job's source.
+                Hard-link it if possible.
+            m_src:
+                Metadata of job's source retrieved by another job
+                with the same source (i.e. src's job).
+                md5 hash in it is written as an md5 file for a local target.
+
+        Returns:
+            Metadata of job's source if retrieved. Otherwise None.
+        """
+        job_src, target = self._jobs[job_id]
+        start = time.perf_counter()
+        with CrooProfiler.span('transfer_job', src=job_src):
+            try:
+                if self._manifest is not None:
+                    entry = self._manifest.find_valid_entry(
+                        job_src, target, thread_id=thread_id
+                    )
+                    if entry is not None:
+                        logger.info(
+                            'Skipped transfer completed in manifest. '
+                            'src={src}, target={target}'.format(
+                                src=job_src, target=target
+                            )
+                        )
+                        self._target_uris[job_id] = entry['target_uri']
+                        self.__add_stats(
+                            job_src,
+                            target,
+                            thread_id,
+                            entry['method'],
+                            CrooStats.STATUS_SKIPPED_MANIFEST,
+                            start,
+                        )
+                        return None
+
+                if src is None:
+                    target_uri, method, m_src, identical = self.__transfer_with_retry(
+                        job_src, target, thread_id
+                    )
+                else:
+                    target_uri, method, _, identical = self.__transfer_with_retry(
+                        src,
+                        target,
+                        thread_id,
+                        hard_link=True,
+                        md5=None if m_src is None else m_src.md5,
+                    )
+                self._target_uris[job_id] = target_uri
+                if self._manifest is not None:
+                    if method != CrooManifest.METHOD_REFERENCE and m_src is None:
+                        m_src = self.__get_metadata(
+                            AutoURI(job_src, thread_id=thread_id), skip_md5=True
+                        )
+                    self._manifest.add(job_src, target, target_uri, method, m_src)
+
+                if self._stats is not None:
+                    if identical:
+                        status = CrooStats.STATUS_SKIPPED_IDENTICAL
+                    else:
+                        status = CrooStats.STATUS_TRANSFERRED
+                    self.__add_stats(
+                        job_src,
+                        target,
+                        thread_id,
+                        method,
+                        status,
+                        start,
+                        m_src=m_src,
+                        copied_from=src,
+                        target_uri=target_uri,
+                    )
+                return m_src
+
+            except Exception as e:
+                logger.error(
+                    'Transfer failed. src={src}, target={target}, error={e}'.format(
+                        src=job_src, target=target, e=e
+                    )
+                )
+                self._errors[job_id] = e
+                self.__add_stats(
+                    job_src, target, thread_id, None, CrooStats.STATUS_FAILED, start
+                )
+                return None
+
+    def __add_stats(
+        self,
+        src,
+        target,
+        thread_id,
+        method,
+        status,
+        start,
+        m_src=None,
+        copied_from=None,
+        target_uri=None,
+    ):
+        """Add a transfer to stats.
+        Size is counted for a copy only (i.e. bytes actually moved).
+        Storages are not accessed only for stats: size is taken from
+        source metadata already retrieved for the transfer or
+        a local target. Otherwise, it is not counted.
+
+        Args:
+            start:
+                Time when a job started (time.perf_counter()).
+            copied_from:
+                Copied from this (a target of another job) instead of source.
+            target_uri:
+                Actual URI of a transferred file.
+        """
+        if self._stats is None:
+            return
+        seconds = time.perf_counter() - start
+        au = AutoURI(copied_from or src, thread_id=thread_id)
+        size = 0
+        if (
+            status == CrooStats.STATUS_TRANSFERRED
+            and method == CrooManifest.METHOD_COPY
+        ):
+            if m_src is not None and m_src.size is not None:
+                size = m_src.size
+            elif target_uri is not None and isinstance(AutoURI(target_uri), AbsPath):
+                try:
+                    size = os.path.getsize(target_uri)
+                except OSError:
+                    pass
+        self._stats.add_transfer(
+            src,
+            target,
+            get_backend(au),
+            get_backend(AutoURI(target)),
+            method,
+            status,
+            size,
+            seconds,
+        )
+
+    def __transfer_with_retry(self, src, target, thread_id, hard_link=False, md5=None):
+        """Transfer with throttles and retry on transient errors.
+        """
+        retry = 0
+        while True:
+            try:
+                with self.__throttle(src, target, thread_id):
+                    result = self.__transfer(src, target, thread_id, hard_link, md5)
+                break
+            except Exception as e:
+                if retry >= self._max_retries or not is_transient_error(e):
+                    raise
+                delay = self._retry_delay * (2**retry) * random.uniform(0.5, 1.0)
+                retry += 1
+                logger.warning(
+                    'Retrying transfer ({retry}/{max_retries}) in {delay:.1f} sec '
+                    'for a transient error. src={src}, target={target}, '
+                    'error={e}'.format(
+                        retry=retry,
+                        max_retries=self._max_retries,
+                        delay=delay,
+                        src=src,
+                        target=target,
+                        e=e,
+                    )
+                )
+                time.sleep(delay)
+
+        _, method, m_src, identical = result
+        if not identical and method == CrooManifest.METHOD_COPY:
+            self.__charge_bandwidth(src, target, thread_id, m_src)
+        return result
+
+    def __get_throttles(self, src, target, thread_id):
+        """Returns:
+        List of throttles for source and target backends in a fixed order.
+        """
+        backends = {
+            get_backend(AutoURI(src, thread_id=thread_id)),
+            get_backend(AutoURI(target, thread_id=thread_id)),
+        }
+        return [
+            self._throttles[backend]
+            for backend in sorted(b for b in backends if b in self._throttles)
+        ]
+
+    @contextmanager
+    def __throttle(self, src, target, thread_id):
+        """Hold concurrency slots of throttles for source and target backends.
+        Slots are acquired in a fixed order to avoid deadlocks.
+        """
+        acquired = []
+        try:
+            for t in self.__get_throttles(src, target, thread_id):
+                t.acquire()
+                acquired.append(t)
+            yield
+        finally:
+            for t in reversed(acquired):
+                t.release()
+
+    def __charge_bandwidth(self, src, target, thread_id, m_src=None):
+        """Charge bandwidth budget of throttles for a file actually copied
+        and wait until it is available before taking the next job.
+        This is called once for a successful transfer only so that
+        skipped files and failed attempts do not consume budget.
+        Concurrency slots are not held while waiting.
+        """
+        throttles = [
+            t
+            for t in self.__get_throttles(src, target, thread_id)
+            if t.limits_bandwidth
+        ]
+        if not throttles:
+            return
+        if m_src is not None and m_src.size is not None:
+            size = m_src.size
+        else:
+            size = self.__get_metadata(
+                AutoURI(src, thread_id=thread_id), skip_md5=True
+            ).size
+        for t in throttles:
+            wait = t.wait_for_bandwidth(size)
+            if wait > 0:
+                logger.debug(
+                    'Throttled transfer for {wait:.1f} sec. src={src}'.format(
+                        wait=wait, src=src
+                    )
+                )
+
+    def __transfer(self, src, target, thread_id, hard_link=False, md5=None):
+        """
+        Args:
+            md5:
+                md5 hash of src if known.
+                It is written as an md5 file for a local target.
+
+        Returns:
+            Tuple of (target_uri, method, metadata_of_source, identical):
+                method: one of CrooManifest.METHOD_*.
+                metadata_of_source: can be None if not retrieved.
+                identical: skipped since target is identical to source.
+        """
+        au = AutoURI(src, thread_id=thread_id)
+
+        if (
+            hard_link
+            and isinstance(au, AbsPath)
+            and isinstance(AutoURI(target), AbsPath)
+        ):
+            # make a copy instead if failed (e.g. different file systems)
+            if local_copy(src, target, LOCAL_COPY_METHOD_HARDLINK):
+                self.__make_md5_file(AutoURI(target), md5)
+                return target, CrooManifest.METHOD_HARD_LINK, None, False
+
+        if self._soft_link:
+            au_target = AutoURI(target)
+            if isinstance(au, AbsPath) and isinstance(au_target, AbsPath):
+                au.soft_link(target, force=True)
+                return target, CrooManifest.METHOD_SOFT_LINK, None, False
+            return src, CrooManifest.METHOD_REFERENCE, None, False
+
+        au_target = AutoURI(target, thread_id=thread_id)
+        if self._no_checksum:
+            m_src = None
+        else:
+            identical, m_src = self.__check_identical(au, au_target)
+            if identical:
+                logger.info(
+                    'Skipped copying identical file. src={src}, target={target}'.format(
+                        src=au.uri, target=au_target.uri
+                    )
+                )
+                return au_target.uri, CrooManifest.METHOD_COPY, m_src, True
+
+        method = CrooManifest.METHOD_COPY
+        if (
+            self._local_copy_method != LOCAL_COPY_METHOD_COPY
+            and isinstance(au, AbsPath)
+            and isinstance(au_target, AbsPath)
+            and local_copy(au.uri, au_target.uri, self._local_copy_method)
+        ):
+            target_uri = au_target.uri
+            if self._local_copy_method == LOCAL_COPY_METHOD_HARDLINK:
+                method = CrooManifest.METHOD_HARD_LINK
+        elif isinstance(au, GCSURI) and isinstance(au_target, GCSURI):
+            target_uri = self.__rewrite_gcs(au, au_target)
+        elif (
+            isinstance(au, AbsPath)
+            and isinstance(au_target, (GCSURI, S3URI))
+            and self._multipart_threshold is not None
+            and os.path.getsize(au.uri) > self._multipart_threshold
+        ):
+            if isinstance(au_target, GCSURI):
+                target_uri = self.__upload_gcs_composite(au, au_target)
+            else:
+                target_uri = self.__upload_s3_multipart(au, au_target)
+        else:
+            target_uri = au.cp(au_target, no_checksum=True, no_lock=True)
+
+        # md5 hash of a local copy is the same as source's
+        if md5 is None and m_src is not None:
+            md5 = m_src.md5
+        self.__make_md5_file(au_target, md5)
+        if (
+            self._checksum_cache is not None
+            and md5 is not None
+            and isinstance(au_target, AbsPath)
+        ):
+            m_target = au_target.get_metadata(skip_md5=True)
+            self._checksum_cache.put(au_target.uri, m_target.size, m_target.mtime, md5)
+        return target_uri, method, m_src, False
+
+    def __rewrite_gcs(self, au, au_target):
+        """Server-side copy between GCS buckets with rewrite tokens.
+        """
+        src_blob, _ = au.get_blob()
+        target_blob, _ = au_target.get_blob(new=True)
+        token, bytes_rewritten, total_bytes = target_blob.rewrite(src_blob)
+        while token is not None:
+            logger.debug(
+                'Rewriting on GCS. {bytes_rewritten}/{total_bytes} bytes, '
+                'src={src}, target={target}'.format(
+                    bytes_rewritten=bytes_rewritten,
+                    total_bytes=total_bytes,
+                    src=au.uri,
+                    target=au_target.uri,
+                )
+            )
+            token, bytes_rewritten, total_bytes = target_blob.rewrite(
+                src_blob, token=token
+            )
+        logger.info(
+            'Copied on GCS server side. src={src}, target={target}'.format(
+                src=au.uri, target=au_target.uri
+            )
+        )
+        return au_target.uri
+
+    def __upload_gcs_composite(self, au, au_target):
+        """Parallel composite upload of a local file to GCS.
+        Each part is uploaded as a temporary object next to target
+        on a separate thread (with a GCS client from a fixed pool) and then
+        all parts are composed into target with a single compose request.
+        """
+        parts = split_into_parts(
+            os.path.getsize(au.uri),
+            self._multipart_part_size,
+            max_num_parts=CrooTransfer.GCS_MAX_COMPOSE_COMPONENTS,
+        )
+        bucket, path = au_target.get_bucket_path()
+        part_names = [
+            CrooTransfer.GCS_COMPOSITE_PART_NAME.format(path=path, i=i)
+            for i in range(len(parts))
+        ]
+
+        def upload_part(i):
+            offset, size = parts[i]
+            thread_id = self._part_thread_ids.get()
+            try:
+                cl = GCSURI.get_gcs_client(thread_id)
+                blob = cl.bucket(bucket).blob(part_names[i])
+                with open(au.uri, 'rb') as fp:
+                    fp.seek(offset)
+                    blob.upload_from_file(fp, size=size)
+            finally:
+                self._part_thread_ids.put(thread_id)
+            return blob
+
+        target_blob, bucket_obj = au_target.get_blob(new=True)
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self._multipart_num_threads
+            ) as executor:
+                part_blobs = list(executor.map(upload_part, range(len(parts))))
+            target_blob.compose(
+                [bucket_obj.blob(part_name) for part_name in part_names]
+            )
+        finally:
+            for part_name in part_names:
+                try:
+                    bucket_obj.blob(part_name).delete()
+                except Exception:
+                    # part not uploaded
+                    pass
+        logger.info(
+            'Uploaded to GCS with parallel composite upload. num_parts={n}, '
+            'src={src}, target={target}'.format(
+                n=len(part_blobs), src=au.uri, target=au_target.uri
+            )
+        )
+        return au_target.uri
+
+    def __upload_s3_multipart(self, au, au_target):
+        """Multipart upload of a local file to S3.
+        boto3's managed upload uploads parts in parallel and
+        adjusts part size for S3's limit on the number of parts.
+        """
+        from boto3.s3.transfer import TransferConfig
+
+        config = TransferConfig(
+            multipart_threshold=self._multipart_threshold,
+            multipart_chunksize=self._multipart_part_size,
+            max_concurrency=self._multipart_num_threads,
+        )
+        bucket, path = au_target.get_bucket_path()
+        cl = S3URI.get_boto3_client(au_target.thread_id)
+        cl.upload_file(Filename=au.uri, Bucket=bucket, Key=path, Config=config)
+        logger.info(
+            'Uploaded to S3 with multipart upload. src={src}, target={target}'.format(
+                src=au.uri, target=au_target.uri
+            )
+        )
+        return au_target.uri
+
+    def __make_md5_file(self, au_target, md5):
+        """Write md5 hash of a local target as an md5 file next to it
+        as autouri's cp(make_md5_file=True) does.
+        autouri takes it instead of calculating md5 hash of target again.
+        """
+        if md5 is None or not isinstance(au_target, AbsPath):
+            return
+        au_target.md5_file_uri.write(md5, no_lock=True)
+
+    def __get_metadata(self, au, skip_md5=False):
+        """Get metadata of a file.
+        md5 hash of a local file is taken from checksum cache if available.
+        skip_md5 is ignored for other storages since md5 hash is
+        already in storage's metadata.
+
+        Args:
+            skip_md5:
+                Do not calculate md5 hash of a local file.
+                md5 hash is still taken from checksum cache or md5 file
+                if available.
+        """
+        if not isinstance(au, AbsPath):
+            return au.get_metadata()
+        if skip_md5:
+            m = au.get_metadata(skip_md5=True)
+            if not m.exists:
+                return m
+            md5 = None
+            if self._checksum_cache is not None:
+                md5 = self._checksum_cache.get(au.uri, m.size, m.mtime)
+            if md5 is None:
+                md5 = au.md5_from_file
+            return m._replace(md5=md5)
+        if self._checksum_cache is not None:
+            return self._checksum_cache.get_metadata(au)
+        return au.get_metadata()
+
+    def __check_identical(self, au, au_target, make_md5_file=True):
+        """Check if target is identical to source with the same criteria as
+        in autouri's cp(): md5 hashes match or
+        file names and sizes match and source is not newer than target.
+
+        Cheap criteria (name, size and mtime) are checked first and
+        md5 hash is calculated only if required.
+
+        md5 file is written for a local target if its md5 hash is calculated
+        as autouri's cp(make_md5_file=True) does and make_md5_file.
+
+        Returns:
+            Tuple of (identical, metadata_of_source)
+        """
+        m_src = self.__get_metadata(au, skip_md5=True)
+        m_target = self.__get_metadata(au_target, skip_md5=True)
+        if not m_target.exists:
+            return False, m_src
+
+        if (
+            au.basename == au_target.basename
+            and m_src.size is not None
+            and m_src.size == m_target.size
+            and m_src.mtime is not None
+            and m_target.mtime is not None
+            and m_src.mtime <= m_target.mtime
+        ):
+            return True, m_src
+
+        if (
+            m_src.size is not None
+            and m_target.size is not None
+            and m_src.size != m_target.size
+        ):
+            # md5 hashes can't match
+            return False, m_src
+
+        if m_src.md5 is None:
+            m_src = self.__get_metadata(au)
+        if m_target.md5 is None:
+            m_target = self.__get_metadata(au_target)
+            if make_md5_file:
+                self.__make_md5_file(au_target, m_target.md5)
+        identical = m_src.md5 is not None and m_src.md5 == m_target.md5
+        return identical, m_src
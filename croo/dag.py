@@ -24,6 +24,17 @@ class DAG(object):
                 so that node itself is not hashable
         nodes (optional):
             list of nodes to be added to graph.
+        fnc_keys_as_parent(n) (optional):
+            function to get an iterable of hashable keys that a node "n"
+            provides to its children (e.g. output file paths).
+        fnc_keys_as_child(n) (optional):
+            function to get an iterable of hashable keys that a node "n"
+            looks for in its parents (e.g. input file paths).
+            n1 is a parent of n2 if and only if
+            fnc_keys_as_parent(n1) and fnc_keys_as_child(n2) share any key.
+            If both key functions are defined then they are used to
+            link nodes through an index instead of calling fnc_is_parent
+            against all existing nodes. They should be consistent with fnc_is_parent.
 
     Member variables:
         self._nodes:
@@ -32,14 +43,33 @@ class DAG(object):
             { h: set([h_parent1, h_parent2, ...]) } where h = hash of a node.
         self._children:
             { h: set([h_parent1, h_parent2, ...]) } where h = hash of a node.
+        self._parent_key_index:
+            { key: set([h1, h2, ...]) } nodes providing a key to children.
+        self._child_key_index:
+            { key: set([h1, h2, ...]) } nodes looking for a key in parents.
+        self._secondary_indexes:
+            { name: (fnc_key, { key: { h: n } }) }
+            Secondary indexes to look up nodes by a key. See add_secondary_index().
     """
 
-    def __init__(self, fnc_is_parent, fnc_hash=None, nodes=None):
+    def __init__(
+        self,
+        fnc_is_parent,
+        fnc_hash=None,
+        nodes=None,
+        fnc_keys_as_parent=None,
+        fnc_keys_as_child=None,
+    ):
         self._fnc_is_parent = fnc_is_parent
         self._fnc_hash = fnc_hash
+        self._fnc_keys_as_parent = fnc_keys_as_parent
+        self._fnc_keys_as_child = fnc_keys_as_child
         self._nodes = {}
         self._parents = {}
         self._children = {}
+        self._parent_key_index = {}
+        self._child_key_index = {}
+        self._secondary_indexes = {}
         if nodes is not None:
             for n in nodes:
                 self.add_node(n)
@@ -49,9 +79,40 @@ class DAG(object):
         """Copy constructor for DAG.
         """
         return cls(
-            is_parent=dag._is_parent,
+            fnc_is_parent=dag._fnc_is_parent,
             fnc_hash=dag._fnc_hash,
-            nodes=copy.copy(dag._nodes),
+            nodes=list(dag._nodes.values()),
+            fnc_keys_as_parent=dag._fnc_keys_as_parent,
+            fnc_keys_as_child=dag._fnc_keys_as_child,
+        )
+
+    @classmethod
+    def from_nodes(
+        cls,
+        nodes,
+        fnc_is_parent,
+        fnc_hash=None,
+        fnc_keys_as_parent=None,
+        fnc_keys_as_child=None,
+    ):
+        """Construct a DAG from all nodes at once.
+        Links are made in a single pass. See add_nodes() for details.
+        """
+        dag = cls(
+            fnc_is_parent=fnc_is_parent,
+            fnc_hash=fnc_hash,
+            fnc_keys_as_parent=fnc_keys_as_parent,
+            fnc_keys_as_child=fnc_keys_as_child,
+        )
+        dag.add_nodes(nodes)
+        return dag
+
+    @property
+    def is_indexed(self):
+        """Whether nodes are linked through key index.
+        """
+        return (
+            self._fnc_keys_as_parent is not None and self._fnc_keys_as_child is not None
         )
 
     def __str__(self):
@@ -75,7 +136,14 @@ class DAG(object):
 
         return result
 
-    def to_dot(self, fnc_node_format, fnc_href=None, fnc_subgraph=None, template=None):
+    def to_dot(
+        self,
+        fnc_node_format,
+        fnc_href=None,
+        fnc_subgraph=None,
+        template=None,
+        transitive_reduction=False,
+    ):
         """Converts a DAG into a Graphviz dot string.
         IMPORTANT: ONLY FORMATTED NODES WILL BE SHOWN IN THE GRAPH.
 
@@ -97,6 +165,10 @@ class DAG(object):
                 key/val will be simply turned into key = val.
                 If val is None then key alone without " = ".
                 Refer to the function caper.dict_tool.dict_to_dot_str for details
+            transitive_reduction (optional):
+                Remove a link between two formatted nodes if the child
+                can be reached from the parent through other formatted nodes.
+                Graphviz renders a huge graph much faster with fewer links.
 
         This function does the followings:
         1) Make a fixed dot template "digraph D {}" first
@@ -138,7 +210,7 @@ class DAG(object):
         d = copy.deepcopy(template) if template is not None else {}
 
         formatted_nodes = []
-        for h, n in self._nodes.items():
+        for h, n in self.get_nodes():
             # wrap hash string
             quoted_h = '"' + str(h) + '"'
             format = fnc_node_format(n)
@@ -165,34 +237,101 @@ class DAG(object):
             quoted_h = '"' + str(h) + '"'
             d['{k} {v}'.format(k=quoted_h, v=format)] = None
 
-        # scan from root to leaf to find children
-        # among candidates in formatted_nodes only
-
-        def deepfind_child(h, candidates, depth=0):
-            """DFS to find any close children in candidates.
-            This doesn't visit the same branch if a child is found
-            but still visits other branches to find other close children
-            """
-            result = []
-            if h not in self._children:
-                return result
-            for h_child in self._children[h]:
-                if h_child in candidates:
-                    result.append(h_child)
-                else:
-                    result.extend(deepfind_child(h_child, candidates))
-            return result
+        # find nearest formatted descendants of each formatted node
+        # links between formatted nodes are made through hidden nodes
+        formatted = {h for h, _ in formatted_nodes}
+        children_in_formatted = self.__find_nearest_descendants(formatted)
+        if transitive_reduction:
+            children_in_formatted = self.__reduce_transitive(children_in_formatted)
 
         # construct a parent-to-child map within formatted_nodes
         for h, format in formatted_nodes:
             quoted_h = '"' + str(h) + '"'
-            children = deepfind_child(h, [i for i, _ in formatted_nodes])
-            for h_child in children:
+            for h_child in children_in_formatted[h]:
                 quoted_h_child = '"' + str(h_child) + '"'
                 d['{h1} -> {h2}'.format(h1=quoted_h, h2=quoted_h_child)] = None
 
         return dict_to_dot_str(d)
 
+    def __find_nearest_descendants(self, candidates):
+        """Find nearest descendants among candidates for each candidate.
+        A descendant is nearest if there is a path to it without
+        visiting any other candidate. Search does not go further once
+        a candidate is found on a branch.
+        Memoized on all visited nodes so that each node is visited once.
+
+        Args:
+            candidates:
+                set of hashes.
+        Returns:
+            { h: set([h_descendant1, ...]) } for each h in candidates.
+        """
+        memo = {}
+        for h_root in candidates:
+            stack = [h_root]
+            while stack:
+                h = stack[-1]
+                if h in memo:
+                    stack.pop()
+                    continue
+                children = self.get_children(h)
+                not_visited = [
+                    h_child
+                    for h_child in children
+                    if h_child not in candidates and h_child not in memo
+                ]
+                if not_visited:
+                    stack.extend(not_visited)
+                    continue
+                result = set()
+                for h_child in children:
+                    if h_child in candidates:
+                        result.add(h_child)
+                    else:
+                        result.update(memo[h_child])
+                memo[h] = result
+                stack.pop()
+
+        return {h: memo[h] for h in candidates}
+
+    @staticmethod
+    def __reduce_transitive(children):
+        """Transitive reduction of a DAG.
+
+        Args:
+            children:
+                { h: set([h_child1, ...]) } for all nodes in a DAG.
+        Returns:
+            { h: set([h_child1, ...]) } without a link to a child
+            which can be reached through another child.
+        """
+        # all descendants of each node (memoized)
+        reachable = {}
+        for h_root in children:
+            stack = [h_root]
+            while stack:
+                h = stack[-1]
+                if h in reachable:
+                    stack.pop()
+                    continue
+                not_visited = [h_ for h_ in children[h] if h_ not in reachable]
+                if not_visited:
+                    stack.extend(not_visited)
+                    continue
+                result = set(children[h])
+                for h_child in children[h]:
+                    result.update(reachable[h_child])
+                reachable[h] = result
+                stack.pop()
+
+        reduced = {}
+        for h, hs_child in children.items():
+            indirect = set()
+            for h_child in hs_child:
+                indirect.update(reachable[h_child])
+            reduced[h] = hs_child - indirect
+        return reduced
+
     def hash_node(self, n):
         if self._fnc_hash is None:
             return hash(n)
@@ -206,7 +345,7 @@ class DAG(object):
             [(h, n)] where h is a hash of a matched node n
         """
         result = []
-        for h, n in self._nodes.items():
+        for h, n in self.get_nodes():
             if fnc_cond(n):
                 result.append((h, n))
         return result
@@ -219,6 +358,64 @@ class DAG(object):
         """
         return self._nodes.items()
 
+    def get_parents(self, h):
+        """Get hashes of all parents of a node.
+        """
+        return self._parents.get(h, ())
+
+    def get_children(self, h):
+        """Get hashes of all children of a node.
+        """
+        return self._children.get(h, ())
+
+    def add_secondary_index(self, name, fnc_key):
+        """Add a secondary index to look up nodes by a key
+        instead of scanning all nodes with find_nodes().
+        Index is updated whenever a node is added/removed.
+
+        Args:
+            name:
+                Name of an index.
+            fnc_key(n):
+                function to get a hashable key of a node "n" for this index.
+                A node will not be indexed if it returns None.
+        """
+        index = {}
+        for h, n in self.get_nodes():
+            key = fnc_key(n)
+            if key is not None:
+                index.setdefault(key, {})[h] = n
+        self._secondary_indexes[name] = (fnc_key, index)
+
+    def find_nodes_by_secondary_index(self, name, key):
+        """Find a list of nodes by a key in a secondary index.
+
+        Returns:
+            [(h, n)] where h is a hash of a matched node n
+        """
+        _, index = self._secondary_indexes[name]
+        return list(index.get(key, {}).items())
+
+    def _update_secondary_indexes(self, h, n_old, n_new):
+        """Update all secondary indexes for a node.
+
+        Args:
+            h: hash of a node.
+            n_old: old node. None if a node is new.
+            n_new: new node. None if a node is removed.
+        """
+        for fnc_key, index in self._secondary_indexes.values():
+            key_old = None if n_old is None else fnc_key(n_old)
+            key_new = None if n_new is None else fnc_key(n_new)
+            if key_old is not None and key_old != key_new:
+                hs = index[key_old]
+                del hs[h]
+                if not hs:
+                    del index[key_old]
+            if key_new is not None:
+                # keep position of a node in index if key is not changed
+                index.setdefault(key_new, {})[h] = n_new
+
     def rm_node(self, h, recursive=False):
         """Remove a node based on hash.
 
@@ -226,54 +423,184 @@ class DAG(object):
             h: hash of a node.
             recursive: remove all children nodes recursively.
         """
+        if h in self._nodes:
+            self.__unlink_node(h)
+            self._update_secondary_indexes(h, self._nodes[h], None)
         self._nodes.pop(h, None)
         self._parents.pop(h, None)
         self._children.pop(h, None)
-        for _, v in self._parents.items():
-            if h in v:
-                v.remove(h)
-        for _, v in self._children.items():
-            if h in v:
-                v.remove(h)
 
     def add_node(self, n):
         """Add a node to graph.
+        If key functions are defined, then a node is linked to
+        existing nodes by looking up its own keys in the key index.
+        Otherwise, fnc_is_parent is checked against all existing nodes.
         """
         # get hash
         h = self.hash_node(n)
 
         if h in self._nodes:
-            # remove all links to n in parents graph
-            for h_ in self._parents:
-                if h == h_:
-                    continue
-                parents = self._parents[h_]
-                if h in parents:
-                    parents.remove(h)
-            # remove all links to n in children graph
-            for h_ in self._children:
+            # remove all links to n in parents/children graph
+            self.__unlink_node(h)
+
+        if self.is_indexed:
+            keys_as_parent = set(self._fnc_keys_as_parent(n))
+            keys_as_child = set(self._fnc_keys_as_child(n))
+
+            children = set()
+            for key in keys_as_parent:
+                children.update(self._child_key_index.get(key, ()))
+            parents = set()
+            for key in keys_as_child:
+                parents.update(self._parent_key_index.get(key, ()))
+            children.discard(h)
+            parents.discard(h)
+
+            if not parents.isdisjoint(children):
+                raise ValueError('Detected a cyclic link in DAG.')
+        else:
+            children = set()
+            parents = set()
+            for h_, n_ in self._nodes.items():
                 if h == h_:
                     continue
-                children = self._children[h_]
-                if h in children:
-                    children.remove(h)
+                p = self._fnc_is_parent(n, n_)
+                p_ = self._fnc_is_parent(n_, n)
+                if p and p_:
+                    raise ValueError('Detected a cyclic link in DAG.')
+                elif p:
+                    children.add(h_)
+                elif p_:
+                    parents.add(h_)
+
+        self._update_secondary_indexes(h, self._nodes.get(h), n)
+        self._nodes[h] = n
+        self._parents[h] = parents
+        self._children[h] = children
 
+        # update links in graph
+        for h_ in children:
+            self._parents[h_].add(h)
+        for h_ in parents:
+            self._children[h_].add(h)
+
+        if self.is_indexed:
+            for key in keys_as_parent:
+                self._parent_key_index.setdefault(key, set()).add(h)
+            for key in keys_as_child:
+                self._child_key_index.setdefault(key, set()).add(h)
+
+    def add_nodes(self, nodes):
+        """Add multiple nodes to graph at once.
+        All nodes are collected and added to key index first and then
+        all links are made by joining keys in a single pass.
+        It's much faster than calling add_node() for each node.
+
+        Node with an existing hash in graph replaces the old one as in add_node().
+        Raises ValueError if two different nodes in "nodes" have the same hash
+        or if any cyclic link is found after adding nodes.
+        """
+        new_nodes = self.__collect_nodes(nodes)
+
+        if not self.is_indexed:
+            for n in new_nodes.values():
+                self.add_node(n)
+            self.__check_acyclic()
+            return
+
+        # add all nodes to key index
+        new_keys = {}
+        for h, n in new_nodes.items():
+            if h in self._nodes:
+                self.__unlink_node(h)
+            else:
+                self._parents[h] = set()
+                self._children[h] = set()
+            self._update_secondary_indexes(h, self._nodes.get(h), n)
+            self._nodes[h] = n
+
+            keys_as_parent = set(self._fnc_keys_as_parent(n))
+            keys_as_child = set(self._fnc_keys_as_child(n))
+            for key in keys_as_parent:
+                self._parent_key_index.setdefault(key, set()).add(h)
+            for key in keys_as_child:
+                self._child_key_index.setdefault(key, set()).add(h)
+            new_keys[h] = (keys_as_parent, keys_as_child)
+
+        # join on keys to make links
+        for h, (keys_as_parent, keys_as_child) in new_keys.items():
+            parents = self._parents[h]
+            for key in keys_as_child:
+                for h_ in self._parent_key_index.get(key, ()):
+                    if h_ != h:
+                        parents.add(h_)
+                        self._children[h_].add(h)
+            # links from new nodes to existing children
+            # links among new nodes are already made above
+            children = self._children[h]
+            for key in keys_as_parent:
+                for h_ in self._child_key_index.get(key, ()):
+                    if h_ != h and h_ not in new_nodes:
+                        children.add(h_)
+                        self._parents[h_].add(h)
+
+        self.__check_acyclic()
+
+    def __collect_nodes(self, nodes):
+        """Collect nodes into a dict of {hash: node}.
+        Raises ValueError if two different nodes have the same hash.
+        """
+        new_nodes = {}
+        for n in nodes:
+            h = self.hash_node(n)
+            if h in new_nodes and new_nodes[h] != n:
+                raise ValueError(
+                    'Detected duplicate hash for different nodes in DAG. '
+                    'hash={h}, node1={n1}, node2={n2}'.format(
+                        h=h, n1=new_nodes[h], n2=n
+                    )
+                )
+            new_nodes[h] = n
+        return new_nodes
+
+    def __check_acyclic(self):
+        """Check if graph is acyclic by peeling off nodes without parents
+        (Kahn's algorithm). Raises ValueError if there is any cyclic link.
+        """
+        num_parents = {h: len(v) for h, v in self._parents.items()}
+        stack = [h for h, num in num_parents.items() if num == 0]
+        num_visited = 0
+        while stack:
+            h = stack.pop()
+            num_visited += 1
+            for h_child in self._children[h]:
+                num_parents[h_child] -= 1
+                if num_parents[h_child] == 0:
+                    stack.append(h_child)
+        if num_visited != len(self._nodes):
+            raise ValueError('Detected a cyclic link in DAG.')
+
+    def __unlink_node(self, h):
+        """Remove all links to an existing node and its keys from key index.
+        """
+        for h_ in self._parents.get(h, ()):
+            self._children[h_].discard(h)
+        for h_ in self._children.get(h, ()):
+            self._parents[h_].discard(h)
         self._parents[h] = set()
         self._children[h] = set()
-        self._nodes[h] = n
 
-        # update links in graph
-        for h_ in self._nodes:
-            if h == h_:
-                continue
-            n_ = self._nodes[h_]
-            p = self._fnc_is_parent(n, n_)
-            p_ = self._fnc_is_parent(n_, n)
-            if p and p_:
-                raise ValueError('Detected a cyclic link in DAG.')
-            elif p:
-                self._parents[h_].add(h)
-                self._children[h].add(h_)
-            elif p_:
-                self._parents[h].add(h_)
-                self._children[h_].add(h)
+        if self.is_indexed:
+            n = self._nodes[h]
+            for key in self._fnc_keys_as_parent(n):
+                hs = self._parent_key_index.get(key)
+                if hs is not None:
+                    hs.discard(h)
+                    if not hs:
+                        del self._parent_key_index[key]
+            for key in self._fnc_keys_as_child(n):
+                hs = self._child_key_index.get(key)
+                if hs is not None:
+                    hs.discard(h)
+                    if not hs:
+                        del self._child_key_index[key]
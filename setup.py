@@ -53,4 +53,5 @@ setuptools.setup(
         'Operating System :: POSIX :: Linux',
     ],
     install_requires=['autouri>=0.2.3', 'graphviz', 'miniwdl', 'caper'],
+    extras_require={'stream': ['ijson>=3.1']},
 )
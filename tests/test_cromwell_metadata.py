@@ -0,0 +1,129 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+from autouri import AutoURI
+
+from croo.cromwell_metadata import (
+    CromwellMetadata,
+    find_valid_uris_in_dict,
+    is_valid_uri,
+)
+from croo.cromwell_metadata_cache import CromwellMetadataCache
+
+
+@pytest.mark.parametrize(
+    's',
+    [
+        '/somewhere/here/there.txt',
+        'gs://bucket/a.txt',
+        's3://bucket/a.txt',
+        'http://server/a.txt',
+        'https://server/a.txt',
+        'relative/a.txt',
+        'sample1',
+        '~/a.txt',
+        'metadata.json',
+        'not_exists.tsv',
+        'ftp://server/a.txt',
+        '',
+    ],
+)
+def test_is_valid_uri(s):
+    assert is_valid_uri(s) == AutoURI(s).is_valid
+
+
+def test_find_valid_uris_in_dict():
+    d = {
+        'sample': 'sample1',
+        'fastqs': [['/in/0_R1.fastq', '/in/0_R2.fastq'], ['/in/1_R1.fastq']],
+        'struct': {'bam': 'gs://bucket/a.bam', 'n': 3, 'flags': [True, 'off']},
+        'ref': 's3://bucket/ref.fa',
+    }
+    assert find_valid_uris_in_dict(d) == [
+        ('fastqs', '/in/0_R1.fastq', (0, 0)),
+        ('fastqs', '/in/0_R2.fastq', (0, 1)),
+        ('fastqs', '/in/1_R1.fastq', (1, 0)),
+        ('struct.bam', 'gs://bucket/a.bam', (-1,)),
+        ('ref', 's3://bucket/ref.fa', (-1,)),
+    ]
+
+    # deeply nested struct should not hit recursion limit
+    nested = '/in/deep.txt'
+    for _ in range(5000):
+        nested = [nested]
+    ((_, uri, list_idx),) = find_valid_uris_in_dict({'deep': nested})
+    assert uri == '/in/deep.txt'
+    assert list_idx == (0,) * 5000
+
+
+@pytest.mark.parametrize(
+    'metadata_json_file',
+    ['data/subworkflow/metadata.json', 'data/nested_scatter/metadata.json'],
+)
+def test_from_stream(metadata_json_file):
+    pytest.importorskip('ijson')
+
+    metadata_json = json.loads(Path(metadata_json_file).read_text())
+    cm = CromwellMetadata(metadata_json)
+    with open(metadata_json_file, 'rb') as fp:
+        cm_stream = CromwellMetadata.from_stream(fp)
+
+    assert cm_stream.get_workflow_id() == cm.get_workflow_id()
+    assert cm_stream.get_out_def_json_file() == cm.get_out_def_json_file()
+    assert list(cm_stream.get_task_graph().get_nodes()) == list(
+        cm.get_task_graph().get_nodes()
+    )
+
+
+def test_from_stream_multiple_objects(tmp_path):
+    pytest.importorskip('ijson')
+
+    metadata_json = json.loads(Path('data/subworkflow/metadata.json').read_text())
+    metadata_json_file = tmp_path / 'metadata.json'
+    metadata_json_file.write_text(json.dumps([metadata_json, {'id': 'second'}]))
+
+    with open(str(metadata_json_file), 'rb') as fp:
+        cm_stream = CromwellMetadata.from_stream(fp)
+    assert cm_stream.get_workflow_id() == metadata_json['id']
+
+    metadata_json_file.write_text('[]')
+    with open(str(metadata_json_file), 'rb') as fp:
+        with pytest.raises(Exception):
+            CromwellMetadata.from_stream(fp)
+
+
+def test_cromwell_metadata_cache(tmp_path):
+    metadata_json_file = tmp_path / 'metadata.json'
+    metadata_json_file.write_text(Path('data/subworkflow/metadata.json').read_text())
+    cm = CromwellMetadata(json.loads(metadata_json_file.read_text()))
+
+    cache = CromwellMetadataCache(str(tmp_path / 'cache'))
+    key = cache.get_key(str(metadata_json_file))
+    assert cache.load(key) is None
+
+    cache.save(key, cm)
+    cm_cached = cache.load(key)
+    assert cm_cached.get_workflow_id() == cm.get_workflow_id()
+    assert cm_cached.get_out_def_json_file() == cm.get_out_def_json_file()
+    assert cm_cached.get_nodes() == cm.get_nodes()
+    assert cm_cached.get_task_graph()._children == cm.get_task_graph()._children
+
+    # cache file is plain JSON
+    with open(cache.get_cache_file(key)) as fp:
+        assert json.load(fp)['workflow_id'] == cm.get_workflow_id()
+
+    # key changes if metadata JSON file is replaced with the same size and mtime
+    st = os.stat(str(metadata_json_file))
+    new_file = tmp_path / 'metadata.json.new'
+    new_file.write_text(metadata_json_file.read_text())
+    os.utime(str(new_file), ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(str(new_file), str(metadata_json_file))
+    new_key = cache.get_key(str(metadata_json_file))
+    assert new_key != key
+
+    # key changes if metadata JSON file changes
+    metadata_json_file.write_text(metadata_json_file.read_text() + '\n')
+    assert cache.get_key(str(metadata_json_file)) not in (key, new_key)
+    assert cache.get_key(str(tmp_path / 'not_exists.json')) is None
@@ -0,0 +1,83 @@
+import json
+import os
+
+from croo.croo_batch import BATCH_SUMMARY_FILE, CrooBatch, find_metadata_json_files
+
+
+def make_metadata(tmp_path, workflow_id):
+    return {
+        'id': workflow_id,
+        'workflowName': 'main',
+        'status': 'Succeeded',
+        'calls': {
+            'main.t1': [
+                {
+                    'shardIndex': -1,
+                    'executionStatus': 'Done',
+                    'outputs': {'out': str(tmp_path / 'src' / 'a.txt')},
+                }
+            ]
+        },
+    }
+
+
+def test_find_metadata_json_files(tmp_path):
+    for d in ('s1', 's2'):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / 'metadata.json').write_text('{}')
+
+    pattern = str(tmp_path / '*' / 'metadata.json')
+    f = str(tmp_path / 's1' / 'metadata.json')
+    assert find_metadata_json_files([f, pattern, 'gs://a/b.json']) == [
+        f,
+        str(tmp_path / 's2' / 'metadata.json'),
+        'gs://a/b.json',
+    ]
+
+
+def test_croo_batch(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'a.txt').write_text('a')
+    metadata_dir = tmp_path / 'metadata'
+    metadata_dir.mkdir()
+    with open(str(metadata_dir / 'single.json'), 'w') as fp:
+        json.dump(make_metadata(tmp_path, 'w1'), fp)
+    with open(str(metadata_dir / 'multi.json'), 'w') as fp:
+        json.dump([make_metadata(tmp_path, 'w2'), make_metadata(tmp_path, 'w3')], fp)
+    with open(str(metadata_dir / 'broken.json'), 'w') as fp:
+        fp.write('{"id": ')
+
+    out_dir = tmp_path / 'out'
+    summary = CrooBatch(
+        metadata_jsons=[
+            str(metadata_dir / 'single.json'),
+            str(metadata_dir / 'm*.json'),
+            str(metadata_dir / 'broken.json'),
+        ],
+        out_dir=str(out_dir),
+        tmp_dir=str(tmp_path / 'tmp'),
+        num_workers=2,
+        out_def_json={'main.t1': {'out': {'path': 't1/${basename}'}}},
+        soft_link=False,
+    ).run()
+
+    assert summary['num_workflows'] == 4
+    assert summary['num_succeeded'] == 3
+    assert summary['num_failed'] == 1
+    assert [
+        (w['workflow_id'], w['index'], w['status']) for w in summary['workflows']
+    ] == [
+        ('w1', None, 'succeeded'),
+        ('w2', 0, 'succeeded'),
+        ('w3', 1, 'succeeded'),
+        (None, None, 'failed'),
+    ]
+    assert summary['workflows'][3]['error']
+
+    for workflow_id in ('w1', 'w2', 'w3'):
+        assert (out_dir / workflow_id / 't1' / 'a.txt').read_text() == 'a'
+        assert os.path.exists(
+            str(out_dir / workflow_id / 'croo.report.{w}.html'.format(w=workflow_id))
+        )
+    with open(str(out_dir / BATCH_SUMMARY_FILE)) as fp:
+        assert json.load(fp)['num_failed'] == 1
@@ -0,0 +1,80 @@
+import hashlib
+import os
+
+import pytest
+from autouri import AutoURI
+
+from croo.croo_checksum_cache import CrooChecksumCache, calc_md5
+from croo.croo_transfer import CrooTransfer
+
+
+@pytest.mark.parametrize('size', [0, 1, 1000, 4096, 10000])
+def test_calc_md5(tmp_path, size):
+    f = tmp_path / 'a.bin'
+    data = os.urandom(size)
+    f.write_bytes(data)
+    assert calc_md5(str(f), chunk_size=1024, num_read_ahead_chunks=2) == (
+        hashlib.md5(data).hexdigest()
+    )
+
+
+def test_calc_md5_missing_file(tmp_path):
+    with pytest.raises(OSError):
+        calc_md5(str(tmp_path / 'missing'), chunk_size=1024, num_read_ahead_chunks=2)
+
+
+def test_croo_checksum_cache(tmp_path):
+    f = tmp_path / 'a.txt'
+    f.write_text('a')
+    md5 = hashlib.md5(b'a').hexdigest()
+
+    cache = CrooChecksumCache(str(tmp_path / 'cache'))
+    m = cache.get_metadata(AutoURI(str(f)))
+    assert m.exists
+    assert m.md5 == md5
+    assert cache.get(str(f), m.size, m.mtime) == md5
+    # outdated
+    assert cache.get(str(f), m.size, m.mtime + 1.0) is None
+
+    # cached hash is used instead of calculating it
+    cache.put(str(f), m.size, m.mtime, 'cached')
+    assert cache.get_metadata(AutoURI(str(f))).md5 == 'cached'
+    cache.close()
+
+    # persistent
+    cache = CrooChecksumCache(str(tmp_path / 'cache'))
+    assert cache.get(str(f), m.size, m.mtime) == 'cached'
+    assert not cache.get_metadata(AutoURI(str(tmp_path / 'missing'))).exists
+    cache.close()
+
+    # read-only: DB file is not created or written
+    cache = CrooChecksumCache(str(tmp_path / 'no_cache'), read_only=True)
+    assert cache.get_metadata(AutoURI(str(f))).md5 == md5
+    cache.close()
+    assert not (tmp_path / 'no_cache').exists()
+    cache = CrooChecksumCache(str(tmp_path / 'cache'), read_only=True)
+    assert cache.get(str(f), m.size, m.mtime) == 'cached'
+    cache.put(str(f), m.size, m.mtime, 'not_cached')
+    assert cache.get(str(f), m.size, m.mtime) == 'cached'
+    cache.close()
+
+
+def test_croo_transfer_checksum_cache(tmp_path):
+    src = tmp_path / 'src' / 'a.txt'
+    src.parent.mkdir()
+    src.write_text('a')
+    target = str(tmp_path / 'out' / 'b.txt')
+
+    cache = CrooChecksumCache(str(tmp_path / 'cache'))
+    for _ in range(2):
+        transfer = CrooTransfer(soft_link=False, checksum_cache=cache)
+        job_id = transfer.add(str(src), target)
+        assert transfer.run() == 0
+        assert transfer.get_target_uri(job_id) == target
+
+    # different names so md5 hashes were compared and then cached
+    m_target = AutoURI(target).get_metadata(skip_md5=True)
+    assert cache.get(target, m_target.size, m_target.mtime) == (
+        hashlib.md5(b'a').hexdigest()
+    )
+    cache.close()
@@ -0,0 +1,55 @@
+import pytest
+
+from croo.croo_inline_exp import CrooInlineExp
+
+
+@pytest.mark.parametrize(
+    's, full_path, shard_idx, expected',
+    [
+        ('align/rep${i+1}/${basename}', '/a/b/c.bam', (0,), 'align/rep1/c.bam'),
+        ('${basename}', 'gs://a/b/c.bam', (-1,), 'c.bam'),
+        ('${dirname}|${full_path}', '/a/b/c.bam', (-1,), '/a/b|/a/b/c.bam'),
+        ('${i}-${j}-${k}', '/a', (-1, 2, 3), 'None-2-3'),
+        ('${ll}${l}${m}${n}${o}', '/a', (0, 1, 2, 3, 4, 5, 6), '33456'),
+        ('${shard_idx}', '/a', (-1, 2), '(-1, 2)'),
+        ('${shard_idx[-1] * 2 + 1}', '/a', (-1, 2), '5'),
+        (
+            "${basename.split('.')[0].replace('_vs_','_').replace('_',' vs. ').capitalize()}",
+            '/a/rep1_vs_rep2.bw',
+            (-1,),
+            'Rep1 vs. rep2',
+        ),
+        ("${'-'.join(basename.split('.')[:-1])}", '/a/b.c.txt', (-1,), 'b-c'),
+        ("${'rep' + str(i+1) if i is not None else 'pooled'}", '/a', (-1,), 'pooled'),
+        ('no expression', '/a', (-1,), 'no expression'),
+    ],
+)
+def test_render(s, full_path, shard_idx, expected):
+    exp = CrooInlineExp(s)
+    assert exp.render(CrooInlineExp.make_env(full_path, shard_idx)) == expected
+
+
+@pytest.mark.parametrize(
+    's',
+    [
+        '${}',
+        '${i +}',
+        '${unknown}',
+        '${__import__("os")}',
+        '${basename.__class__}',
+        '${basename.format(i)}',
+        '${open(full_path)}',
+        '${i ** 2}',
+        '${str(*shard_idx)}',
+        '${(lambda: 1)()}',
+    ],
+)
+def test_invalid_exp(s):
+    with pytest.raises(ValueError):
+        CrooInlineExp(s)
+
+
+def test_str_method_on_non_str():
+    exp = CrooInlineExp('${shard_idx.replace(1, 2)}')
+    with pytest.raises(ValueError):
+        exp.render(CrooInlineExp.make_env('/a', (1,)))
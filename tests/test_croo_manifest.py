@@ -0,0 +1,145 @@
+import json
+import os
+
+import pytest
+
+from croo.croo import Croo
+from croo.croo_manifest import CrooManifest
+from croo.croo_transfer import CrooTransfer
+
+
+def run_transfer(manifest, jobs, soft_link=False):
+    transfer = CrooTransfer(soft_link=soft_link, manifest=manifest)
+    job_ids = [transfer.add(src, target) for src, target in jobs]
+    assert transfer.run() == 0
+    manifest.close()
+    return [transfer.get_target_uri(job_id) for job_id in job_ids]
+
+
+def test_croo_manifest_resume(tmp_path):
+    srcs = []
+    for i in range(3):
+        src = tmp_path / 'src' / '{i}.txt'.format(i=i)
+        src.parent.mkdir(exist_ok=True)
+        src.write_text('src {i}'.format(i=i))
+        srcs.append(str(src))
+    jobs = [(src, str(tmp_path / 'out' / os.path.basename(src))) for src in srcs]
+    manifest_file = str(tmp_path / 'out' / 'croo.manifest.jsonl')
+
+    run_transfer(CrooManifest(manifest_file), jobs)
+    with open(manifest_file) as fp:
+        entries = [json.loads(line) for line in fp]
+    assert [(e['src'], e['target']) for e in entries] == jobs
+    assert all(e['method'] == CrooManifest.METHOD_COPY for e in entries)
+    assert entries[0]['size'] == len('src 0')
+
+    # simulate a crash while writing the last line
+    with open(manifest_file, 'a') as fp:
+        fp.write('{"src": ')
+
+    # 0: completed in manifest, 1: source changed, 2: target deleted
+    (tmp_path / 'out' / '0.txt').write_text('xxx 0')
+    (tmp_path / 'src' / '1.txt').write_text('changed 1')
+    (tmp_path / 'out' / '2.txt').unlink()
+
+    target_uris = run_transfer(CrooManifest(manifest_file, resume=True), jobs)
+    assert target_uris == [target for _, target in jobs]
+    assert (tmp_path / 'out' / '0.txt').read_text() == 'xxx 0'
+    assert (tmp_path / 'out' / '1.txt').read_text() == 'changed 1'
+    assert (tmp_path / 'out' / '2.txt').read_text() == 'src 2'
+
+    # without resume, a new manifest is written from scratch
+    run_transfer(CrooManifest(manifest_file), jobs)
+    with open(manifest_file) as fp:
+        assert len(fp.readlines()) == len(jobs)
+
+
+def test_croo_manifest_soft_link(tmp_path):
+    src = tmp_path / 'a.txt'
+    src.write_text('a')
+    target = str(tmp_path / 'out' / 'a.txt')
+    jobs = [(str(src), target), (str(src), 'gs://bucket/a.txt')]
+    manifest_file = str(tmp_path / 'croo.manifest.jsonl')
+
+    run_transfer(CrooManifest(manifest_file), jobs, soft_link=True)
+    manifest = CrooManifest(manifest_file, resume=True)
+    assert manifest.find_valid_entry(str(src), target)['method'] == (
+        CrooManifest.METHOD_SOFT_LINK
+    )
+    assert manifest.find_valid_entry(str(src), 'gs://bucket/a.txt')['method'] == (
+        CrooManifest.METHOD_REFERENCE
+    )
+    os.unlink(target)
+    assert manifest.find_valid_entry(str(src), target) is None
+    manifest.close()
+
+
+def test_croo_manifest_upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(CrooManifest, 'UPLOAD_EVERY', 2)
+    # any URI works as upload_uri. local one here instead of a remote one
+    upload_uri = str(tmp_path / 'remote' / 'croo.manifest.jsonl')
+    manifest_file = str(tmp_path / 'tmp' / 'croo.manifest.jsonl')
+    srcs = []
+    for i in range(3):
+        src = tmp_path / 'src' / '{i}.txt'.format(i=i)
+        src.parent.mkdir(exist_ok=True)
+        src.write_text('src {i}'.format(i=i))
+        srcs.append(str(src))
+    jobs = [(src, str(tmp_path / 'out' / os.path.basename(src))) for src in srcs]
+
+    # uploaded periodically before close
+    manifest = CrooManifest(manifest_file, upload_uri=upload_uri)
+    transfer = CrooTransfer(soft_link=False, manifest=manifest)
+    for src, target in jobs[:2]:
+        transfer.add(src, target)
+    transfer.run()
+    with open(upload_uri) as fp:
+        assert len(fp.readlines()) == 2
+    manifest.close()
+
+    # local manifest is lost (e.g. on another tmp_dir)
+    os.remove(manifest_file)
+    run_transfer(
+        CrooManifest(manifest_file, resume=True, upload_uri=upload_uri), jobs[2:]
+    )
+    with open(upload_uri) as fp:
+        assert [json.loads(line)['src'] for line in fp] == srcs
+
+    # remote manifest is behind a local one (e.g. croo was killed)
+    with open(upload_uri, 'w') as fp:
+        fp.write('')
+    manifest = CrooManifest(manifest_file, resume=True, upload_uri=upload_uri)
+    assert all(manifest.find_valid_entry(src, target) for src, target in jobs)
+    manifest.close()
+    with open(upload_uri) as fp:
+        assert len(fp.readlines()) == len(jobs)
+
+    # double close is safe and adding to a closed manifest fails
+    manifest.close()
+    with pytest.raises(ValueError):
+        manifest.add(srcs[0], jobs[0][1], jobs[0][1], 'copy')
+
+
+def test_croo_manifest_upload_on_failure(
+    metadata_json_for_subworkflow, tmp_path, monkeypatch
+):
+    upload_uri = str(tmp_path / 'remote' / 'croo.manifest.jsonl')
+    manifest_file = str(tmp_path / 'tmp' / 'croo.manifest.jsonl')
+    # as if out_dir is remote
+    monkeypatch.setattr(
+        Croo, '_Croo__get_manifest_uris', lambda self: (upload_uri, manifest_file)
+    )
+
+    def run(self):
+        raise RuntimeError('transfer failed')
+
+    monkeypatch.setattr(CrooTransfer, 'run', run)
+    co = Croo(
+        metadata_json=str(metadata_json_for_subworkflow),
+        out_def_json={"main.t_main_1": {"out": {"path": "${i}/${basename}"}}},
+        out_dir=str(tmp_path / 'out'),
+        tmp_dir=str(tmp_path / 'tmp'),
+    )
+    with pytest.raises(RuntimeError):
+        co.organize_output()
+    assert os.path.exists(upload_uri)
@@ -0,0 +1,102 @@
+import json
+import os
+
+import pytest
+
+from croo.croo import Croo
+from croo.croo_profiler import CrooProfiler
+
+
+def test_croo_profiler(tmp_path):
+    CrooProfiler.disable()
+    with CrooProfiler.span('disabled'):
+        pass
+
+    CrooProfiler.enable()
+    try:
+        with CrooProfiler.span('outer'):
+            with CrooProfiler.span('inner', src='a.txt'):
+                pass
+            with CrooProfiler.span('inner'):
+                pass
+        summary = CrooProfiler.get_summary()
+        assert list(summary) == ['outer', 'inner']
+        assert summary['inner']['count'] == 2
+        assert summary['outer']['max_rss_mb'] > 0
+
+        CrooProfiler.save(str(tmp_path / 'trace.json'))
+    finally:
+        CrooProfiler.disable()
+
+    with open(str(tmp_path / 'trace.json')) as fp:
+        trace = json.load(fp)
+    events = trace['traceEvents']
+    assert [e['name'] for e in events] == ['inner', 'inner', 'outer']
+    assert all(e['ph'] == 'X' for e in events)
+    assert events[0]['args']['src'] == 'a.txt'
+    # inner spans are nested in outer span
+    outer = events[2]
+    for e in events[:2]:
+        assert outer['ts'] <= e['ts']
+        assert e['ts'] + e['dur'] <= outer['ts'] + outer['dur']
+    assert trace['otherData']['phases']['outer']['count'] == 1
+
+
+def test_croo_profiler_multiple_users():
+    CrooProfiler.enable()
+    with CrooProfiler.span('first'):
+        pass
+    # another user doesn't clear spans of others
+    CrooProfiler.enable()
+    CrooProfiler.disable()
+    assert CrooProfiler.is_enabled()
+    assert list(CrooProfiler.get_summary()) == ['first']
+
+    CrooProfiler.disable()
+    assert not CrooProfiler.is_enabled()
+    assert not CrooProfiler.get_summary()
+
+
+def test_croo_profile(metadata_json_for_subworkflow, tmp_path):
+    out_dir = tmp_path / 'out'
+    co = Croo(
+        metadata_json=str(metadata_json_for_subworkflow),
+        out_def_json={"main.t_main_1": {"out": {"path": "${i}/${basename}"}}},
+        out_dir=str(out_dir),
+        tmp_dir=str(tmp_path / 'tmp'),
+        profile=True,
+    )
+    co.organize_output()
+    # profiling stops after organizing outputs
+    assert not CrooProfiler.is_enabled()
+
+    (trace_file,) = [
+        f for f in os.listdir(str(out_dir)) if f.startswith('croo.profile.')
+    ]
+    with open(str(out_dir / trace_file)) as fp:
+        phases = json.load(fp)['otherData']['phases']
+    for name in (
+        'load_metadata',
+        'localize_metadata',
+        'parse_metadata',
+        'build_task_graph',
+        'interpret_inline_exp',
+        'transfer',
+        'write_html_report',
+    ):
+        assert name in phases
+    assert phases['transfer_job']['count'] == 2
+
+
+def test_croo_profile_init_failure(metadata_json_for_subworkflow, tmp_path):
+    # out_def JSON file defined in WDL (main.croo.json) does not exist
+    with pytest.raises(FileNotFoundError):
+        Croo(
+            metadata_json=str(metadata_json_for_subworkflow),
+            out_def_json=None,
+            out_dir=str(tmp_path / 'out'),
+            tmp_dir=str(tmp_path / 'tmp'),
+            profile=True,
+        )
+    assert not CrooProfiler.is_enabled()
+    assert CrooProfiler._num_enabled == 0
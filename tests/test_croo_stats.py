@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+
+from croo.croo import Croo
+from croo.croo_stats import CrooStats
+from croo.croo_transfer import CrooTransfer
+
+
+def test_croo_stats():
+    stats = CrooStats(num_slowest=2)
+    with stats.phase('transfer'):
+        pass
+    stats.add_phase_time('transfer', 1.0)
+    stats.add_transfer(
+        'a', 'out/a', 'local', 'gs', 'copy', CrooStats.STATUS_TRANSFERRED, 100, 0.5
+    )
+    stats.add_transfer(
+        'b', 'out/b', 'local', 'gs', 'copy', CrooStats.STATUS_TRANSFERRED, 300, 3.0
+    )
+    stats.add_transfer(
+        'c',
+        'out/c',
+        'local',
+        'local',
+        'soft_link',
+        CrooStats.STATUS_TRANSFERRED,
+        0,
+        1.0,
+    )
+    stats.add_transfer(
+        'd', 'out/d', 'local', 'gs', None, CrooStats.STATUS_FAILED, 0, 0.1
+    )
+    stats.add_deduplicated(300)
+    with stats.memory('parse_metadata'):
+        data = b'a' * (64 * 1024 * 1024)
+
+    d = stats.to_dict()
+    assert d['phases']['transfer'] >= 1.0
+    assert d['rss_increase_mb']['parse_metadata'] >= 32
+    del data
+    assert d['num_files'] == {'transferred': 3, 'failed': 1}
+    assert d['num_files_by_method'] == {'copy': 2, 'soft_link': 1}
+    assert d['bytes_transferred'] == 400
+    assert d['num_deduplicated_files'] == 1
+    assert d['bytes_saved'] == 300
+    assert d['backends']['local->gs']['num_files'] == 2
+    assert d['backends']['local->gs']['bytes'] == 400
+    assert d['backends']['local->local']['mb_per_sec_per_file'] == 0.0
+    assert [t['src'] for t in d['slowest_transfers']] == ['b', 'c']
+
+
+def test_croo_transfer_stats(tmp_path):
+    src = tmp_path / 'a.txt'
+    src.write_text('a' * 100)
+    identical = tmp_path / 'out' / 'b' / 'a.txt'
+    identical.parent.mkdir(parents=True)
+    identical.write_text('a' * 100)
+
+    stats = CrooStats()
+    transfer = CrooTransfer(soft_link=False, stats=stats)
+    transfer.add(str(src), str(tmp_path / 'out' / 'a' / 'a.txt'))
+    transfer.add(str(tmp_path / 'missing.txt'), str(tmp_path / 'out' / 'missing.txt'))
+    transfer.run()
+    transfer = CrooTransfer(soft_link=False, stats=stats)
+    transfer.add(str(src), str(identical))
+    transfer.run()
+
+    d = stats.to_dict()
+    assert d['num_files'] == {'transferred': 1, 'failed': 1, 'skipped_identical': 1}
+    assert d['bytes_transferred'] == 100
+    assert d['backends']['local->local']['num_files'] == 1
+
+
+def test_croo_transfer_stats_no_extra_metadata(tmp_path, monkeypatch):
+    """Source metadata is not retrieved again only for stats.
+    """
+    from autouri import AbsPath
+
+    src = tmp_path / 'a.txt'
+    src.write_text('a' * 100)
+    calls = []
+    get_metadata = AbsPath.get_metadata
+
+    def get_metadata_counted(self, *args, **kwargs):
+        calls.append(self.uri)
+        return get_metadata(self, *args, **kwargs)
+
+    monkeypatch.setattr(AbsPath, 'get_metadata', get_metadata_counted)
+
+    for no_checksum in (False, True):
+        stats = CrooStats()
+        transfer = CrooTransfer(soft_link=False, no_checksum=no_checksum, stats=stats)
+        transfer.add(str(src), str(tmp_path / str(no_checksum) / 'a.txt'))
+        calls.clear()
+        transfer.run()
+        assert stats.to_dict()['bytes_transferred'] == 100
+        assert calls.count(str(src)) <= (0 if no_checksum else 1)
+
+
+def test_croo_transfer_stats_dedup(tmp_path):
+    src = tmp_path / 'pooled.bam'
+    src.write_text('a' * 100)
+    targets = [str(tmp_path / 'out' / str(i) / 'pooled.bam') for i in range(3)]
+
+    for _ in range(2):
+        if os.path.exists(targets[0]):
+            # make source newer than target to compare md5 hashes
+            os.utime(targets[0], (0, 0))
+        stats = CrooStats()
+        transfer = CrooTransfer(soft_link=False, stats=stats)
+        for target in targets:
+            transfer.add(str(src), target)
+        transfer.run()
+
+        d = stats.to_dict()
+        assert d['num_deduplicated_files'] == 2
+        assert d['bytes_saved'] == 200
+
+    # md5 hash of source is known on 2nd run.
+    # it is written as an md5 file for duplicate targets too
+    for target in targets[1:]:
+        with open(target + '.md5') as fp:
+            assert fp.read() == hashlib.md5(b'a' * 100).hexdigest()
+
+
+def test_croo_write_stats(metadata_json_for_subworkflow, tmp_path):
+    out_dir = tmp_path / 'out'
+    co = Croo(
+        metadata_json=str(metadata_json_for_subworkflow),
+        out_def_json={"main.t_main_1": {"out": {"path": "${i}/${basename}"}}},
+        out_dir=str(out_dir),
+        tmp_dir=str(tmp_path / 'tmp'),
+    )
+    co.organize_output()
+
+    (stats_file,) = [f for f in os.listdir(str(out_dir)) if f.startswith('croo.stats.')]
+    with open(str(out_dir / stats_file)) as fp:
+        d = json.load(fp)
+    for phase in ('load_metadata', 'build_task_graph', 'transfer', 'report'):
+        assert phase in d['phases']
+    assert 'parse_metadata' in d['rss_increase_mb']
+    assert d['num_files_by_method'] == {'soft_link': 2}
@@ -0,0 +1,149 @@
+import errno
+import threading
+import time
+
+import pytest
+
+from croo.croo_throttle import CrooThrottle, is_transient_error, make_throttles
+from croo.croo_transfer import CrooTransfer
+
+
+def test_is_transient_error():
+    assert is_transient_error(ConnectionResetError())
+    assert is_transient_error(TimeoutError())
+    assert is_transient_error(OSError(errno.ESTALE, 'Stale file handle'))
+    assert not is_transient_error(FileNotFoundError(errno.ENOENT, 'No such file'))
+    assert not is_transient_error(ValueError())
+
+
+def test_croo_throttle_concurrency():
+    throttle = CrooThrottle(max_concurrency=2)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def run():
+        throttle.acquire()
+        try:
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        finally:
+            throttle.release()
+
+    threads = [threading.Thread(target=run) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max_running[0] == 2
+
+
+def test_croo_throttle_bandwidth():
+    throttle = CrooThrottle(max_bytes_per_sec=1000)
+    # first transfer starts immediately
+    assert throttle.wait_for_bandwidth(100) == 0.0
+    start = time.monotonic()
+    throttle.wait_for_bandwidth(100)
+    assert time.monotonic() - start >= 0.09
+    assert CrooThrottle().wait_for_bandwidth(10**9) == 0.0
+
+
+def test_make_throttles():
+    throttles = make_throttles(
+        max_concurrency={'local': 4}, max_bytes_per_sec={'gs': 10**8}
+    )
+    assert sorted(throttles) == ['gs', 'local']
+    assert throttles['gs'].limits_bandwidth
+    assert not throttles['local'].limits_bandwidth
+    with pytest.raises(ValueError):
+        make_throttles(max_concurrency={'nfs': 4})
+
+
+@pytest.fixture
+def flaky_http_server(tmp_path):
+    """Local HTTP server which fails the first GET for each file with 503.
+    """
+    from functools import partial
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    failed = set()
+    lock = threading.Lock()
+
+    class FlakyHandler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                first = self.path not in failed
+                failed.add(self.path)
+            if first:
+                self.send_error(503)
+                return
+            super().do_GET()
+
+    root = tmp_path / 'http_root'
+    root.mkdir()
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), partial(FlakyHandler, directory=str(root))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, 'http://127.0.0.1:{port}'.format(port=server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('max_retries,num_failed', [(0, 4), (2, 0)])
+def test_croo_transfer_retry(tmp_path, flaky_http_server, max_retries, num_failed):
+    root, url = flaky_http_server
+    for i in range(4):
+        (root / '{i}.txt'.format(i=i)).write_text(str(i))
+
+    transfer = CrooTransfer(
+        num_threads=2,
+        soft_link=False,
+        no_checksum=True,
+        throttles=make_throttles(max_concurrency={'local': 1, 'http': 2}),
+        max_retries=max_retries,
+        retry_delay=0.01,
+    )
+    for i in range(4):
+        transfer.add(
+            '{url}/{i}.txt'.format(url=url, i=i),
+            str(tmp_path / 'out' / '{i}.txt'.format(i=i)),
+        )
+    assert transfer.run() == num_failed
+    if not num_failed:
+        for i in range(4):
+            assert (tmp_path / 'out' / '{i}.txt'.format(i=i)).read_text() == str(i)
+
+
+def test_croo_transfer_bandwidth_skipped(tmp_path):
+    """Files skipped as identical do not consume bandwidth budget.
+    """
+    for i in range(3):
+        src = tmp_path / 'src' / '{i}.txt'.format(i=i)
+        src.parent.mkdir(exist_ok=True)
+        src.write_text('a' * 100)
+        target = tmp_path / 'out' / '{i}.txt'.format(i=i)
+        target.parent.mkdir(exist_ok=True)
+        target.write_text('a' * 100)
+    new = tmp_path / 'src' / 'new.txt'
+    new.write_text('b' * 100)
+
+    throttles = make_throttles(max_bytes_per_sec={'local': 100})
+    transfer = CrooTransfer(soft_link=False, throttles=throttles)
+    for i in range(3):
+        transfer.add(
+            str(tmp_path / 'src' / '{i}.txt'.format(i=i)),
+            str(tmp_path / 'out' / '{i}.txt'.format(i=i)),
+        )
+    transfer.add(str(new), str(tmp_path / 'out' / 'new.txt'))
+    start = time.monotonic()
+    assert transfer.run() == 0
+    assert time.monotonic() - start < 0.5
+
+    # budget is consumed by new.txt only
+    assert throttles['local'].wait_for_bandwidth(100) >= 0.5
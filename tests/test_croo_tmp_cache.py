@@ -0,0 +1,173 @@
+import functools
+import http.server
+import os
+import threading
+import time
+
+import pytest
+from autouri import AutoURI
+
+from croo.croo_checksum_cache import CrooChecksumCache
+from croo.croo_tmp_cache import CrooTmpCache
+
+
+def make_file(path, size, atime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(b'0' * size)
+    os.utime(path, (atime, 1000.0))
+
+
+def test_croo_tmp_cache_evict(tmp_path, monkeypatch):
+    tmp_dir = str(tmp_path)
+    old = os.path.join(tmp_dir, 'bucket', 'a', 'old.json')
+    mid = os.path.join(tmp_dir, 'bucket', 'b', 'mid.json')
+    new = os.path.join(tmp_dir, 'bucket', 'b', 'new.json')
+    db = os.path.join(tmp_dir, CrooChecksumCache.DB_FILE)
+    manifest = os.path.join(tmp_dir, 'croo.manifest.w1.jsonl')
+    make_file(old, 100, 1000.0)
+    make_file(mid, 100, 2000.0)
+    make_file(new, 100, 3000.0)
+    make_file(db, 1000, 0.0)
+    make_file(manifest, 1000, 0.0)
+
+    # no limit
+    CrooTmpCache(tmp_dir).evict()
+    assert os.path.exists(old)
+
+    cache = CrooTmpCache(tmp_dir, max_size=200)
+    # old is most recently accessed now
+    cache.touch(old)
+    assert os.path.getmtime(old) == 1000.0
+    cache.evict()
+
+    assert not os.path.exists(mid)
+    assert os.path.exists(old)
+    assert os.path.exists(new)
+    assert os.path.exists(db)
+    assert os.path.exists(manifest)
+
+    cache.evict(protected=(new,))
+    assert os.path.exists(new)
+
+    # old has just been accessed
+    monkeypatch.setattr(CrooTmpCache, 'EVICT_GRACE_PERIOD', 0.0)
+    cache = CrooTmpCache(tmp_dir, max_size=0)
+    cache.evict(protected=(new,))
+    assert not os.path.exists(old)
+    # empty directory is removed
+    assert not os.path.exists(os.path.dirname(old))
+    assert os.path.exists(new)
+    assert cache.get_stats() == {
+        'num_hits': 0,
+        'num_misses': 0,
+        'num_evicted_files': 1,
+        'evicted_bytes': 100,
+        'max_size': 0,
+    }
+
+
+def test_croo_tmp_cache_evict_in_use(tmp_path):
+    tmp_dir = str(tmp_path)
+    old = os.path.join(tmp_dir, 'bucket', 'old.json')
+    locked = os.path.join(tmp_dir, 'bucket', 'locked.json')
+    recent = os.path.join(tmp_dir, 'bucket', 'recent.json')
+    make_file(old, 100, 1000.0)
+    make_file(locked, 100, 1000.0)
+    make_file(recent, 100, time.time())
+    make_file(locked + AutoURI.LOCK_FILE_EXT, 0, 1000.0)
+
+    cache = CrooTmpCache(tmp_dir, max_size=0)
+    cache.evict()
+    assert not os.path.exists(old)
+    # being localized by another process
+    assert os.path.exists(locked)
+    # accessed within grace period
+    assert os.path.exists(recent)
+
+
+def test_croo_tmp_cache_evict_scan(tmp_path, monkeypatch):
+    tmp_dir = str(tmp_path)
+    a = os.path.join(tmp_dir, 'bucket', 'a.json')
+    b = os.path.join(tmp_dir, 'bucket', 'b.json')
+    make_file(a, 100, 1000.0)
+
+    num_scans = []
+    walk = os.walk
+
+    def count_walk(*args, **kwargs):
+        num_scans.append(args[0])
+        return walk(*args, **kwargs)
+
+    monkeypatch.setattr(os, 'walk', count_walk)
+    monkeypatch.setattr(CrooTmpCache, 'EVICT_GRACE_PERIOD', 0.0)
+    cache = CrooTmpCache(tmp_dir, max_size=150)
+    cache.evict()
+    assert len(num_scans) == 1
+    # total size is kept on memory. not scanned while it's within max_size
+    cache.touch(a)
+    cache.evict()
+    assert len(num_scans) == 1
+
+    make_file(b, 100, 2000.0)
+    cache.touch(b)
+    cache.evict(protected=(b,))
+    assert len(num_scans) == 2
+    assert not os.path.exists(a)
+    assert os.path.exists(b)
+    cache.evict()
+    assert len(num_scans) == 2
+
+
+def test_croo_tmp_cache_localize_local_file(tmp_path):
+    f = tmp_path / 'a.json'
+    f.write_text('{}')
+    cache = CrooTmpCache(str(tmp_path / 'tmp'), max_size=0)
+    # local file is not localized
+    assert cache.localize(str(f)) == str(f)
+    assert cache.get_stats()['num_misses'] == 0
+
+
+def test_croo_tmp_cache_localize(tmp_path):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    (src_dir / 'a.json').write_text('{}')
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(src_dir)
+    )
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{port}/a.json'.format(port=server.server_port)
+        cache = CrooTmpCache(str(tmp_path / 'tmp'))
+        f = cache.localize(url)
+        assert f.startswith(str(tmp_path / 'tmp'))
+        assert cache.localize(url) == f
+
+        # file just localized is opened before evicting files.
+        # it can be read even if evicted (e.g. by another process)
+        limited_cache = CrooTmpCache(str(tmp_path / 'tmp'), max_size=0)
+        with limited_cache.open(url) as fp:
+            os.remove(f)
+            assert fp.read() == '{}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    stats = cache.get_stats()
+    assert stats['num_misses'] == 1
+    assert stats['num_hits'] == 1
+
+
+def test_croo_tmp_cache_out_dir(tmp_path):
+    tmp_dir = str(tmp_path / 'tmp')
+    for out_dir in (tmp_dir, os.path.join(tmp_dir, 'out')):
+        with pytest.raises(ValueError):
+            CrooTmpCache(tmp_dir, max_size=100, out_dir=out_dir)
+        # no eviction without limit
+        CrooTmpCache(tmp_dir, out_dir=out_dir)
+    CrooTmpCache(tmp_dir, max_size=100, out_dir=str(tmp_path / 'out'))
+    CrooTmpCache(tmp_dir, max_size=100, out_dir=str(tmp_path / 'tmp2'))
+    CrooTmpCache(tmp_dir, max_size=100, out_dir='gs://bucket/tmp')
+    # default tmp_dir is under out_dir
+    CrooTmpCache(os.path.join(tmp_dir, '.croo_tmp'), max_size=100, out_dir=tmp_dir)
@@ -0,0 +1,273 @@
+import hashlib
+import os
+
+import pytest
+
+from croo.croo_transfer import CrooTransfer, split_into_parts
+
+
+@pytest.mark.parametrize('num_threads', [1, 4])
+def test_croo_transfer(tmp_path, num_threads):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    srcs = []
+    for i in range(20):
+        src = src_dir / '{i}.txt'.format(i=i)
+        src.write_text(str(i))
+        srcs.append(str(src))
+
+    transfer = CrooTransfer(num_threads=num_threads, soft_link=False)
+    job_ids = [
+        transfer.add(src, str(tmp_path / 'out' / str(i) / 'a.txt'))
+        for i, src in enumerate(srcs)
+    ]
+    # same target is added only once
+    assert transfer.add(srcs[0], str(tmp_path / 'out' / '0' / 'a.txt')) == job_ids[0]
+    missing = transfer.add(str(src_dir / 'missing.txt'), str(tmp_path / 'missing.txt'))
+    assert transfer.num_jobs == len(srcs) + 1
+
+    assert transfer.run() == 1
+    for i, job_id in enumerate(job_ids):
+        target = tmp_path / 'out' / str(i) / 'a.txt'
+        assert transfer.get_target_uri(job_id) == str(target)
+        assert transfer.get_error(job_id) is None
+        assert target.read_text() == str(i)
+
+    assert transfer.get_target_uri(missing) is None
+    ((src, target, _),) = transfer.get_errors()
+    assert src == str(src_dir / 'missing.txt')
+
+
+def test_croo_transfer_md5_file(tmp_path):
+    md5 = hashlib.md5(b'a' * 100).hexdigest()
+    src = tmp_path / 'a.txt'
+    src.write_text('a' * 100)
+    (tmp_path / 'a.txt.md5').write_text(md5)
+    # target exists but md5 hash is required to check if identical
+    existing = tmp_path / 'out' / 'b' / 'a.txt'
+    existing.parent.mkdir(parents=True)
+    existing.write_text('a' * 100)
+    os.utime(str(existing), (0, 0))
+
+    for target in (tmp_path / 'out' / 'a' / 'a.txt', existing):
+        transfer = CrooTransfer(soft_link=False)
+        transfer.add(str(src), str(target))
+        assert transfer.run() == 0
+        # md5 hash of source is known for a fresh copy.
+        # md5 hash of an existing target is calculated.
+        assert (target.parent / 'a.txt.md5').read_text() == md5
+
+
+def test_croo_transfer_soft_link(tmp_path):
+    src = tmp_path / 'a.txt'
+    src.write_text('a')
+
+    transfer = CrooTransfer(num_threads=2, soft_link=True)
+    job_id = transfer.add(str(src), str(tmp_path / 'out' / 'a.txt'))
+    # remote target is not used for soft-linking
+    job_id_remote = transfer.add(str(src), 'gs://bucket/a.txt')
+    transfer.run()
+
+    assert os.path.islink(str(tmp_path / 'out' / 'a.txt'))
+    assert transfer.get_target_uri(job_id) == str(tmp_path / 'out' / 'a.txt')
+    assert transfer.get_target_uri(job_id_remote) == str(src)
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """Local HTTP server as a stand-in for remote storage.
+    """
+    from functools import partial
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    from threading import Thread
+
+    root = tmp_path / 'http_root'
+    root.mkdir()
+    handler = partial(SimpleHTTPRequestHandler, directory=str(root))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, 'http://127.0.0.1:{port}'.format(port=server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_croo_transfer_http(tmp_path, http_server):
+    root, url = http_server
+    for i in range(50):
+        (root / '{i}.log'.format(i=i)).write_text('log {i}'.format(i=i))
+
+    transfer = CrooTransfer(num_threads=8, soft_link=False)
+    job_ids = [
+        transfer.add(
+            '{url}/{i}.log'.format(url=url, i=i),
+            str(tmp_path / 'out' / '{i}.log'.format(i=i)),
+        )
+        for i in range(50)
+    ]
+    missing = transfer.add(url + '/missing.log', str(tmp_path / 'missing.log'))
+
+    assert transfer.run() == 1
+    for i, job_id in enumerate(job_ids):
+        target = tmp_path / 'out' / '{i}.log'.format(i=i)
+        assert transfer.get_target_uri(job_id) == str(target)
+        assert target.read_text() == 'log {i}'.format(i=i)
+    assert transfer.get_error(missing) is not None
+
+
+@pytest.mark.parametrize('num_threads', [1, 4])
+def test_croo_transfer_dedup(tmp_path, num_threads):
+    src = tmp_path / 'pooled.bam'
+    src.write_text('a' * 100)
+
+    transfer = CrooTransfer(num_threads=num_threads, soft_link=False)
+    targets = [str(tmp_path / 'out' / str(i) / 'pooled.bam') for i in range(3)]
+    job_ids = [transfer.add(str(src), target) for target in targets]
+    missing_job_ids = [
+        transfer.add(
+            str(tmp_path / 'missing.bam'), str(tmp_path / '{i}.bam'.format(i=i))
+        )
+        for i in range(2)
+    ]
+
+    assert transfer.run() == 2
+    assert transfer.bytes_saved == 200
+    for job_id, target in zip(job_ids, targets):
+        assert transfer.get_target_uri(job_id) == target
+        assert (tmp_path / target).read_text() == 'a' * 100
+    # only the first target is a copy of source. others are hard links of it
+    assert os.stat(targets[0]).st_ino != os.stat(str(src)).st_ino
+    assert os.stat(targets[1]).st_ino == os.stat(targets[0]).st_ino
+    assert os.stat(targets[2]).st_ino == os.stat(targets[0]).st_ino
+    assert all(transfer.get_error(job_id) for job_id in missing_job_ids)
+
+
+def test_croo_transfer_plan(tmp_path):
+    src = tmp_path / 'a.bam'
+    src.write_text('a' * 100)
+    # another source already copied to its target
+    src_identical = tmp_path / 'b.bam'
+    src_identical.write_text('b' * 100)
+    identical = tmp_path / 'out' / 'b.bam'
+    identical.parent.mkdir()
+    identical.write_text('b' * 100)
+
+    transfer = CrooTransfer(num_threads=2, soft_link=False)
+    transfer.add(str(src), str(tmp_path / 'out' / '0' / 'a.bam'))
+    transfer.add(str(src), str(tmp_path / 'out' / '1' / 'a.bam'))
+    transfer.add(str(src_identical), str(identical))
+
+    plan = transfer.plan()
+    assert [job['method'] for job in plan] == ['copy', 'hard_link', 'copy']
+    assert all(job['size'] is None and job['skip'] is None for job in plan)
+
+    plan = transfer.plan(check_storage=True)
+    assert [job['size'] for job in plan] == [100, 100, 100]
+    assert [job['skip'] for job in plan] == [False, False, True]
+    assert plan[0]['src_storage'] == plan[0]['target_storage'] == 'AbsPath'
+    # nothing is written
+    assert not (tmp_path / 'out' / '0').exists()
+
+
+@pytest.mark.parametrize(
+    'local_copy_method', ['copy', 'hardlink', 'reflink', 'copy_file_range']
+)
+def test_croo_transfer_local_copy_method(tmp_path, local_copy_method):
+    src = tmp_path / 'a.bam'
+    src.write_text('a' * 100)
+    target = tmp_path / 'out' / 'a.bam'
+    # stale soft link on target is replaced
+    target.parent.mkdir()
+    target.symlink_to(src)
+
+    transfer = CrooTransfer(
+        soft_link=False, no_checksum=True, local_copy_method=local_copy_method
+    )
+    job_id = transfer.add(str(src), str(target))
+    assert transfer.run() == 0
+
+    assert transfer.get_target_uri(job_id) == str(target)
+    assert not target.is_symlink()
+    assert target.read_text() == 'a' * 100
+    # reflink and copy_file_range fall back to copy if not supported
+    is_hard_link = os.stat(str(target)).st_ino == os.stat(str(src)).st_ino
+    assert is_hard_link == (local_copy_method == 'hardlink')
+
+
+def test_croo_transfer_local_copy_method_invalid():
+    with pytest.raises(ValueError):
+        CrooTransfer(local_copy_method='scp')
+
+
+def test_split_into_parts():
+    assert split_into_parts(10, 4) == [(0, 4), (4, 4), (8, 2)]
+    assert split_into_parts(8, 4) == [(0, 4), (4, 4)]
+    assert split_into_parts(0, 4) == [(0, 0)]
+    # part size is increased for the limit on the number of parts
+    parts = split_into_parts(100, 4, max_num_parts=8)
+    assert len(parts) == 8
+    assert sum(size for _, size in parts) == 100
+    assert parts[0] == (0, 13)
+
+
+def test_croo_transfer_gcs_composite_clients(tmp_path, monkeypatch):
+    """GCS clients for part upload threads are taken from a fixed pool
+    regardless of number of files.
+    """
+    from autouri import GCSURI
+
+    uploaded = {}
+    thread_ids = set()
+
+    class FakeBlob:
+        def __init__(self, name):
+            self.name = name
+
+        def upload_from_file(self, fp, size):
+            uploaded[self.name] = fp.read(size)
+
+        def compose(self, blobs):
+            uploaded[self.name] = b''.join(uploaded[b.name] for b in blobs)
+
+        def delete(self):
+            uploaded.pop(self.name, None)
+
+    class FakeBucket:
+        def blob(self, name):
+            return FakeBlob(name)
+
+    class FakeClient:
+        def bucket(self, bucket):
+            return FakeBucket()
+
+    def get_gcs_client(thread_id):
+        thread_ids.add(thread_id)
+        return FakeClient()
+
+    monkeypatch.setattr(GCSURI, 'get_gcs_client', staticmethod(get_gcs_client))
+    monkeypatch.setattr(
+        GCSURI,
+        'get_blob',
+        lambda self, new=False: (FakeBlob(self.get_bucket_path()[1]), FakeBucket()),
+    )
+
+    transfer = CrooTransfer(
+        num_threads=2,
+        soft_link=False,
+        no_checksum=True,
+        multipart_threshold=0,
+        multipart_part_size=2,
+        multipart_num_threads=3,
+    )
+    for i in range(20):
+        src = tmp_path / '{i}.txt'.format(i=i)
+        src.write_text('src {i}'.format(i=i) * 4)
+        transfer.add(str(src), 'gs://bucket/out/{i}.txt'.format(i=i))
+    assert transfer.run() == 0
+
+    for i in range(20):
+        assert (
+            uploaded['out/{i}.txt'.format(i=i)] == ('src {i}'.format(i=i) * 4).encode()
+        )
+    assert len(thread_ids) <= 2 * 3
+    assert min(thread_ids) >= CrooTransfer.PART_THREAD_ID_OFFSET
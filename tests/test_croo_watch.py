@@ -0,0 +1,185 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from croo.cromwell_metadata import CromwellMetadata
+from croo.croo import Croo
+
+
+def make_metadata(tmp_path, t2_status, status):
+    return {
+        'id': 'watch-test',
+        'workflowName': 'main',
+        'status': status,
+        'calls': {
+            'main.t1': [
+                {
+                    'shardIndex': i,
+                    'executionStatus': 'Done',
+                    'outputs': {
+                        'out': str(tmp_path / 'src' / 't1.{i}.txt'.format(i=i))
+                    },
+                }
+                for i in range(2)
+            ],
+            'main.t2': [
+                {
+                    'shardIndex': -1,
+                    'executionStatus': t2_status,
+                    'outputs': (
+                        {'out': str(tmp_path / 'src' / 't2.txt')}
+                        if t2_status == 'Done'
+                        else {}
+                    ),
+                }
+            ],
+        },
+    }
+
+
+def test_cromwell_metadata_update(tmp_path):
+    cm = CromwellMetadata(
+        make_metadata(tmp_path, 'Running', 'Running'), done_calls_only=True
+    )
+    assert not cm.is_workflow_done()
+    assert len(cm.find_task_nodes('main.t1')) == 2
+    assert not cm.find_task_nodes('main.t2')
+
+    new_nodes = cm.update(make_metadata(tmp_path, 'Done', 'Succeeded'))
+    assert cm.is_workflow_done()
+    assert [(n.type, n.task_name) for n in new_nodes] == [
+        ('task', 'main.t2'),
+        ('output', 'main.t2'),
+    ]
+    assert len(cm.find_task_nodes('main.t2')) == 1
+    assert not cm.update(make_metadata(tmp_path, 'Done', 'Succeeded'))
+
+
+def test_cromwell_metadata_update_failed(tmp_path):
+    """All calls are taken from the final snapshot of a failed workflow
+    as in a normal run.
+    """
+    failed = make_metadata(tmp_path, 'Failed', 'Failed')
+    expected = sorted(str(n) for n in CromwellMetadata(failed).get_nodes())
+
+    cm = CromwellMetadata(
+        make_metadata(tmp_path, 'Running', 'Running'), done_calls_only=True
+    )
+    cm.update(failed)
+    assert sorted(str(n) for n in cm.get_nodes()) == expected
+    assert len(cm.find_task_nodes('main.t2')) == 1
+
+    # workflow already done
+    cm = CromwellMetadata(failed, done_calls_only=True)
+    assert sorted(str(n) for n in cm.get_nodes()) == expected
+
+    if importlib.util.find_spec('ijson') is None:
+        return
+    metadata_json_file = tmp_path / 'metadata.json'
+    metadata_json_file.write_text(json.dumps(failed))
+    with open(str(metadata_json_file), 'rb') as fp:
+        cm = CromwellMetadata.from_stream(fp, done_calls_only=True)
+    assert sorted(str(n) for n in cm.get_nodes()) == expected
+
+    metadata_json_file.write_text(
+        json.dumps(make_metadata(tmp_path, 'Running', 'Running'))
+    )
+    with open(str(metadata_json_file), 'rb') as fp:
+        cm = CromwellMetadata.from_stream(fp, done_calls_only=True)
+    metadata_json_file.write_text(json.dumps(failed))
+    with open(str(metadata_json_file), 'rb') as fp:
+        cm.update_from_stream(fp)
+    assert sorted(str(n) for n in cm.get_nodes()) == expected
+
+
+def test_croo_watch(tmp_path):
+    (tmp_path / 'src').mkdir()
+    for f in ('t1.0.txt', 't1.1.txt', 't2.txt'):
+        (tmp_path / 'src' / f).write_text(f)
+    metadata_dir = tmp_path / 'metadata'
+    metadata_dir.mkdir()
+    with open(str(metadata_dir / 'metadata.0.json'), 'w') as fp:
+        json.dump(make_metadata(tmp_path, 'Running', 'Running'), fp)
+
+    out_dir = tmp_path / 'out'
+    co = Croo(
+        metadata_json=str(metadata_dir),
+        out_def_json={
+            'main.t1': {'out': {'path': 't1/${basename}'}},
+            'main.t2': {'out': {'path': 't2/${basename}'}},
+        },
+        out_dir=str(out_dir),
+        tmp_dir=str(tmp_path / 'tmp'),
+        soft_link=False,
+        watch=True,
+    )
+    thread = threading.Thread(target=co.watch, kwargs={'interval': 0.05, 'timeout': 10})
+    thread.start()
+
+    # outputs of done calls are organized before workflow is done
+    for _ in range(100):
+        if (out_dir / 't1' / 't1.1.txt').exists():
+            break
+        time.sleep(0.05)
+    assert (out_dir / 't1' / 't1.0.txt').read_text() == 't1.0.txt'
+    assert not (out_dir / 't2').exists()
+
+    # new snapshot in directory
+    time.sleep(0.05)
+    with open(str(metadata_dir / 'metadata.1.json'), 'w') as fp:
+        json.dump(make_metadata(tmp_path, 'Done', 'Succeeded'), fp)
+    thread.join()
+
+    assert (out_dir / 't2' / 't2.txt').read_text() == 't2.txt'
+    assert os.path.exists(str(out_dir / 'croo.report.watch-test.html'))
+
+
+def watch_with_new_snapshot(tmp_path, new_snapshot):
+    """Watch a running workflow and write new_snapshot (str)
+    to a metadata JSON directory after watching started.
+    """
+    (tmp_path / 'src').mkdir()
+    for f in ('t1.0.txt', 't1.1.txt'):
+        (tmp_path / 'src' / f).write_text(f)
+    metadata_dir = tmp_path / 'metadata'
+    metadata_dir.mkdir()
+    with open(str(metadata_dir / 'metadata.0.json'), 'w') as fp:
+        json.dump(make_metadata(tmp_path, 'Running', 'Running'), fp)
+
+    co = Croo(
+        metadata_json=str(metadata_dir),
+        out_def_json={'main.t1': {'out': {'path': 't1/${basename}'}}},
+        out_dir=str(tmp_path / 'out'),
+        tmp_dir=str(tmp_path / 'tmp'),
+        soft_link=False,
+        watch=True,
+    )
+    writer = threading.Timer(
+        0.2, (metadata_dir / 'metadata.1.json').write_text, args=(new_snapshot,)
+    )
+    writer.start()
+    try:
+        co.watch(interval=0.05, timeout=10)
+    finally:
+        writer.join()
+
+
+def test_croo_watch_partially_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(Croo, 'WATCH_MAX_CONSECUTIVE_FAILURES', 3)
+    start = time.time()
+    # new snapshot is never completely written
+    with pytest.raises(json.JSONDecodeError):
+        watch_with_new_snapshot(tmp_path, '{"id": "watch-test", "calls"')
+    assert time.time() - start < 5
+
+
+def test_croo_watch_workflow_id_mismatch(tmp_path):
+    metadata = make_metadata(tmp_path, 'Done', 'Succeeded')
+    metadata['id'] = 'another-workflow'
+    # not tried again
+    with pytest.raises(ValueError, match='Workflow ID does not match'):
+        watch_with_new_snapshot(tmp_path, json.dumps(metadata))
@@ -0,0 +1,265 @@
+import re
+
+import pytest
+
+from croo.compact_dag import CompactDAG
+from croo.cromwell_metadata import (
+    CMNode,
+    cmnode_keys_as_child,
+    cmnode_keys_as_parent,
+    is_parent_cmnode,
+)
+from croo.dag import DAG
+
+
+def make_task(task_name, shard_idx, inputs=None, outputs=None):
+    return CMNode(
+        type='task',
+        shard_idx=shard_idx,
+        task_name=task_name,
+        output_name=None,
+        output_path=None,
+        all_outputs=tuple(outputs) if outputs else None,
+        all_inputs=tuple(inputs) if inputs else None,
+    )
+
+
+def make_output(task_name, shard_idx, output_name, output_path):
+    return CMNode(
+        type='output',
+        shard_idx=shard_idx,
+        task_name=task_name,
+        output_name=output_name,
+        output_path=output_path,
+        all_outputs=None,
+        all_inputs=None,
+    )
+
+
+@pytest.fixture
+def cmnodes():
+    """Pipeline input -> align (2 shards) -> pool.
+    """
+    nodes = [
+        make_output(None, (-1,), 'fastqs', '/in/{}.fastq'.format(i)) for i in range(2)
+    ]
+    for i in range(2):
+        fastq = '/in/{}.fastq'.format(i)
+        bam = '/out/align/{}.bam'.format(i)
+        nodes.append(
+            make_task(
+                'main.align',
+                (i,),
+                inputs=[('fastq', fastq, (-1,))],
+                outputs=[('bam', bam, (-1,))],
+            )
+        )
+        nodes.append(make_output('main.align', (i,), 'bam', bam))
+    nodes.append(
+        make_task(
+            'main.pool',
+            (-1,),
+            inputs=[('bams', '/out/align/{}.bam'.format(i), (i,)) for i in range(2)],
+            outputs=[('bam', '/out/pool/pooled.bam', (-1,))],
+        )
+    )
+    nodes.append(make_output('main.pool', (-1,), 'bam', '/out/pool/pooled.bam'))
+    return nodes
+
+
+def make_indexed_dag(nodes=None):
+    return DAG(
+        fnc_is_parent=is_parent_cmnode,
+        nodes=nodes,
+        fnc_keys_as_parent=cmnode_keys_as_parent,
+        fnc_keys_as_child=cmnode_keys_as_child,
+    )
+
+
+def test_indexed_add_node_matches_is_parent(cmnodes):
+    dag = make_indexed_dag(cmnodes)
+    dag_is_parent = DAG(fnc_is_parent=is_parent_cmnode, nodes=cmnodes)
+
+    assert dag._parents == dag_is_parent._parents
+    assert dag._children == dag_is_parent._children
+    assert sum(len(v) for v in dag._children.values()) == 7
+
+    # order of insertion should not matter
+    dag_reversed = make_indexed_dag(list(reversed(cmnodes)))
+    assert dag_reversed._parents == dag._parents
+    assert dag_reversed._children == dag._children
+
+
+def test_indexed_add_existing_node(cmnodes):
+    dag = make_indexed_dag(cmnodes)
+    pool = cmnodes[-2]
+    h = dag.hash_node(pool)
+    dag.add_node(pool)
+    assert len(dag._parents[h]) == 2
+    assert len(dag._children[h]) == 1
+
+    dag.rm_node(h)
+    assert h not in dag._nodes
+    assert all(h not in v for v in dag._parents.values())
+    assert all(h not in v for v in dag._children.values())
+    assert ('task', 'main.pool', (-1,)) not in dag._parent_key_index
+
+
+def test_indexed_cyclic_link():
+    dag = make_indexed_dag()
+    dag.add_node(make_output('main.t', (-1,), 'out', '/out/t.txt'))
+    with pytest.raises(ValueError):
+        dag.add_node(make_task('main.t', (-1,), inputs=[('in', '/out/t.txt', (-1,))]))
+
+
+def test_from_nodes_matches_add_node(cmnodes):
+    dag = make_indexed_dag(cmnodes)
+    dag_bulk = DAG.from_nodes(
+        cmnodes + cmnodes[:2],
+        fnc_is_parent=is_parent_cmnode,
+        fnc_keys_as_parent=cmnode_keys_as_parent,
+        fnc_keys_as_child=cmnode_keys_as_child,
+    )
+    assert list(dag_bulk._nodes) == list(dag._nodes)
+    assert dag_bulk._parents == dag._parents
+    assert dag_bulk._children == dag._children
+
+    # add the rest of nodes to a partial graph
+    dag_partial = make_indexed_dag(cmnodes[:4])
+    dag_partial.add_nodes(cmnodes[2:])
+    assert dag_partial._parents == dag._parents
+    assert dag_partial._children == dag._children
+
+
+@pytest.mark.parametrize('indexed', [True, False])
+def test_add_nodes_duplicate_hash(cmnodes, indexed):
+    if indexed:
+        dag = DAG(
+            fnc_is_parent=is_parent_cmnode,
+            fnc_hash=lambda n: n.task_name,
+            fnc_keys_as_parent=cmnode_keys_as_parent,
+            fnc_keys_as_child=cmnode_keys_as_child,
+        )
+    else:
+        dag = DAG(fnc_is_parent=is_parent_cmnode, fnc_hash=lambda n: n.task_name)
+    assert dag.is_indexed == indexed
+    with pytest.raises(ValueError):
+        dag.add_nodes(cmnodes)
+    assert not dag._nodes
+
+    # the same node twice is not a duplicate
+    dag.add_nodes([cmnodes[0], cmnodes[0]])
+    assert len(dag._nodes) == 1
+
+
+def test_add_nodes_cyclic_link():
+    dag = make_indexed_dag()
+    with pytest.raises(ValueError):
+        dag.add_nodes(
+            [
+                make_task('main.t', (-1,), inputs=[('in', '/out/t.txt', (-1,))]),
+                make_output('main.t', (-1,), 'out', '/out/t.txt'),
+            ]
+        )
+
+
+def get_dot_edges(dot_str):
+    return set(re.findall(r'"(-?\d+)" -> "(-?\d+)"', dot_str))
+
+
+def test_to_dot(cmnodes):
+    qc = make_task(
+        'main.qc',
+        (-1,),
+        inputs=[
+            ('fastq', '/in/0.fastq', (-1,)),
+            ('bam', '/out/pool/pooled.bam', (-1,)),
+        ],
+        outputs=[('qc', '/out/qc/qc.txt', (-1,))],
+    )
+    qc_out = make_output('main.qc', (-1,), 'qc', '/out/qc/qc.txt')
+    dag = make_indexed_dag(cmnodes + [qc, qc_out])
+
+    def fnc_node_format(n):
+        if n.type == 'output':
+            return '[label="{}"]'.format(n.output_name)
+
+    def h(path):
+        ((h, _),) = dag.find_nodes(lambda n: n.output_path == path)
+        return str(h)
+
+    fastqs = [h('/in/{}.fastq'.format(i)) for i in range(2)]
+    bams = [h('/out/align/{}.bam'.format(i)) for i in range(2)]
+    pooled = h('/out/pool/pooled.bam')
+    expected = {(fastqs[i], bams[i]) for i in range(2)}
+    expected |= {(bams[i], pooled) for i in range(2)}
+    expected.add((pooled, h('/out/qc/qc.txt')))
+
+    edges = get_dot_edges(dag.to_dot(fnc_node_format))
+    assert edges == expected | {(fastqs[0], h('/out/qc/qc.txt'))}
+
+    edges = get_dot_edges(dag.to_dot(fnc_node_format, transitive_reduction=True))
+    assert edges == expected
+
+
+def test_compact_dag(cmnodes):
+    dag = make_indexed_dag(cmnodes)
+    compact_dag = CompactDAG.from_nodes(
+        cmnodes,
+        fnc_is_parent=is_parent_cmnode,
+        fnc_keys_as_parent=cmnode_keys_as_parent,
+        fnc_keys_as_child=cmnode_keys_as_child,
+    )
+    assert [n for _, n in compact_dag.get_nodes()] == cmnodes
+
+    hashes = list(dag._nodes)
+    for i, n in compact_dag.get_nodes():
+        h = hashes[i]
+        assert {hashes[j] for j in compact_dag.get_parents(i)} == dag._parents[h]
+        assert {hashes[j] for j in compact_dag.get_children(i)} == dag._children[h]
+
+    def fnc_node_format(n):
+        if n.type == 'output':
+            return '[label="{}"]'.format(n.output_name)
+
+    edges = {
+        (hashes[int(i)], hashes[int(j)])
+        for i, j in get_dot_edges(compact_dag.to_dot(fnc_node_format))
+    }
+    assert edges == {
+        (int(i), int(j)) for i, j in get_dot_edges(dag.to_dot(fnc_node_format))
+    }
+
+    i = compact_dag.get_id(cmnodes[-2])
+    compact_dag.rm_node(i)
+    assert i not in [i_ for i_, _ in compact_dag.get_nodes()]
+    assert all(i not in compact_dag.get_parents(i_) for i_ in range(len(cmnodes)))
+
+    compact_dag.add_node(
+        make_task('main.t', (-1,), inputs=[('in', '/out/pool/pooled.bam', (-1,))])
+    )
+    with pytest.raises(ValueError):
+        compact_dag.add_node(
+            make_output('main.t', (-1,), 'out', '/out/pool/pooled.bam')
+        )
+
+
+@pytest.mark.parametrize('dag_cls', [DAG, CompactDAG])
+def test_secondary_index(cmnodes, dag_cls):
+    dag = dag_cls.from_nodes(
+        cmnodes[:3],
+        fnc_is_parent=is_parent_cmnode,
+        fnc_keys_as_parent=cmnode_keys_as_parent,
+        fnc_keys_as_child=cmnode_keys_as_child,
+    )
+    dag.add_secondary_index('task', lambda n: n.task_name if n.type == 'task' else None)
+    dag.add_nodes(cmnodes[3:])
+
+    for task_name in ('main.align', 'main.pool', 'main.qc', None):
+        assert dag.find_nodes_by_secondary_index('task', task_name) == dag.find_nodes(
+            lambda n: n.type == 'task' and n.task_name == task_name
+        )
+
+    ((h, _),) = dag.find_nodes_by_secondary_index('task', 'main.pool')
+    dag.rm_node(h)
+    assert not dag.find_nodes_by_secondary_index('task', 'main.pool')
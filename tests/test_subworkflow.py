@@ -1,6 +1,9 @@
+import os
+
 import pytest
 
 from croo.croo import Croo
+from croo.croo_checksum_cache import CrooChecksumCache
 
 
 @pytest.mark.parametrize(
@@ -77,3 +80,34 @@ def test_subworkflow(
 
     for expected_relpath in expected_relpaths:
         assert (tmp_path / expected_relpath).exists
+
+
+def test_subworkflow_plan(metadata_json_for_subworkflow, tmp_path):
+    cm = Croo(
+        metadata_json=str(metadata_json_for_subworkflow),
+        out_def_json={
+            "main.t_main_1": {
+                "out": {"path": "main.t_main_1/${i}/${basename}", "table": "T/${i}"}
+            }
+        },
+        out_dir=str(tmp_path / 'out'),
+        tmp_dir=str(tmp_path / 'tmp'),
+        soft_link=False,
+    )
+    plan = cm.plan(check_storage=False)
+
+    targets = sorted(output['target'] for output in plan['outputs'])
+    assert targets == [
+        str(tmp_path / 'out' / 'main.t_main_1/0/t_main_1.0.out'),
+        str(tmp_path / 'out' / 'main.t_main_1/1/t_main_1.1.out'),
+    ]
+    assert sorted(output['table'] for output in plan['outputs']) == ['T/0', 'T/1']
+    assert plan['summary']['num_jobs'] == 2
+    assert plan['summary']['bytes_to_transfer'] is None
+    assert not (tmp_path / 'out').exists()
+
+    # nothing is written on tmp_dir (e.g. checksum cache DB) either
+    plan = cm.plan(check_storage=True)
+    assert plan['summary']['bytes_to_transfer'] is not None
+    assert not (tmp_path / 'out').exists()
+    assert not os.path.exists(str(tmp_path / 'tmp' / CrooChecksumCache.DB_FILE))